@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import argparse, contextlib, copy, os, time
+import pdb_util as util
+import manifest
+import prepareamber
+
+#Prepares many complexes at once, e.g. every hit from a virtual screen against
+#one receptor. The force field setup and each distinct receptor are done once
+#and shared; the ligands are then fanned out over a pool of worker processes,
+#each complex getting its own directory.
+
+def prepare_receptor(receptor, workdir, args, ff, ions, standard_res):
+    '''
+    Run a receptor through pdb4amber once in workdir. Returns its
+    prepare_structure output with absolute paths, to be shared by every
+    complex that uses it
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        struct,mol,metal_info,reslist,_ = prepareamber.load_structure(receptor,
+                None, args.overwrite, ions, standard_res)
+        assert not reslist, 'Receptor %s has nonstandard residues %s; prepare \
+it with prepareamber and pass its libraries with -p\n' %(receptor,
+                ' '.join(reslist))
+        struct,mol,libs,ante_lig,out = prepareamber.prepare_structure(struct,
+                mol, reslist, [], metal_info, None, ff, args, False)
+        return (os.path.abspath(struct), mol, [os.path.abspath(lib) for lib in
+            libs], ante_lig, out)
+    finally:
+        os.chdir(cwd)
+
+def prepare_complex(name, args, ff, ions, standard_res, receptor, workdir):
+    '''
+    Prepare one complex in its own directory, logging to prepare.log there.
+    Returns its row of the summary table
+    '''
+    start = time.time()
+    status, error = 'done', ''
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        with open('prepare.log', 'w') as log, contextlib.redirect_stdout(log):
+            prepareamber.prepare(args, ff, ions, standard_res, receptor)
+    #prepareamber exits on some failures; that shouldn't end the batch
+    except (Exception, SystemExit) as e:
+        status, error = 'failed', str(e).strip() or type(e).__name__
+    finally:
+        os.chdir(cwd)
+    return {'name': name, 'status': status, 'seconds': '%.1f' %(time.time() -
+        start), 'error': error}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepare many complexes for \
+    AMBER MD from a manifest, sharing the force field setup and receptor \
+    preparation between them. Options other than those below are passed to \
+    prepareamber for every complex.')
+
+    parser.add_argument('-m', '--manifest', required=True, help='CSV or YAML \
+    manifest listing the complexes; each gives a ligand and optionally a \
+    name, receptor and net_charge.')
+
+    parser.add_argument('-R', '--receptor', help='Receptor for manifest \
+    entries that don\'t give one.')
+
+    parser.add_argument('-o', '--outdir', default='batch', help='Directory \
+    for the per-complex directories and summary; defaults to "batch".')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of \
+    complexes to prepare at once; defaults to 1.')
+
+    batch_args,passthrough = parser.parse_known_args()
+    complexes = manifest.read_manifest(batch_args.manifest,
+            batch_args.receptor)
+    outdir = os.path.abspath(batch_args.outdir)
+    os.makedirs(outdir, exist_ok=True)
+
+    #options shared by every complex; the workers run without a terminal, and
+    #in their own directories, so paths have to be absolute
+    args = prepareamber.get_parser(require_structures=False).parse_args(
+            passthrough)
+    if args.structures:
+        parser.error('the structures come from the manifest; -s/--structures \
+can\'t be given')
+    args.uninteractive = True
+    args.jobs = 1
+    if args.libs:
+        args.libs = [os.path.abspath(lib) for lib in args.libs]
+    if args.extra:
+        args.extra = os.path.abspath(args.extra)
+    args.cache_dir = os.path.abspath(args.cache_dir)
+    ff, ions, standard_res = prepareamber.setup_forcefields(args)
+
+    receptors = {}
+    for entry in complexes:
+        if entry['receptor'] not in receptors:
+            workdir = os.path.join(outdir, 'receptors', '%d_%s' %
+                    (len(receptors), util.get_base(entry['receptor'])))
+            receptors[entry['receptor']] = prepare_receptor(entry['receptor'],
+                    workdir, args, ff, ions, standard_res)
+
+    jobs = []
+    for entry in complexes:
+        complex_args = copy.copy(args)
+        complex_args.structures = [entry['ligand']]
+        complex_args.out_name = entry['name']
+        complex_args.net_charge = entry.get('net_charge', args.net_charge)
+        jobs.append((entry['name'], complex_args, ff, ions, standard_res,
+            receptors[entry['receptor']], os.path.join(outdir, entry['name'])))
+    rows = prepareamber.run_jobs(prepare_complex, jobs, batch_args.jobs)
+    manifest.write_summary(os.path.join(outdir, 'summary.csv'), rows)
+    failed = sum(row['status'] != 'done' for row in rows)
+    print('%d of %d complexes prepared; see %s for details\n' %(len(rows) -
+        failed, len(rows), os.path.join(outdir, 'summary.csv')))
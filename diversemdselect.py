@@ -1,83 +1,48 @@
 #!/usr/bin/env python
 
 import MDAnalysis, argparse
-from MDAnalysis.analysis.rms import rmsd
+import rmsd_engine
 import MDAnalysis.analysis
 import os
 from os.path import splitext, basename
 
-#This finds the most distinct set of frames.  Does not perform alignment, just rmsd.
+#This finds the most distinct set of frames.  Does not perform alignment, just rmsd,
+#unless --superpose is given.
 
-def compute_cluster_sizes(current, model, selection):
-	"""Given a set of frames (current), assign each from in
-	the trajectory to its closest current frame to get cluster sizes and radii"""
-	cnts = [0]*len(current)
-	maxrmsd = [0]*len(current)
-	for ts in model.trajectory:
-		frame = ts.frame
-		minr = float('infinity')
-		closest = 0
-		for (pos,(refframe, refcoords)) in enumerate(current):
-			r = rmsd(refcoords, selection.positions)			
-			if r < minr:
-				minr = r
-				closest = pos
-		cnts[closest] += 1
-		if minr > maxrmsd[closest]:
-			maxrmsd[closest] = minr
-	return (cnts,maxrmsd)
-		
-def add_next_farthest(current, model, selection):
-	"""Given a list of frames (frame number, coordinates) current
-		identify the frame that has the maximum minimum distance
-		from current and add it to current"""
-	maxr = 0
-	maxframe = 0
-	maxcoords = None
-	for ts in model.trajectory:
-		frame = ts.frame
-		minr = float('infinity')
-		for (refframe, refcoords) in current:
-			r = rmsd(refcoords, selection.positions)			
-			if r < minr:
-				minr = r
-		if minr > maxr:
-			maxframe = frame
-			maxr = minr
-			maxcoords = selection.positions
-	
-	current.append( (maxframe, maxcoords) )
-
-
-parser = argparse.ArgumentParser(description='Identify most distinct frames of md trajectory\nIMPORTANT: assumes an aligned input')
+parser = argparse.ArgumentParser(description='Identify most distinct frames of md trajectory\nIMPORTANT: assumes an aligned input unless --superpose is given')
 parser.add_argument("topology")
 parser.add_argument("trajectory")
 parser.add_argument("size",type=int)
 parser.add_argument("--selection",default="backbone",required=False)
 parser.add_argument("--output_selection",default="not (resname WAT or resname HOH)",required=False)
+parser.add_argument("--assignments",help="Save each frame's nearest selected frame and its rmsd to it to this file (.npz or .csv)")
+parser.add_argument("--superpose",action="store_true",help="Superimpose frames before computing RMSDs, so the trajectory needn't be aligned first")
 
 args = parser.parse_args()
 
 model = MDAnalysis.Universe(args.topology,args.trajectory)
 selection = model.select_atoms(args.selection)
 
-current = [(0, selection.positions)]
-
-for i in range(args.size-1):
-	add_next_farthest(current, model, selection)
+#read the trajectory once; each frame added then takes one pass of rmsds to it,
+#which also keeps track of the cluster of frames nearest each one
+coords = rmsd_engine.load_coords(model, selection)
+sampler = rmsd_engine.farthest_point_sampling(coords, args.size, 0, args.superpose)
+current = sampler.centers
+if args.assignments:
+	sampler.save(args.assignments)
 
 name = splitext(basename(args.topology))[0]
 
-for (frame,coords) in current:
+for frame in current:
 	model.trajectory[frame] #has side effect of setting current frame
 	fname = "%s_%d.pdb" % (name, frame)
 	model.select_atoms(args.output_selection).write(fname)
 	os.system("sed -i '/REMARK/d' %s" % fname) #remove remarks with binary characters
 
 #print out frame numbers and their respective cnts
-(cnts,rmsds) = compute_cluster_sizes(current,model,selection)
+(cnts,rmsds) = (sampler.cluster_sizes(),sampler.cluster_radii())
 for i in range(len(current)):
-	(frame,coords) = current[i]
+	frame = current[i]
 	cnt = cnts[i]
 	rmsd = rmsds[i]
 	print('%d:\t%d\t%.3f' % (frame,cnt,rmsd))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import csv, os
+import pdb_util as util
+
+#Reading batchprepare's manifests of complexes and writing its summary table;
+#kept apart from batchprepare so it doesn't need AmberTools to import.
+
+def read_manifest(fname, receptor=None):
+    '''
+    Read the complexes to prepare from a CSV manifest with a header row or a
+    YAML manifest (a list of complexes, or a mapping with a default
+    "receptor" and a list of "complexes"). Each complex needs a ligand and
+    may give a name, a receptor (defaulting to the one passed in) and a
+    net_charge. Paths are relative to the manifest. Returns a list of dicts
+    '''
+    ext = os.path.splitext(fname)[-1].lower()
+    if ext in ['.yaml', '.yml']:
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Reading YAML manifests requires PyYAML')
+        with open(fname, 'r') as f:
+            contents = yaml.safe_load(f) or []
+        if isinstance(contents, dict):
+            if contents.get('receptor'):
+                receptor = os.path.join(os.path.dirname(fname),
+                        contents['receptor'])
+            contents = contents.get('complexes', [])
+    else:
+        with open(fname, 'r', newline='') as f:
+            contents = list(csv.DictReader(f))
+    root = os.path.dirname(os.path.abspath(fname))
+    complexes = []
+    names = set()
+    for i,entry in enumerate(contents):
+        entry = {str(key).strip(): str(value).strip() for key,value in
+                entry.items() if value is not None and str(value).strip()}
+        assert 'ligand' in entry, 'Manifest entry %d has no ligand\n' %(i+1)
+        entry['ligand'] = os.path.join(root, entry['ligand'])
+        if 'receptor' in entry:
+            entry['receptor'] = os.path.join(root, entry['receptor'])
+        elif receptor:
+            entry['receptor'] = os.path.abspath(receptor)
+        else:
+            raise AssertionError('Manifest entry %d has no receptor and no \
+default receptor was given\n' %(i+1))
+        entry.setdefault('name', util.get_base(entry['ligand']))
+        assert entry['name'] not in names, 'Duplicate complex name %s in \
+manifest\n' %entry['name']
+        names.add(entry['name'])
+        complexes.append(entry)
+    return complexes
+
+def write_summary(fname, rows):
+    '''
+    Write the summary table as CSV and print it
+    '''
+    fields = ['name', 'status', 'seconds', 'error']
+    with open(fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    width = max([len('name')] + [len(row['name']) for row in rows])
+    print('%-*s %-6s %8s  %s' %(width, 'name', 'status', 'seconds', 'error'))
+    for row in rows:
+        print('%-*s %-6s %8s  %s' %(width, row['name'], row['status'],
+            row['seconds'], row['error'].splitlines()[0] if row['error'] else
+            ''))
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+import abc, os, re, shutil
+import numpy as np
+from plumbum import local, FG
+
+#Engines that run the minimization and MD stages prepareamber sets up. Every
+#stage is described the way pmemd sees it: an mdin file, the topology, the
+#starting coordinates, and the files to write. The AMBER engines run pmemd or
+#sander on exactly that; the OpenMM engine reads the settings out of the mdin
+#and sets up the equivalent simulation; the mock engine runs nothing and just
+#stands in for the outputs, for testing.
+
+class MDRun:
+    '''
+    One minimization or MD run, named by pmemd's flags for its files.
+
+    Attributes:
+        mdin: Input file with the &cntrl namelist and any GROUP restraints.
+
+        mdout: Log to write.
+
+        prmtop: Topology.
+
+        inpcrd: Starting coordinates (and velocities and box, for a restart).
+
+        restrt: Restart file to write at the end.
+
+        refc: Reference coordinates for positional restraints, if any.
+
+        mdcrd: Trajectory to write, if any.
+    '''
+    def __init__(self, mdin, mdout, prmtop, inpcrd, restrt, refc=None,
+            mdcrd=None):
+        self.mdin = mdin
+        self.mdout = mdout
+        self.prmtop = prmtop
+        self.inpcrd = inpcrd
+        self.restrt = restrt
+        self.refc = refc
+        self.mdcrd = mdcrd
+
+def parse_value(value):
+    value = value.strip().strip('\'"')
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+def read_mdin(fname):
+    '''
+    Read an AMBER mdin file. Returns the &cntrl settings as a dict with
+    lowercase keys, and the GROUP restraints that follow it (if ntr=1) as
+    a dict with the weight in kcal/mol/A^2 and the list of (first, last)
+    residue ranges it applies to, or None
+    '''
+    with open(fname, 'r') as f:
+        contents = f.read()
+    m = re.search(r'&cntrl(.*?)^\s*(/|&end)\s*$', contents, re.S | re.M |
+            re.I)
+    assert m, 'No &cntrl namelist in %s\n' %fname
+    cntrl = {key.lower(): parse_value(value) for key,value in
+            re.findall(r'(\w+)\s*=\s*([^,\s]+)', m.group(1))}
+    restraint = None
+    if cntrl.get('ntr', 0) == 1:
+        lines = [line.strip() for line in contents[m.end():].splitlines() if
+                line.strip()]
+        assert len(lines) > 1, 'Restraints requested but no GROUP input in \
+%s\n' %fname
+        residues = []
+        for line in lines:
+            fields = line.split()
+            if fields[0].upper() == 'RES':
+                residues += [(int(fields[i]), int(fields[i+1])) for i in
+                        range(1, len(fields)-1, 2)]
+        restraint = {'weight': float(lines[1]), 'residues': residues}
+    return cntrl, restraint
+
+class Engine(abc.ABC):
+    '''
+    Base class; subclasses return something printable for the runfile from
+    command and run it with execute
+    '''
+    name = ''
+
+    @abc.abstractmethod
+    def command(self, run):
+        '''
+        Return what to run for an MDRun, printable for the runfile
+        '''
+
+    @abc.abstractmethod
+    def execute(self, command):
+        '''
+        Run what command returned
+        '''
+
+class AmberEngine(Engine):
+    '''
+    Runs pmemd or sander, optionally under an MPI launcher.
+
+    Attributes:
+        executable: The program to run.
+
+        launcher: Command prefix, e.g. mpirun -np 8, or None.
+
+        runner: tool_runner.ToolRunner to run it with, or None to run it in
+        the foreground with plumbum.
+    '''
+    def __init__(self, name, executable, launcher=None, runner=None):
+        self.name = name
+        self.executable = executable
+        self.launcher = launcher
+        self.runner = runner
+
+    def command(self, run):
+        args = ['-O', '-i', run.mdin, '-o', run.mdout, '-p', run.prmtop, '-c',
+                run.inpcrd, '-r', run.restrt]
+        if run.refc:
+            args += ['-ref', run.refc]
+        if run.mdcrd:
+            args += ['-x', run.mdcrd]
+        if self.launcher is not None:
+            return self.launcher[str(self.executable)][args]
+        return self.executable[args]
+
+    def execute(self, command):
+        if self.runner:
+            self.runner.run(command, os.path.basename(str(self.executable)))
+        else:
+            command & FG
+
+class OpenMMRun:
+    '''
+    What the OpenMM engine runs for an MDRun; prints like a command line
+    '''
+    def __init__(self, run, platform):
+        self.run = run
+        self.platform = platform
+
+    def __str__(self):
+        run = self.run
+        return 'openmm[%s] -i %s -o %s -p %s -c %s -r %s%s%s' %(self.platform
+                or 'auto', run.mdin, run.mdout, run.prmtop, run.inpcrd,
+                run.restrt, ' -ref ' + run.refc if run.refc else '', ' -x ' +
+                run.mdcrd if run.mdcrd else '')
+
+class OpenMMEngine(Engine):
+    '''
+    Runs each stage in OpenMM, set up from the mdin: minimization or
+    Langevin dynamics, PME if there's a box, HBond constraints for ntc=2, a
+    Monte Carlo barostat for ntp=1. GROUP restraints are applied to the heavy
+    atoms of the residues they select. Restarts and trajectories are written
+    in AMBER formats with ParmEd, so stages can mix engines.
+
+    Attributes:
+        platform: OpenMM platform name, or None for the fastest available.
+
+        threads: CPU threads, for the CPU platform.
+    '''
+    name = 'openmm'
+
+    def __init__(self, platform=None, threads=None):
+        self.platform = platform
+        self.threads = threads
+
+    def command(self, run):
+        return OpenMMRun(run, self.platform)
+
+    def execute(self, command):
+        try:
+            import openmm
+            from openmm import app, unit
+            from openmm.app.internal.unitcell import computePeriodicBoxVectors
+        except ImportError:
+            try:
+                from simtk import openmm, unit
+                from simtk.openmm import app
+                from simtk.openmm.app.internal.unitcell import \
+                        computePeriodicBoxVectors
+            except ImportError:
+                raise ImportError('The openmm engine requires OpenMM')
+        try:
+            import parmed
+            from parmed.openmm.reporters import NetCDFReporter
+        except ImportError:
+            raise ImportError('The openmm engine requires ParmEd')
+        run = command.run
+        cntrl,restraint = read_mdin(run.mdin)
+        prmtop = app.AmberPrmtopFile(run.prmtop)
+        start = parmed.amber.Rst7.open(run.inpcrd)
+        box = start.box if start.hasbox else None
+        #OpenMM works in nm
+        positions = np.asarray(start.coordinates).reshape(-1, 3) / 10.
+
+        nonbonded = app.PME if box is not None else app.CutoffNonPeriodic
+        system = prmtop.createSystem(nonbondedMethod=nonbonded,
+                nonbondedCutoff=cntrl.get('cut', 8.0)*unit.angstrom,
+                constraints=app.HBonds if cntrl.get('ntc', 1) == 2 else None)
+        temp = cntrl.get('temp0', 300.0)*unit.kelvin
+        if restraint:
+            ref = parmed.amber.Rst7.open(run.refc or run.inpcrd)
+            force = openmm.CustomExternalForce('k*periodicdistance(x, y, z, '
+                    'x0, y0, z0)^2')
+            #kcal/mol/A^2 -> kJ/mol/nm^2
+            force.addGlobalParameter('k', restraint['weight'] * 418.4)
+            ref_positions = np.asarray(ref.coordinates).reshape(-1, 3) / 10.
+            for name in ('x0', 'y0', 'z0'):
+                force.addPerParticleParameter(name)
+            for atom in prmtop.topology.atoms():
+                resnum = atom.residue.index + 1
+                if atom.element is not None and atom.element.symbol != 'H' \
+                        and any(first <= resnum <= last for first,last in
+                                restraint['residues']):
+                    force.addParticle(atom.index,
+                            ref_positions[atom.index].tolist())
+            system.addForce(force)
+        if cntrl.get('ntp', 0) and box is not None:
+            system.addForce(openmm.MonteCarloBarostat(cntrl.get('pres0',
+                1.0)*unit.bar, temp))
+        integrator = openmm.LangevinMiddleIntegrator(temp,
+                cntrl.get('gamma_ln', 1.0)/unit.picosecond, cntrl.get('dt',
+                    0.001)*unit.picosecond)
+
+        args = [prmtop.topology, system, integrator]
+        if self.platform:
+            platform = openmm.Platform.getPlatformByName(self.platform)
+            properties = {}
+            if self.platform == 'CPU' and self.threads:
+                properties['Threads'] = str(self.threads)
+            args += [platform, properties]
+        simulation = app.Simulation(*args)
+        if box is not None:
+            simulation.context.setPeriodicBoxVectors(*computePeriodicBoxVectors(
+                *[length / 10. for length in box[:3]] + [np.radians(angle) for
+                    angle in box[3:]]))
+        simulation.context.setPositions(positions)
+
+        with open(run.mdout, 'w') as mdout:
+            if cntrl.get('imin', 0) == 1:
+                openmm.LocalEnergyMinimizer.minimize(simulation.context,
+                        maxIterations=cntrl.get('maxcyc', 1))
+            else:
+                if cntrl.get('irest', 0) and start.hasvels:
+                    simulation.context.setVelocities(np.asarray(
+                        start.velocities).reshape(-1, 3) / 10.)
+                elif cntrl.get('tempi', 0):
+                    simulation.context.setVelocitiesToTemperature(
+                            cntrl['tempi']*unit.kelvin)
+                simulation.reporters.append(app.StateDataReporter(mdout,
+                    cntrl.get('ntpr', 50), step=True, potentialEnergy=True,
+                    temperature=True, volume=True))
+                if run.mdcrd and cntrl.get('ntwx', 0):
+                    simulation.reporters.append(NetCDFReporter(run.mdcrd,
+                        cntrl['ntwx']))
+                simulation.step(cntrl.get('nstlim', 1))
+            state = simulation.context.getState(getPositions=True,
+                    getVelocities=True, getEnergy=True, enforcePeriodicBox=True)
+            mdout.write('Final potential energy: %s\n' %state.getPotentialEnergy())
+
+        restart = parmed.amber.Rst7(natom=system.getNumParticles())
+        restart.coordinates = state.getPositions(asNumpy=True).value_in_unit(
+                unit.angstrom)
+        restart.velocities = state.getVelocities(asNumpy=True).value_in_unit(
+                unit.angstrom/unit.picosecond)
+        if box is not None:
+            vectors = state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(
+                    unit.angstrom)
+            lengths = np.linalg.norm(vectors, axis=1)
+            angles = [np.degrees(np.arccos(np.dot(vectors[j], vectors[k]) /
+                (lengths[j] * lengths[k]))) for j,k in ((1, 2), (0, 2), (0, 1))]
+            restart.box = list(lengths) + angles
+        restart.write(run.restrt, netcdf=cntrl.get('ntxo', 1) == 2)
+
+class MockEngine(Engine):
+    '''
+    Runs nothing: copies the starting coordinates to the restart and writes
+    an mdout (and an empty trajectory) saying so. For testing workflows
+    without an MD code.
+    '''
+    name = 'mock'
+
+    def command(self, run):
+        return run
+
+    def execute(self, run):
+        read_mdin(run.mdin)
+        shutil.copyfile(run.inpcrd, run.restrt)
+        with open(run.mdout, 'w') as f:
+            f.write('mock engine: %s not run\n' %run.mdin)
+        if run.mdcrd:
+            open(run.mdcrd, 'w').close()
+
+def find_executable(names):
+    '''
+    Return a plumbum command for the first of names on the path
+    '''
+    for name in names:
+        try:
+            return local[name]
+        except Exception:
+            pass
+    raise ImportError('Check that one of %s is on your path' %', '.join(names))
+
+def get_engine(name, ranks=1, runner=None):
+    '''
+    Return the engine called name: "cuda" for pmemd.cuda, "cpu" for pmemd or
+    sander (run with MPI if ranks > 1), "openmm" or "mock". Executables are
+    only looked for here, so nothing is needed to import this module or to
+    only build parameters. AMBER executables are run with runner if given
+    '''
+    if name == 'cuda':
+        return AmberEngine(name, find_executable(['pmemd.cuda', 'pmemd_cuda']),
+                runner=runner)
+    elif name == 'cpu':
+        if ranks > 1:
+            launcher = find_executable(['mpirun', 'mpiexec'])['-np', ranks]
+            return AmberEngine(name, find_executable(['pmemd.MPI',
+                'sander.MPI']), launcher, runner)
+        return AmberEngine(name, find_executable(['pmemd', 'sander']),
+                runner=runner)
+    elif name == 'openmm':
+        return OpenMMEngine(threads=ranks)
+    elif name == 'mock':
+        return MockEngine()
+    raise ValueError('Unknown MD engine %s' %name)
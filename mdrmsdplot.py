@@ -3,12 +3,12 @@
 import sys, MDAnalysis
 import numpy as np
 from os.path import splitext
-from MDAnalysis.analysis.rms import *
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import seaborn as sns
 import argparse
+import rmsd_engine
 
-parser = argparse.ArgumentParser(description='Generate pairwise RMSD heatmap plot.\nIMPORTANT: assumes an aligned input')
+parser = argparse.ArgumentParser(description='Generate pairwise RMSD heatmap plot.\nIMPORTANT: assumes an aligned input unless --superpose is given')
 parser.add_argument("topology")
 parser.add_argument("trajectory")
 parser.add_argument("--selection",default="backbone",help="MDAnalysis selection for computing RMSD",required=False)
@@ -16,6 +16,12 @@ parser.add_argument("--step",default=10, type=int, required=False,help="Frames t
 parser.add_argument('--title',help="Graph title")
 parser.add_argument('-o','--output',type=str,help="Output filename")
 parser.add_argument('--max',type=float,help='Max RMSD value to consider',default=None)
+parser.add_argument('--tile',default=512,type=int,help="Frames per block of the RMSD matrix computed at once")
+parser.add_argument('--threads',default=1,type=int,help="Blocks of the RMSD matrix to compute at once")
+parser.add_argument('--cutoff',default=2.0,type=float,help="RMSD within which frames count as neighbors")
+parser.add_argument('--memmap',help="Write the RMSD matrix to this .npy file instead of keeping it in memory, for long trajectories")
+parser.add_argument('--superpose',action='store_true',help="Superimpose each pair of frames before computing their RMSD, so the trajectory needn't be aligned first")
+parser.add_argument('--plot_max',default=2000,type=int,help="Most frames to show along each axis of the heatmap; longer matrices are subsampled")
 args = parser.parse_args()
 
 top = args.topology
@@ -28,34 +34,27 @@ if not args.title:
 if not args.output:
     args.output = base+'.png'
     
-u1 = MDAnalysis.Universe(top,traj)
-u2 = MDAnalysis.Universe(top,traj)
+u = MDAnalysis.Universe(top,traj)
 
 # arguments: topology, trajector, [selection], [graph title], [step]
 # todo, switch to argparse
-sel = args.selection
-
-n = u1.trajectory.n_frames
-
-div = args.step
-downn = n//div 
-if n % div != 0:
-    downn += 1
-rmat = np.zeros((downn,downn))
-
-sel1 = u1.select_atoms(sel)
-sel2 = u2.select_atoms(sel)
-#print len(sel1),len(sel2)
-for t1 in u1.trajectory[::div]:
-    for t2 in u2.trajectory[t1.frame::div]:
-        rmat[t2.frame//div, t1.frame//div] = rmat[t1.frame//div, t2.frame//div] = rmsd(sel1.positions,sel2.positions)
+sel = u.select_atoms(args.selection)
+
+#read every step-th frame once, then compute all pairs with matrix products
+coords = rmsd_engine.load_coords(u, sel, args.step)
+#and count each frame's neighbors as the tiles are computed
+ndown = len(coords)
+if args.memmap:
+    rmat = rmsd_engine.open_memmap(args.memmap, (ndown,ndown))
+else:
+    rmat = np.zeros((ndown,ndown),dtype=np.float32)
+cutoff = args.cutoff
+cnts = rmsd_engine.tiled_rmsd(coords, rmat, cutoff, args.tile, args.threads, args.superpose)
 
 np.set_printoptions(threshold=np.inf,precision=2)
 
 
 #find frame with most other frames under cutoff
-cutoff = 2.0
-cnts = np.array([len(row[row < cutoff]) for row in rmat])
 pos = cnts.argmax()
 print("Frame %d is within %.2f of %d frames" % (pos, cutoff, cnts[pos]))
 
@@ -64,15 +63,21 @@ import matplotlib.pylab as plt
 plt.figure()
 plt.title(args.title)
 
+#a heatmap can't show more frames than it has pixels anyway
+stride = -(-ndown//args.plot_max)
+shown = np.asarray(rmat[::stride,::stride])
+
 #multiples of 10, but no more than 6ish ticks
 n = 10
-while len(rmat)/n > 6:
+while ndown/n > 6:
     n += 10
+#label the shown rows that are (or are the first past) a multiple
+labels = [str(i) if i % n < stride else '' for i in range(0,ndown,stride)]
 
 if args.max:
-    sns.heatmap(rmat,square=True,xticklabels=n,yticklabels=n,cmap='YlGnBu',cbar_kws={'label':'RMSD'},vmin=0,vmax=args.max)
+    sns.heatmap(shown,square=True,xticklabels=labels,yticklabels=labels,cmap='YlGnBu',cbar_kws={'label':'RMSD'},vmin=0,vmax=args.max)
 else:
-    sns.heatmap(rmat,square=True,xticklabels=n,yticklabels=n,cmap='YlGnBu',cbar_kws={'label':'RMSD'},vmin=0)
+    sns.heatmap(shown,square=True,xticklabels=labels,yticklabels=labels,cmap='YlGnBu',cbar_kws={'label':'RMSD'},vmin=0)
 plt.xlabel("Frame #")
 plt.ylabel("Frame #")
 ax = plt.gca()
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+import hashlib, itertools, json, os, shutil, tempfile, time
+import simplepdb as pdb
+import pdb_util as util
+
+#Persistent cache for ligand parameters generated with antechamber/parmchk.
+#Entries are directories named by a hash of everything that determines the
+#parameters (ligand topology, net charge, force fields, unit name, AmberTools
+#version) holding copies of the output files; the least recently used entries
+#are evicted once the cache grows past its size limit. The topology hash can
+#collide for different molecules, so a cached mol2 is only used if its atoms
+#and bonds match the ligand's, and molecules that collide get separate
+#entries under the same key.
+
+default_cache_dir = os.environ.get('PREPAREAMBER_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'prepareamber'))
+default_max_size = 1024 * 2**20
+
+def bond_graph(mol):
+    '''
+    Return a molecule's atom names, elements, and bonds as pairs of atom
+    indices. Bonds are perceived from distances so that they don't depend on
+    which CONECT records the input happened to have
+    '''
+    mol = pdb.simplepdb(mol)
+    elements = mol.get_elements()
+    pairs = util.find_bonds(util.get_coords(mol), elements)
+    return ([name.strip() for name in mol.mol_data['atomname']], elements,
+            [(int(i), int(j)) for i,j in pairs])
+
+def refine(labels, neighbors):
+    '''
+    Refine atom labels by their neighbors' labels until that stops splitting
+    classes of atoms (Weisfeiler-Lehman)
+    '''
+    for _ in range(len(labels)):
+        new_labels = [hashlib.sha1((label + '(' + ','.join(sorted(labels[j]
+            for j in neighbors[i])) + ')').encode()).hexdigest() for i,label
+            in enumerate(labels)]
+        if len(set(new_labels)) == len(set(labels)):
+            return new_labels
+        labels = new_labels
+    return labels
+
+def topology_hash(mol):
+    '''
+    Return a hash of a molecule's element-labeled bond graph that doesn't
+    depend on coordinates, atom order, or atom names, from its atoms' refined
+    labels. Different molecules can share a hash (1-WL refinement can't tell
+    decalin from bicyclopentyl, and stereochemistry and bond orders aren't
+    part of the graph), so it only narrows down which cache entries to check
+    with same_molecule
+    '''
+    names, elements, bonds = bond_graph(mol)
+    neighbors = [set() for _ in elements]
+    for i,j in bonds:
+        neighbors[i].add(j)
+        neighbors[j].add(i)
+    labels = refine(elements, neighbors)
+    return hashlib.sha256(','.join(sorted(labels)).encode()).hexdigest()
+
+def isomorphic(a, b, max_steps=10**6):
+    '''
+    Return whether two labeled graphs, each given as (labels, bonds) with
+    bonds as pairs of atom indices, are the same up to the order of their
+    atoms. Labels are refined on both graphs together to prune the search
+    for a mapping between them, which is exact; a search that takes more
+    than max_steps is given up on as a mismatch
+    '''
+    (labels_a, bonds_a), (labels_b, bonds_b) = a, b
+    n = len(labels_a)
+    edges_a = set(frozenset(bond) for bond in bonds_a)
+    edges_b = set(frozenset(bond) for bond in bonds_b)
+    if n != len(labels_b) or len(edges_a) != len(edges_b):
+        return False
+    #the disjoint union, so labels from either graph are comparable
+    neighbors = [set() for _ in range(2 * n)]
+    for offset,edges in ((0, edges_a), (n, edges_b)):
+        for i,j in edges:
+            neighbors[i + offset].add(j + offset)
+            neighbors[j + offset].add(i + offset)
+    labels = refine(list(labels_a) + list(labels_b), neighbors)
+    if sorted(labels[:n]) != sorted(labels[n:]):
+        return False
+    #map atoms in breadth-first order, so each is constrained by a neighbor
+    order = []
+    seen = set()
+    for start in sorted(range(n), key=lambda i: labels[:n].count(labels[i])):
+        if start in seen:
+            continue
+        seen.add(start)
+        queue = [start]
+        while queue:
+            i = queue.pop(0)
+            order.append(i)
+            for j in sorted(neighbors[i]):
+                if j not in seen:
+                    seen.add(j)
+                    queue.append(j)
+    candidates = {}
+    for j in range(n, 2 * n):
+        candidates.setdefault(labels[j], []).append(j)
+    mapping = {}
+    used = set()
+    steps = [0]
+
+    def extend(depth):
+        if depth == n:
+            return True
+        steps[0] += 1
+        if steps[0] > max_steps:
+            return False
+        i = order[depth]
+        for j in candidates[labels[i]]:
+            if j in used or any((k in neighbors[i]) != (mapped in
+                neighbors[j]) for k,mapped in mapping.items()):
+                continue
+            mapping[i] = j
+            used.add(j)
+            if extend(depth + 1):
+                return True
+            del mapping[i]
+            used.discard(j)
+        return False
+
+    return extend(0)
+
+def same_molecule(mol, mol2):
+    '''
+    Return whether the molecule in a parameter mol2 has the same elements
+    and bonds as mol, and, if their atom names are the same, the same bonds
+    between the same names
+    '''
+    names, elements, bonds = bond_graph(mol)
+    mol2_names, mol2_elements, mol2_bonds = util.get_mol2_graph(mol2)
+    if not isomorphic((elements, bonds), (mol2_elements, mol2_bonds)):
+        return False
+    if sorted(names) == sorted(mol2_names):
+        return isomorphic(([element + ':' + name for element,name in
+            zip(elements, names)], bonds), ([element + ':' + name for
+                element,name in zip(mol2_elements, mol2_names)], mol2_bonds))
+    #atom names differ; match_atomname renames the ligand's to the mol2's
+    return True
+
+class ParamCache:
+    '''
+    Size-bounded on-disk cache of ligand parameter files.
+
+    Attributes:
+        cache_dir: Directory holding one subdirectory per entry.
+
+        max_size: Total size in bytes above which old entries are evicted.
+    '''
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = cache_dir or default_cache_dir
+        self.max_size = default_max_size if max_size is None else max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, mol, net_charge, ff, molname, version):
+        '''
+        Return the cache key for parametrizing mol as unit molname with the
+        given net charge, force field list and AmberTools version
+        '''
+        record = {'topology': topology_hash(mol), 'net_charge':
+                str(net_charge), 'ff': [os.path.basename(name) for name in ff],
+                'molname': molname, 'version': version}
+        return hashlib.sha256(json.dumps(record,
+            sort_keys=True).encode()).hexdigest()
+
+    def slots(self, key):
+        '''
+        Yield the entry paths for key: the first molecule stored under it
+        gets the key itself, any others whose topology hash collides with it
+        get numbered entries after it
+        '''
+        for slot in itertools.count():
+            yield os.path.join(self.cache_dir, key if not slot else '%s-%d' %
+                    (key, slot))
+
+    def matches(self, entry, mol):
+        '''
+        Return the entry's files (kind -> name) if it's complete and its
+        mol2, if any, matches mol (see same_molecule), otherwise None. Raises
+        OSError if there's no such entry
+        '''
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            files = json.load(f)['files']
+        if mol is not None and 'mol2' in files and not same_molecule(mol,
+                os.path.join(entry, files['mol2'])):
+            return None
+        return files
+
+    def fetch(self, key, outputs, mol=None):
+        '''
+        Copy the cached files for key to the paths in outputs, a dict mapping
+        each kind of file (e.g. 'mol2') to where it should go. If mol is
+        given, only an entry whose mol2 matches it is used. Returns False,
+        copying nothing, on a miss
+        '''
+        for entry in self.slots(key):
+            try:
+                files = self.matches(entry, mol)
+                if files is None:
+                    continue
+                if not set(outputs).issubset(files):
+                    return False
+                for kind,dest in outputs.items():
+                    shutil.copyfile(os.path.join(entry, files[kind]), dest)
+                #mark as recently used
+                os.utime(entry)
+            except (OSError, ValueError, KeyError):
+                #missing, or evicted by another process mid-copy
+                return False
+            return True
+
+    def store(self, key, outputs, mol=None):
+        '''
+        Add the files in outputs (kind -> path) to the cache under key, in
+        the first of its slots that's free, unless one already holds mol. The
+        entry is assembled in a scratch directory and renamed into place, so
+        concurrent runs never see a partial entry
+        '''
+        scratch = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        files = {}
+        for kind,path in outputs.items():
+            files[kind] = kind + os.path.splitext(path)[-1]
+            shutil.copyfile(path, os.path.join(scratch, files[kind]))
+        with open(os.path.join(scratch, 'meta.json'), 'w') as f:
+            json.dump({'files': files, 'created': time.time()}, f)
+        for entry in self.slots(key):
+            try:
+                os.rename(scratch, entry)
+                break
+            except OSError:
+                pass
+            #taken, maybe by someone else storing the same molecule first
+            try:
+                if self.matches(entry, mol) is not None:
+                    break
+            except (OSError, ValueError, KeyError):
+                #evicted or still being replaced; try the next one
+                pass
+        shutil.rmtree(scratch, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        '''
+        Return (last use, size in bytes, path) for every entry
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, fname)) for fname
+                        in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                pass
+        return entries
+
+    def evict(self):
+        '''
+        Delete least recently used entries until the cache fits in max_size
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
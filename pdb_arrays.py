@@ -0,0 +1,934 @@
+#!/usr/bin/python
+import collections
+import collections.abc
+import itertools
+import mmap
+import numpy as np
+import os
+import pdb_util as util
+
+#Columnar (NumPy) storage for simplepdb. Coordinates live in one contiguous
+#(N,3) float64 array, string fields are fixed-width byte-string arrays and
+#integer/float fields are numeric arrays. Blank integer fields are stored as
+#INT_BLANK and blank float fields as NaN, so that the list view can hand them
+#back as '' exactly like the list-based parser does.
+
+INT_BLANK = np.iinfo(np.int64).min
+coord_fields = ('x', 'y', 'z')
+int_fields = tuple(util.pdb_fieldnames[i] for i in util.pdb_intfields)
+float_fields = tuple(util.pdb_fieldnames[i] for i in util.pdb_floatfields
+        if util.pdb_fieldnames[i] not in coord_fields)
+str_fields = tuple(name for name in util.pdb_fieldnames if name not in
+        coord_fields + int_fields + float_fields)
+#width of each field per the PDB spec, used as the initial width of the
+#byte-string columns
+field_widths = dict(zip(util.pdb_fieldnames, [fw for fw in
+    util.pdb_fieldwidths if fw > 0]))
+
+def field_slices(fieldwidths):
+    '''
+    Return (start, end) columns for the non-padding fields of a fixed-width
+    layout, the bulk equivalent of pdb_util.make_parser
+    '''
+    cuts = (0,) + tuple(util.accumulate(abs(fw) for fw in fieldwidths))
+    return [(cuts[i], cuts[i+1]) for i,fw in enumerate(fieldwidths) if fw > 0]
+
+atom_slices = dict(zip(util.pdb_fieldnames, field_slices(util.pdb_fieldwidths)))
+connect_slices = field_slices(util.pdb_connectfields)
+
+def to_array(field, values):
+    '''
+    Convert a list of Python values for a PDB field to the corresponding
+    column array; blank entries ('') become INT_BLANK or NaN for numeric fields
+    '''
+    if isinstance(values, ColumnView):
+        return values.array().copy()
+    if isinstance(values, np.ndarray):
+        if field in str_fields:
+            if values.dtype.kind != 'S':
+                return np.char.encode(values.astype(str), 'latin-1')
+            return values
+        if field in int_fields:
+            return values.astype(np.int64, copy=False)
+        return values.astype(np.float64, copy=False)
+    values = list(values)
+    if field in str_fields:
+        if not values:
+            return np.zeros(0, dtype='S%d' % field_widths[field])
+        return np.array([str(v).encode('latin-1') for v in values],
+                dtype='S')
+    if field in int_fields:
+        return np.array([v if str(v).strip() else INT_BLANK for v in values],
+                dtype=np.int64)
+    return np.array([v if str(v).strip() else np.nan for v in values],
+            dtype=np.float64)
+
+def to_list(field, arr):
+    '''
+    Convert a column array back to the list of Python values that the
+    list-based parser would have produced
+    '''
+    if field in str_fields:
+        return arr.astype(str).tolist()
+    values = arr.tolist()
+    if field in int_fields:
+        blank = arr == INT_BLANK
+    else:
+        blank = np.isnan(arr)
+    if blank.any():
+        for i in np.flatnonzero(blank):
+            values[i] = ''
+    return values
+
+def to_value(field, value):
+    '''
+    Convert a single column entry to its list-based equivalent
+    '''
+    if field in str_fields:
+        return value.decode('latin-1')
+    if field in int_fields:
+        return '' if value == INT_BLANK else int(value)
+    return '' if np.isnan(value) else float(value)
+
+class ColumnView(collections.abc.Sequence):
+    '''
+    List-like view of one column of an ArrayData; reads convert entries to
+    the same Python values the list-based storage holds and item assignment
+    writes through to the underlying array
+    '''
+    def __init__(self, data, field):
+        self.data = data
+        self.field = field
+
+    def array(self):
+        return self.data.array(self.field)
+
+    def __len__(self):
+        return len(self.array())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return to_list(self.field, self.array()[i])
+        return to_value(self.field, self.array()[i])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = to_array(self.field, value)
+        else:
+            value = to_array(self.field, [value])[0]
+        arr = self.array()
+        if arr.dtype.kind == 'S' and np.asarray(value).dtype.itemsize > arr.dtype.itemsize:
+            #widen the column rather than silently truncating the new value
+            self.data[self.field] = arr.astype(np.asarray(value).dtype)
+            arr = self.array()
+        arr[i] = value
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Sequence) and not isinstance(other, str):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def tolist(self):
+        return to_list(self.field, self.array())
+
+class ArrayData(collections.abc.MutableMapping):
+    '''
+    Dictionary-like columnar storage for the contents of a PDB file, with the
+    same keys as the list-based mol_data. Indexing by field name returns a
+    ColumnView, so code written against the list API keeps working; the raw
+    arrays are available through array() and coords.
+
+    Attributes:
+        coords: (N,3) contiguous float64 array of atom coordinates.
+
+        columns: Dictionary mapping the remaining PDB field names to arrays.
+    '''
+    def __init__(self, columns, coords):
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(-1, 3)
+        self.columns = {}
+        for field in util.pdb_fieldnames:
+            if field not in coord_fields:
+                self.columns[field] = to_array(field, columns[field])
+                assert len(self.columns[field]) == len(self.coords), \
+                'Column %s has the wrong number of entries\n' % field
+
+    @classmethod
+    def from_lists(cls, mol_data):
+        '''
+        Build columnar storage from a list-based mol_data dictionary
+        '''
+        coords = np.column_stack([np.asarray(mol_data[field], dtype=np.float64)
+            for field in coord_fields]) if len(mol_data['x']) else np.zeros((0,3))
+        return cls(mol_data, coords)
+
+    def to_lists(self):
+        '''
+        Return the equivalent list-based mol_data dictionary
+        '''
+        return {field: to_list(field, self.array(field)) for field in
+                util.pdb_fieldnames}
+
+    def array(self, field):
+        '''
+        Return the array backing field; x, y and z are views into coords
+        '''
+        if field in coord_fields:
+            return self.coords[:, coord_fields.index(field)]
+        return self.columns[field]
+
+    def take(self, indices):
+        '''
+        Return a new ArrayData holding the atoms at indices (or a boolean mask)
+        in the given order
+        '''
+        return ArrayData({field: arr[indices] for field,arr in
+            self.columns.items()}, self.coords[indices])
+
+    def extend(self, other):
+        '''
+        Append the atoms in other, which may be another ArrayData or a
+        list-based mol_data dictionary
+        '''
+        if not isinstance(other, ArrayData):
+            other = ArrayData.from_lists(other)
+        for field,arr in self.columns.items():
+            self.columns[field] = np.concatenate((arr, other.columns[field]))
+        self.coords = np.concatenate((self.coords, other.coords))
+
+    def matches(self, field, value, indices=None):
+        '''
+        Return a boolean mask of the atoms (or just those at indices) whose
+        field equals value
+        '''
+        arr = self.array(field)
+        if indices is not None:
+            arr = arr[indices]
+        if field in str_fields:
+            return arr == str(value).encode('latin-1')
+        if value == '':
+            return arr == INT_BLANK if field in int_fields else np.isnan(arr)
+        return arr == value
+
+    def unique(self, field):
+        '''
+        Return the distinct values of field as Python values
+        '''
+        return to_list(field, np.unique(self.array(field)))
+
+    def __getitem__(self, field):
+        if field not in util.pdb_fieldnames:
+            raise KeyError(field)
+        return ColumnView(self, field)
+
+    def __setitem__(self, field, values):
+        if field not in util.pdb_fieldnames:
+            raise KeyError(field)
+        arr = to_array(field, values)
+        assert len(arr) == self.natoms, 'Column %s has the wrong number of entries\n' % field
+        if field in coord_fields:
+            self.coords[:, coord_fields.index(field)] = arr
+        else:
+            self.columns[field] = arr
+
+    def __delitem__(self, field):
+        raise TypeError('PDB columns cannot be removed')
+
+    def __iter__(self):
+        return iter(util.pdb_fieldnames)
+
+    def __len__(self):
+        return len(util.pdb_fieldnames)
+
+    @property
+    def natoms(self):
+        return len(self.coords)
+
+class ConnectGraph(collections.abc.Mapping):
+    '''
+    CONECT records held as a compressed sparse row (CSR) adjacency array.
+    Behaves like the read-only dictionary of the list-based parser, mapping
+    each atom number that has CONECT records to the list of atom numbers it
+    is bonded to, in record order; changes go through methods that return a
+    new graph.
+
+    Attributes:
+        atoms: Atom numbers with CONECT records, in the order first seen.
+
+        indptr: Offsets such that the bonds of atoms[i] are
+        bonds[indptr[i]:indptr[i+1]].
+
+        bonds: Bonded atom numbers for all records, concatenated.
+    '''
+    def __init__(self, atoms=(), indptr=(0,), bonds=()):
+        self.atoms = np.asarray(atoms, dtype=np.int64).reshape(-1)
+        self.indptr = np.asarray(indptr, dtype=np.int64).reshape(-1)
+        self.bonds = np.asarray(bonds, dtype=np.int64).reshape(-1)
+        assert len(self.indptr) == len(self.atoms) + 1 and self.indptr[-1] == \
+        len(self.bonds), 'Inconsistent CONECT adjacency arrays\n'
+        self.rows = None
+        self.symmetric = None
+
+    @classmethod
+    def from_dict(cls, connect):
+        '''
+        Build a graph from a dictionary mapping atom numbers to bonded atoms
+        '''
+        if isinstance(connect, ConnectGraph):
+            return connect
+        counts = [len(bonds) for bonds in connect.values()]
+        return cls(list(connect.keys()), np.r_[0, np.cumsum(counts,
+            dtype=np.int64)], list(itertools.chain.from_iterable(
+                connect.values())))
+
+    @classmethod
+    def from_pairs(cls, atoms, bonds, keys=None):
+        '''
+        Build a graph from parallel arrays of atom numbers and the atoms
+        bonded to them, merging the pairs of each atom in the order given.
+        Rows follow the first occurrence of each atom in keys (which may list
+        atoms that have no bonds), or in atoms if keys isn't given.
+        '''
+        atoms = np.asarray(atoms, dtype=np.int64).reshape(-1)
+        bonds = np.asarray(bonds, dtype=np.int64).reshape(-1)
+        keys = atoms if keys is None else np.asarray(keys,
+                dtype=np.int64).reshape(-1)
+        unique,first = np.unique(keys, return_index=True)
+        pos = np.searchsorted(unique, atoms)
+        assert (unique[np.minimum(pos, len(unique)-1)] == atoms).all() if \
+        len(atoms) else True, 'Bonded atom missing from keys\n'
+        rank = np.argsort(np.argsort(first))
+        rows = rank[pos] if len(atoms) else np.zeros(0, dtype=np.int64)
+        counts = np.bincount(rows, minlength=len(unique))
+        return cls(keys[np.sort(first)], np.r_[0, np.cumsum(counts)],
+                bonds[np.argsort(rows, kind='stable')])
+
+    def row(self, atom):
+        '''
+        Return the row of atom, or None if it has no CONECT records
+        '''
+        if self.rows is None:
+            self.rows = dict(zip(self.atoms.tolist(), range(len(self.atoms))))
+        return self.rows.get(atom)
+
+    def __getitem__(self, atom):
+        row = self.row(atom)
+        if row is None:
+            raise KeyError(atom)
+        return self.bonds[self.indptr[row]:self.indptr[row+1]].tolist()
+
+    def __iter__(self):
+        return iter(self.atoms.tolist())
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def __repr__(self):
+        return 'ConnectGraph(%r)' % dict(self.items())
+
+    def pairs(self):
+        '''
+        Return the (atom, bonded atom) pairs of every record as two arrays
+        '''
+        return np.repeat(self.atoms, np.diff(self.indptr)), self.bonds
+
+    def neighbors(self, atom):
+        '''
+        Return the sorted atom numbers bonded to atom, counting bonds recorded
+        in either direction
+        '''
+        if self.symmetric is None:
+            atoms,bonds = self.pairs()
+            src,dst = np.r_[atoms, bonds], np.r_[bonds, atoms]
+            order = np.lexsort((dst, src))
+            src,dst = src[order],dst[order]
+            distinct = np.r_[True, (src[1:] != src[:-1]) |
+                    (dst[1:] != dst[:-1])][:len(src)]
+            src,dst = src[distinct],dst[distinct]
+            nodes,starts = np.unique(src, return_index=True)
+            self.symmetric = (nodes, np.r_[starts, len(src)], dst)
+        nodes,indptr,bonds = self.symmetric
+        i = np.searchsorted(nodes, atom)
+        if i == len(nodes) or nodes[i] != atom:
+            return bonds[:0]
+        return bonds[indptr[i]:indptr[i+1]]
+
+    def renumber(self, old, new):
+        '''
+        Return a new graph with atom numbers old[i] replaced by new[i] via a
+        lookup array. Records for atoms not in old are dropped, while bonds to
+        them keep their original numbers.
+        '''
+        old = np.asarray(old, dtype=np.int64).reshape(-1)
+        new = np.asarray(new, dtype=np.int64).reshape(-1)
+        valid = old >= 0
+        old,new = old[valid],new[valid]
+        size = max([0] + [arr.max() + 1 for arr in (old, self.atoms,
+            self.bonds) if len(arr)])
+        lookup = np.arange(size, dtype=np.int64)
+        lookup[old] = new
+        found = np.zeros(size, dtype=bool)
+        found[old] = True
+        #negative (blank) numbers are never in the lookup
+        keep = found[np.maximum(self.atoms, 0)] & (self.atoms >= 0)
+        counts = np.diff(self.indptr)[keep]
+        bonds = self.bonds[np.repeat(keep, np.diff(self.indptr))]
+        bonds = np.where(bonds >= 0, lookup[np.maximum(bonds, 0)], bonds)
+        return ConnectGraph(lookup[self.atoms[keep]], np.r_[0,
+            np.cumsum(counts)], bonds)
+
+    def subgraph(self, atoms):
+        '''
+        Return a new graph restricted to bonds between the given atom numbers,
+        dropping records left without bonds
+        '''
+        atoms = np.asarray(atoms, dtype=np.int64).reshape(-1)
+        row_atoms,bonds = self.pairs()
+        keep = np.isin(row_atoms, atoms) & np.isin(bonds, atoms)
+        return ConnectGraph.from_pairs(row_atoms[keep], bonds[keep])
+
+#records are padded/truncated to this many characters before slicing
+record_width = 80
+
+class Records:
+    '''
+    Fixed-width view of a set of PDB lines: every line is padded with NUL
+    bytes (which byte-string arrays drop) or truncated to record_width
+    characters and stored as one row of a uint8 matrix, so a field is a
+    column slice of that matrix for all records at once.
+
+    Attributes:
+        lines: (N, record_width) uint8 array, one row per line.
+    '''
+    def __init__(self, lines):
+        self.lines = lines
+
+    @classmethod
+    def from_lines(cls, lines):
+        '''
+        Build Records from a list of bytes objects, one per line
+        '''
+        lines = np.array(lines, dtype='S%d' % record_width)
+        return cls(lines.view(np.uint8).reshape(-1, record_width))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def select(self, rows):
+        '''
+        Return the records at rows (indices or a boolean mask)
+        '''
+        return Records(self.lines[rows])
+
+    def block(self, start, end):
+        '''
+        Return columns start:end of every record as a contiguous (N,
+        end-start) uint8 block
+        '''
+        return np.ascontiguousarray(self.lines[:, start:end])
+
+    def strings(self, start, end):
+        '''
+        Return columns start:end of every record as a stripped byte-string
+        array
+        '''
+        col = self.block(start, end).view('S%d' % (end-start)).ravel()
+        return np.char.strip(col)
+
+    def prefixes(self):
+        '''
+        Return the record name (first six characters) of every line
+        '''
+        return self.strings(0, 6)
+
+    def numbers(self, start, end, dtype):
+        '''
+        Return columns start:end of every record parsed as numbers of dtype
+        '''
+        return parse_numbers(self.block(start, end).T, dtype)
+
+class MappedRecords:
+    '''
+    Lines of a memory-mapped PDB file, held only as an index of line offsets
+    into the mapping. Has the same interface as Records, but a field is read
+    by gathering just its bytes from each selected line, so columns that are
+    never asked for are never read or decoded.
+
+    Attributes:
+        buf: uint8 array over the memory-mapped file.
+
+        starts, lengths: Offset of the first character of each line and its
+        length, excluding the line terminator.
+    '''
+    #lines are located in chunks of this many bytes to bound temporary memory
+    chunk_size = 1 << 26
+
+    def __init__(self, buf, starts, lengths):
+        self.buf = buf
+        self.starts = starts
+        self.lengths = lengths
+
+    @classmethod
+    def from_file(cls, pdb):
+        '''
+        Memory-map a PDB file and index the offsets of its lines
+        '''
+        with open(pdb, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                buf = np.zeros(0, dtype=np.uint8)
+            else:
+                buf = np.frombuffer(mmap.mmap(f.fileno(), 0,
+                    access=mmap.ACCESS_READ), dtype=np.uint8)
+        ends = [np.flatnonzero(buf[i:i+cls.chunk_size] == ord('\n')) + i for
+                i in range(0, len(buf), cls.chunk_size)]
+        ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+        if len(buf) and buf[-1] != ord('\n'):
+            ends = np.append(ends, len(buf))
+        starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) else ends
+        if len(buf):
+            #drop the carriage return of DOS line endings
+            ends = ends - ((ends > starts) & (buf[np.maximum(ends - 1, 0)] == ord('\r')))
+        return cls(buf, starts, ends - starts)
+
+    def __deepcopy__(self, memo):
+        #the mapping is read-only, so copies can share it
+        return MappedRecords(self.buf, self.starts.copy(), self.lengths.copy())
+
+    def __len__(self):
+        return len(self.starts)
+
+    def select(self, rows):
+        '''
+        Return the records at rows (indices or a boolean mask)
+        '''
+        return MappedRecords(self.buf, self.starts[rows], self.lengths[rows])
+
+    def chars(self, start, end):
+        '''
+        Return columns start:end of every record as an (end-start, N) uint8
+        block, one character position per row, with NULs past the end of
+        short lines
+        '''
+        chars = np.zeros((end-start, len(self)), dtype=np.uint8)
+        for i,col in enumerate(range(start, end)):
+            inside = self.lengths > col
+            if inside.all():
+                np.take(self.buf, self.starts + col, out=chars[i])
+            else:
+                chars[i][inside] = self.buf[self.starts[inside] + col]
+        return chars
+
+    def strings(self, start, end):
+        '''
+        Return columns start:end of every record as a stripped byte-string
+        array
+        '''
+        col = np.ascontiguousarray(self.chars(start, end).T)
+        return np.char.strip(col.view('S%d' % (end-start)).ravel())
+
+    def prefixes(self):
+        '''
+        Return the record name (first six characters) of every line
+        '''
+        return self.strings(0, 6)
+
+    def numbers(self, start, end, dtype):
+        '''
+        Return columns start:end of every record parsed as numbers of dtype
+        '''
+        return parse_numbers(self.chars(start, end), dtype)
+
+def read_records(pdb):
+    '''
+    Read a PDB file as bytes and return its Records
+    '''
+    with open(pdb, 'rb') as f:
+        return Records.from_lines(f.read().splitlines())
+
+#classification of bytes in numeric fields: digit, blank, '.', '-', other
+char_class = np.full(256, 4, dtype=np.uint8)
+char_class[ord('0'):ord('9')+1] = 0
+char_class[[0, ord(' ')]] = 1
+char_class[ord('.')] = 2
+char_class[ord('-')] = 3
+
+def parse_numbers(chars, dtype):
+    '''
+    Convert a (width, N) uint8 block of fixed-width decimal numbers, stored one
+    character position per row, to an array of dtype with blank entries set to
+    INT_BLANK or NaN. Digits are accumulated column by column as an exact
+    integer and divided by a power of ten, which rounds exactly like float();
+    anything else (exponents, junk) falls back to Python's own conversion for
+    just those entries.
+    '''
+    nrecords = chars.shape[1]
+    mantissa = np.zeros(nrecords, dtype=np.int64)
+    ndigits = np.zeros(nrecords, dtype=np.int8)
+    decimals = np.zeros(nrecords, dtype=np.int8)
+    npoints = np.zeros(nrecords, dtype=np.int8)
+    nminus = np.zeros(nrecords, dtype=np.int8)
+    unknown = np.zeros(nrecords, dtype=bool)
+    for char in chars:
+        kind = char_class[char]
+        is_digit = kind == 0
+        np.multiply(mantissa, 10, out=mantissa, where=is_digit)
+        np.add(mantissa, char - np.uint8(ord('0')), out=mantissa, where=is_digit)
+        ndigits += is_digit
+        decimals += is_digit & (npoints > 0)
+        npoints += kind == 2
+        nminus += kind == 3
+        unknown |= kind == 4
+    unknown |= nminus > 1
+    if dtype == np.int64:
+        values = np.where(nminus > 0, -mantissa, mantissa)
+        blank_value = INT_BLANK
+        convert = int
+        unknown |= npoints > 0
+    else:
+        values = mantissa / 10.0**decimals
+        values[nminus > 0] *= -1
+        blank_value = np.nan
+        convert = float
+        unknown |= npoints > 1
+    values[ndigits == 0] = blank_value
+    for i in np.flatnonzero(unknown):
+        text = chars[:, i].tobytes().strip(b' \0')
+        values[i] = convert(text) if text else blank_value
+    return values
+
+def parse_atoms(records):
+    '''
+    Return an ArrayData for the fields of ATOM/HETATM records
+    '''
+    columns = {}
+    for field in util.pdb_fieldnames:
+        columns[field] = parse_field(records, field)
+    coords = np.column_stack([columns.pop(field) for field in coord_fields]) \
+            if len(records) else np.zeros((0,3))
+    return ArrayData(columns, coords)
+
+def parse_field(records, field):
+    '''
+    Return the column array for one field of ATOM/HETATM records
+    '''
+    start,end = atom_slices[field]
+    if field in int_fields:
+        return records.numbers(start, end, np.int64)
+    elif field in float_fields or field in coord_fields:
+        return records.numbers(start, end, np.float64)
+    return records.strings(start, end)
+
+def parse_ters(atoms, atom_rows, ter_rows):
+    '''
+    Return the residue (number plus insertion code) preceding each TER record,
+    plus the last residue in the file if it doesn't already end in a TER;
+    atom_rows and ter_rows are the line numbers of the ATOM/HETATM records in
+    atoms and of the TER records
+    '''
+    #this includes the insertion code, if applicable, so the ters have to be
+    #strings rather than ints
+    positions = np.searchsorted(atom_rows, ter_rows) - 1
+    if len(atoms):
+        positions = np.append(positions, len(atoms) - 1)
+    resids = atoms.select(positions).strings(22, 27).astype(str).tolist()
+    ters = [resid if pos >= 0 else '' for resid,pos in zip(resids, positions)]
+    if len(atoms):
+        ter = ters.pop()
+        if ter and not ter in ters:
+            ters.append(ter)
+    return ters
+
+def parse_connect(records):
+    '''
+    Return a ConnectGraph for CONECT records, merging repeated records for
+    the same atom
+    '''
+    if not len(records):
+        return ConnectGraph()
+    fields = np.column_stack([records.numbers(start, end, np.int64) for
+        start,end in connect_slices[1:]])
+    bonded = fields[:,1:] != INT_BLANK
+    return ConnectGraph.from_pairs(np.repeat(fields[:,0], bonded.sum(axis=1)),
+            fields[:,1:][bonded], fields[:,0])
+
+def parse_pdb(pdb, lazy=False):
+    '''
+    Parse a PDB file in a single pass, returning an ArrayData for its
+    ATOM/HETATM records, its list of TERs and its CONECT records. If lazy,
+    the file is memory-mapped and a LazyArrayData is returned instead, which
+    decodes each column the first time it is used.
+    '''
+    records = MappedRecords.from_file(pdb) if lazy else read_records(pdb)
+    prefixes = records.prefixes()
+    #for a multi-model file only the atoms of the first MODEL are read; use
+    #iter_models to get at the rest
+    in_model = np.arange(len(prefixes)) < first_model_end(prefixes)
+    atom_rows = np.flatnonzero((np.char.startswith(prefixes, b'ATOM') |
+            np.char.startswith(prefixes, b'HETATM')) & in_model)
+    atoms = records.select(atom_rows)
+    ters = parse_ters(atoms, atom_rows,
+            np.flatnonzero(np.char.startswith(prefixes, b'TER') & in_model))
+    connect = parse_connect(records.select(np.char.startswith(prefixes,
+        b'CONECT')))
+    if lazy:
+        return LazyArrayData(atoms), ters, connect
+    return parse_atoms(atoms), ters, connect
+
+def first_model_end(prefixes):
+    '''
+    Return the row of the first ENDMDL record, or the number of records if
+    there isn't one
+    '''
+    ends = np.flatnonzero(np.char.startswith(prefixes, b'ENDMDL'))
+    return ends[0] if len(ends) else len(prefixes)
+
+def iter_model_records(pdb):
+    '''
+    Generate Records for the ATOM/HETATM and TER lines of each MODEL in a PDB
+    file, reading it line by line so that only one model is held in memory at
+    a time. A file without MODEL records is a single model.
+    '''
+    lines = []
+    in_model = False
+    seen_model = False
+    with open(pdb, 'rb') as f:
+        for line in f:
+            if line.startswith((b'ATOM', b'HETATM', b'TER')):
+                if in_model or not seen_model:
+                    lines.append(line.rstrip(b'\r\n'))
+            elif line.startswith(b'MODEL'):
+                in_model = seen_model = True
+                lines = []
+            elif line.startswith(b'ENDMDL'):
+                yield Records.from_lines(lines)
+                in_model = False
+                lines = []
+    if lines:
+        yield Records.from_lines(lines)
+
+def parse_coords(records):
+    '''
+    Return the (N,3) coordinates of ATOM/HETATM records
+    '''
+    if not len(records):
+        return np.zeros((0,3))
+    return np.column_stack([parse_field(records, field) for field in
+        coord_fields])
+
+def iter_models(pdb):
+    '''
+    Generate (mol_data, ters, connect) for each MODEL of a multi-model (NMR
+    ensemble or trajectory) PDB file. The topology is parsed from the first
+    model only; every later ArrayData shares its column arrays and just gets
+    its own coordinates, so memory use doesn't grow with the number of models.
+    The CONECT records are collected up front since they usually follow the
+    last model.
+    '''
+    with open(pdb, 'rb') as f:
+        conect = [line.rstrip(b'\r\n') for line in f if
+                line.startswith(b'CONECT')]
+    connect = parse_connect(Records.from_lines(conect))
+    topology = None
+    for records in iter_model_records(pdb):
+        prefixes = records.prefixes()
+        atom_rows = np.flatnonzero(~np.char.startswith(prefixes, b'TER'))
+        atoms = records.select(atom_rows)
+        if topology is None:
+            topology = parse_atoms(atoms)
+            ters = parse_ters(atoms, atom_rows,
+                    np.flatnonzero(np.char.startswith(prefixes, b'TER')))
+            yield topology, ters, connect
+            continue
+        assert len(atoms) == topology.natoms, 'Model has %d atoms but the \
+first model has %d\n' % (len(atoms), topology.natoms)
+        yield ArrayData(dict(topology.columns), parse_coords(atoms)), ters, \
+                connect
+
+class LazyArrayData(ArrayData):
+    '''
+    ArrayData for the ATOM/HETATM records of a memory-mapped file that only
+    decodes a column (or the coordinates) on first access. Selecting atoms
+    with take() stays lazy, so e.g. pulling one residue out of a large file
+    only ever decodes that residue's lines. Anything that changes the number
+    of atoms decodes all columns first and detaches from the file.
+
+    Attributes:
+        records: MappedRecords for the atoms, or None once fully decoded.
+    '''
+    def __init__(self, records):
+        self.records = records
+        self.columns = {}
+        self._coords = None
+
+    @property
+    def coords(self):
+        if self._coords is None:
+            self._coords = np.column_stack([parse_field(self.records, field)
+                for field in coord_fields]) if len(self.records) else np.zeros((0,3))
+        return self._coords
+
+    @coords.setter
+    def coords(self, coords):
+        self._coords = coords
+
+    @property
+    def natoms(self):
+        if self.records is None:
+            return len(self._coords)
+        return len(self.records)
+
+    def is_decoded(self, field):
+        '''
+        Returns true if field has already been read from the file
+        '''
+        if field in coord_fields:
+            return self._coords is not None
+        return field in self.columns
+
+    def array(self, field):
+        if field not in coord_fields and field not in self.columns:
+            self.columns[field] = parse_field(self.records, field)
+        return super().array(field)
+
+    def materialize(self):
+        '''
+        Decode every column and detach from the underlying file
+        '''
+        if self.records is not None:
+            for field in util.pdb_fieldnames:
+                self.array(field)
+            self.records = None
+
+    def take(self, indices):
+        if self.records is None:
+            return super().take(indices)
+        data = LazyArrayData(self.records.select(indices))
+        data.columns = {field: arr[indices] for field,arr in self.columns.items()}
+        if self._coords is not None:
+            data._coords = self._coords[indices]
+        return data
+
+    def extend(self, other):
+        self.materialize()
+        super().extend(other)
+
+def format_fixed(values, decimals, width):
+    '''
+    Format floats like '{:.<decimals>f}' right-justified in width columns,
+    returning a byte-string array. Values are rounded as exact scaled
+    integers and their digits written into a fixed-width block; entries too
+    close to a rounding tie to be sure of the result, entries too wide for
+    the column, and NaNs (blank fields) are formatted by Python instead.
+    '''
+    nvalues = len(values)
+    block = np.full((nvalues, width), ord(' '), dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        scaled = np.abs(values) * 10.0**decimals
+        exact = (scaled < 1e9) & (np.abs(scaled - np.floor(scaled) - 0.5) > 1e-6)
+    ints = np.round(np.where(exact, scaled, 0)).astype(np.int64)
+    for col in range(width-1, width-1-decimals, -1):
+        block[:, col] = ord('0') + ints % 10
+        ints //= 10
+    block[:, width-1-decimals] = ord('.')
+    #integer part has at least one digit; keep writing while any remain
+    ndigits = np.zeros(nvalues, dtype=np.int64)
+    writing = np.ones(nvalues, dtype=bool)
+    for col in range(width-2-decimals, -1, -1):
+        block[writing, col] = ord('0') + ints[writing] % 10
+        ndigits += writing
+        ints //= 10
+        writing = ints > 0
+        if not writing.any():
+            break
+    negative = np.signbit(values)
+    signcol = width - 2 - decimals - ndigits
+    exact &= ~writing & ~(negative & (signcol < 0))
+    rows = np.flatnonzero(negative & exact)
+    block[rows, signcol[rows]] = ord('-')
+    strings = block.view('S%d' % width).ravel()
+    inexact = np.flatnonzero(~exact)
+    if len(inexact):
+        texts = ['' if np.isnan(value) else '{:.{}f}'.format(value, decimals)
+                for value in values[inexact].tolist()]
+        strings = strings.astype('S%d' % max([width] + [len(t) for t in texts]))
+        strings[inexact] = ['{:>{}s}'.format(text, width).encode() for text in texts]
+    return strings
+
+def format_atoms(mol_data, ters):
+    '''
+    Return the ATOM/HETATM and TER lines for mol_data as bytes, formatting
+    each column for all atoms at once and concatenating the columns. Like
+    the PDB writer always has, values too wide for their column are written
+    in full rather than truncated.
+    '''
+    if not isinstance(mol_data, ArrayData):
+        mol_data = ArrayData.from_lists(mol_data)
+    if not mol_data.natoms:
+        return b''
+    lines = np.zeros(mol_data.natoms, dtype='S1')
+    fields = iter(util.pdb_fieldnames)
+    for fieldwidth in util.pdb_fieldwidths:
+        if fieldwidth < 0:
+            lines = np.char.add(lines, b' ' * abs(fieldwidth))
+            continue
+        field = next(fields)
+        values = mol_data.array(field)
+        if field in coord_fields:
+            column = format_fixed(values, 3, fieldwidth)
+        elif field in float_fields:
+            column = format_fixed(values, 2, fieldwidth)
+        elif field in int_fields:
+            column = np.char.rjust(int_strings(values), fieldwidth)
+        elif field == 'recordname':
+            column = np.char.ljust(values, fieldwidth)
+        else:
+            column = np.char.rjust(values, fieldwidth)
+        lines = np.char.add(lines, column)
+
+    #TER after the last atom and after any residue listed in ters that isn't
+    #continued by the next atom
+    resids = np.char.add(int_strings(mol_data.array('resnum')),
+            mol_data.array('rescode'))
+    ter_after = np.isin(resids, [ter.encode('latin-1') for ter in ters])
+    ter_after[:-1] &= resids[:-1] != resids[1:]
+    ter_after[-1] = True
+    lines = np.char.add(lines, np.where(ter_after, b'\nTER\n', b'\n'))
+    return b''.join(lines.tolist())
+
+def int_strings(values):
+    '''
+    Return integer column values as byte strings, with blanks as b''
+    '''
+    strings = values.astype('S')
+    strings[values == INT_BLANK] = b''
+    return strings
+
+def format_connect(connect):
+    '''
+    Return CONECT records as bytes, with at most four bonded atoms per line.
+    An atom without bonds gets an empty line, as it always has.
+    '''
+    connect = ConnectGraph.from_dict(connect)
+    if not len(connect):
+        return b''
+    counts = np.diff(connect.indptr)
+    nlines = np.maximum((counts + 3) // 4, 1)
+    rows = np.repeat(np.arange(len(counts)), nlines)
+    #position of each line within its record
+    line_idx = np.arange(len(rows)) - (np.cumsum(nlines) - nlines)[rows]
+    starts = connect.indptr[rows] + 4 * line_idx
+    ends = connect.indptr[rows + 1]
+    bonds = np.char.rjust(int_strings(np.r_[connect.bonds, 0]),
+            util.pdb_connectfields[2])
+    lines = np.char.add(b'CONECT', np.char.rjust(int_strings(
+        connect.atoms[rows]), util.pdb_connectfields[1]))
+    for i in range(4):
+        lines = np.char.add(lines, np.where(starts + i < ends,
+            bonds[np.minimum(starts + i, len(bonds) - 1)], b''))
+    lines[counts[rows] == 0] = b''
+    return b'\n'.join(lines.tolist()) + b'\n'
@@ -1,6 +1,8 @@
 #!/usr/bin/python
-import os, re, math
+import os, re, math, json, functools
+from copy import deepcopy
 from itertools import zip_longest
+import numpy as np
 
 #Basic utilities used by simplepdb or prepareamber that are generally useful and
 #not limited in their functionality to the simplepdb class
@@ -45,22 +47,6 @@ def is_bonded(dist, thresh=2.0):
     else:
         return False
 
-def walk_to_end(atom, atomdict, mytype):
-    '''
-    when you walk the adjacency list in atomdict, do you make it to the end?
-    '''
-    at_end = True
-    if atom[1] > 0:
-        atom_index = atom[1]
-        next_atom_type = atom[2]
-        at_end = walk_to_end(atomdict[next_atom_type][atom_index], atomdict,
-                next_atom_type)
-    elif mytype == "O" or mytype == "OXT":
-        return at_end
-    else:
-        at_end = False
-    return at_end
-
 def accumulate(iterable):
     '''
     Generate running sum from an iterator
@@ -87,10 +73,11 @@ def get_base(fname):
     '''
     return os.path.splitext(os.path.basename(fname))[0]
 
-def get_fname(fname):
+def get_fname(fname, reserve=False):
     '''
     Generate a filename that doesn't overwrite anything in the current
-    directory
+    directory. If reserve, the name is claimed by atomically creating an
+    empty file with it, so concurrent callers can't be handed the same name
     '''
     i = 0
     name = fname.split('_')
@@ -104,12 +91,17 @@ def get_fname(fname):
             fname = base + ext
         else:
             fname = base + str(i) + ext
-        if os.path.isfile(fname):
-            if i == 0:
-                base = base + '_'
-            i += 1
-        else:
-            return fname
+        if not os.path.isfile(fname):
+            if not reserve:
+                return fname
+            try:
+                os.close(os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return fname
+            except FileExistsError:
+                pass
+        if i == 0:
+            base = base + '_'
+        i += 1
 
 def get_molname(molname):
     '''
@@ -124,6 +116,68 @@ def get_molname(molname):
         molname = molname[:3-len(numstr)] + numstr
     return molname
 
+#Metadata parsed from force field files (the libs a leaprc loads, the units
+#and atoms a lib defines, ion masses) is memoized by file path, mtime and
+#size, so each file is only parsed again if it changes. If metadata_index
+#names a file (by default $PDB_UTIL_INDEX), the parsed metadata is kept there
+#too, so later runs don't parse anything either.
+metadata_index = os.environ.get('PDB_UTIL_INDEX', '')
+_index = None
+
+def _load_index():
+    global _index
+    if _index is None:
+        _index = {}
+        if metadata_index:
+            try:
+                with open(metadata_index, 'r') as f:
+                    _index = json.load(f)
+            except (OSError, ValueError):
+                pass
+    return _index
+
+def _save_index():
+    tmp = metadata_index + '.%d.tmp' %os.getpid()
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(_index, f)
+        os.replace(tmp, metadata_index)
+    except OSError:
+        pass
+
+def memoize_file(func):
+    '''
+    Memoize func(fname), which parses a file into JSON-serializable lists and
+    dicts, by the file's path, mtime and size. Callers get their own copy of
+    the result
+    '''
+    @functools.lru_cache(maxsize=256)
+    def cached(path, mtime, size):
+        index = _load_index()
+        key = func.__name__ + ':' + path
+        entry = index.get(key)
+        if entry and entry['mtime'] == mtime and entry['size'] == size:
+            return entry['value']
+        value = func(path)
+        if metadata_index:
+            index[key] = {'mtime': mtime, 'size': size, 'value': value}
+            _save_index()
+        return value
+
+    @functools.wraps(func)
+    def wrapper(fname):
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            #let func raise the usual error
+            return func(fname)
+        return deepcopy(cached(os.path.realpath(fname), stat.st_mtime_ns,
+            stat.st_size))
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+@memoize_file
 def get_libs(ff):
     '''
     Get the libs that will be loaded by a leaprc; force field should be
@@ -141,6 +195,222 @@ def get_libs(ff):
 
     return libs
 
+def get_coords(mol):
+    '''
+    Return the coordinates of a simplepdb (or anything array-like of shape
+    (N,3)) as an (N,3) float64 array
+    '''
+    if hasattr(mol, 'mol_data'):
+        mol_data = mol.mol_data
+        if hasattr(mol_data, 'coords'):
+            return mol_data.coords
+        return np.column_stack([np.asarray(mol_data[field], dtype=np.float64)
+            for field in ('x', 'y', 'z')]).reshape(-1, 3)
+    return np.asarray(mol, dtype=np.float64).reshape(-1, 3)
+
+class CellList:
+    '''
+    Spatial index for fixed-radius neighbor searches. Points are binned into
+    a uniform grid of cubic cells with the cutoff as edge length, so every
+    neighbor of a point within the cutoff lies in the 27 cells around it and
+    finding all close pairs takes time roughly linear in the number of
+    points.
+
+    Attributes:
+        coords: (N,3) array of point coordinates.
+
+        cutoff: Cell edge length, the largest radius that can be queried.
+
+        order: Point indices sorted by cell.
+
+        keys: Sorted linear cell index of each point in order.
+    '''
+    #the cell itself plus half of its 26 neighbors, so each pair of cells is
+    #visited once
+    half_shell = [(0,0,0)] + [(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k
+            in (-1,0,1) if (i,j,k) > (0,0,0)]
+
+    def __init__(self, coords, cutoff):
+        assert cutoff > 0, 'Cell list cutoff must be positive\n'
+        self.coords = get_coords(coords)
+        self.cutoff = float(cutoff)
+        if len(self.coords):
+            self.origin = self.coords.min(axis=0)
+            cells = np.floor((self.coords - self.origin) /
+                    self.cutoff).astype(np.int64)
+        else:
+            self.origin = np.zeros(3)
+            cells = np.zeros((0,3), dtype=np.int64)
+        #one empty layer on each side so neighbor cells never wrap around
+        self.shape = cells.max(axis=0) + 3 if len(cells) else np.ones(3,
+                dtype=np.int64)
+        keys = self.cell_keys(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.cells = cells[self.order]
+
+    def cell_keys(self, cells):
+        '''
+        Return linear indices for (M,3) integer cell coordinates
+        '''
+        cells = cells + 1
+        return (cells[:,0] * self.shape[1] + cells[:,1]) * self.shape[2] + \
+                cells[:,2]
+
+    def query(self, point, r=None):
+        '''
+        Return the sorted indices of all points within r (default: the
+        cutoff) of point
+        '''
+        r = self.cutoff if r is None else r
+        assert r <= self.cutoff, 'Query radius exceeds cell list cutoff\n'
+        point = np.asarray(point, dtype=np.float64).reshape(3)
+        cell = np.floor((point - self.origin) / self.cutoff).astype(np.int64)
+        offsets = np.array([(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k
+            in (-1,0,1)])
+        cells = cell + offsets
+        inside = ((cells >= -1) & (cells <= self.shape - 2)).all(axis=1)
+        keys = self.cell_keys(cells[inside])
+        lo = np.searchsorted(self.keys, keys, 'left')
+        hi = np.searchsorted(self.keys, keys, 'right')
+        candidates = self.order[np.concatenate([np.arange(l, h) for l,h in
+            zip(lo, hi)] + [np.zeros(0, dtype=np.int64)])]
+        d2 = ((self.coords[candidates] - point)**2).sum(axis=1)
+        return np.sort(candidates[d2 < r*r])
+
+    def pairs(self, r=None):
+        '''
+        Return an (M,2) array of all index pairs (i, j) with i < j whose points
+        are closer than r (default: the cutoff)
+        '''
+        r = self.cutoff if r is None else r
+        assert r <= self.cutoff, 'Query radius exceeds cell list cutoff\n'
+        found = [np.zeros((0,2), dtype=np.int64)]
+        npoints = len(self.keys)
+        for offset in self.half_shell:
+            keys = self.cell_keys(self.cells + offset)
+            lo = np.searchsorted(self.keys, keys, 'left')
+            hi = np.searchsorted(self.keys, keys, 'right')
+            if offset == (0,0,0):
+                #within a cell only look at points later in the order
+                lo = np.maximum(lo, np.arange(npoints) + 1)
+            counts = np.maximum(hi - lo, 0)
+            total = counts.sum()
+            if not total:
+                continue
+            first = np.repeat(np.arange(npoints), counts)
+            second = np.repeat(lo - (np.cumsum(counts) - counts), counts) + \
+                    np.arange(total)
+            i,j = self.order[first],self.order[second]
+            d2 = ((self.coords[i] - self.coords[j])**2).sum(axis=1)
+            close = d2 < r*r
+            found.append(np.column_stack((np.minimum(i[close], j[close]),
+                np.maximum(i[close], j[close]))))
+        return np.concatenate(found)
+
+#single-bond covalent radii in Angstroms (Cordero et al., Dalton Trans. 2008)
+covalent_radii = {'H': 0.31, 'Li': 1.28, 'B': 0.84, 'C': 0.76, 'N': 0.71,
+        'O': 0.66, 'F': 0.57, 'Na': 1.66, 'Mg': 1.41, 'Al': 1.21, 'Si': 1.11,
+        'P': 1.07, 'S': 1.05, 'Cl': 1.02, 'K': 2.03, 'Ca': 1.76, 'Mn': 1.39,
+        'Fe': 1.32, 'Co': 1.26, 'Ni': 1.24, 'Cu': 1.32, 'Zn': 1.22, 'Se': 1.20,
+        'Br': 1.20, 'I': 1.39, 'Hg': 1.32}
+#used for elements missing from the table
+default_radius = 1.5
+
+#usual number of bonds for neutral atoms of elements common in ligands
+standard_valences = {'H': 1, 'B': 3, 'C': 4, 'N': 3, 'O': 2, 'F': 1, 'Si': 4,
+        'P': 3, 'S': 2, 'Cl': 1, 'Se': 2, 'Br': 1, 'I': 1}
+
+def find_bonds(coords, elements, tolerance=0.45):
+    '''
+    Infer covalent bonds from interatomic distances, LEaP/Open Babel style:
+    two atoms are bonded if they are closer than the sum of their covalent
+    radii plus tolerance (but not implausibly close). Returns an (M,2) array
+    of bonded atom index pairs (i, j) with i < j, sorted.
+    '''
+    coords = get_coords(coords)
+    radii = np.array([covalent_radii.get(element, default_radius) for element
+        in elements], dtype=np.float64)
+    if not len(radii):
+        return np.zeros((0,2), dtype=np.int64)
+    cutoff = 2 * radii.max() + tolerance
+    pairs = CellList(coords, cutoff).pairs()
+    dist = np.sqrt(((coords[pairs[:,0]] - coords[pairs[:,1]])**2).sum(axis=1))
+    bonded = (dist < radii[pairs[:,0]] + radii[pairs[:,1]] + tolerance) & \
+            (dist > 0.4)
+    pairs = pairs[bonded]
+    return pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+
+def estimate_formal_charge(elements, neighbors):
+    '''
+    Estimate the net formal charge of a molecule with explicit hydrogens from
+    its elements and bond graph (neighbors[i] lists the atoms bonded to atom
+    i). Multiple bonds are placed greedily between atoms with unfilled
+    valence, then charges are assigned to what is left over, e.g. -1 for a
+    carboxylate or phosphate oxygen and +1 for a quaternary or iminium
+    nitrogen. Returns None if the result is ambiguous or the molecule has
+    elements this doesn't know about.
+    '''
+    charge = 0
+    degree = [len(bonded) for bonded in neighbors]
+    valences = []
+    need = []
+    for i,element in enumerate(elements):
+        if element not in standard_valences:
+            return None
+        valence = standard_valences[element]
+        if element == 'N' and degree[i] == 4:
+            valence = 4
+            charge += 1
+        elif element == 'N' and degree[i] == 3 and sum(elements[j] == 'O' and
+                degree[j] == 1 for j in neighbors[i]) > 1:
+            #nitro or nitrate
+            valence = 4
+            charge += 1
+        elif element == 'P' and degree[i] > 3:
+            valence = 5
+        elif element == 'S' and degree[i] > 2:
+            valence = 4 if degree[i] == 3 else 6
+        if degree[i] > valence:
+            return None
+        valences.append(valence)
+        need.append(valence - degree[i])
+
+    #multiple bonds, starting with the atoms that have the fewest options
+    while True:
+        options = {i: [j for j in neighbors[i] if need[j]] for i in
+                range(len(need)) if need[i]}
+        options = {i: js for i,js in options.items() if js}
+        if not options:
+            break
+        i = min(options, key=lambda i: (len(options[i]), i))
+        j = min(options[i], key=lambda j: (len(options.get(j, ())), j))
+        need[i] -= 1
+        need[j] -= 1
+
+    for i,left in enumerate(need):
+        if not left:
+            continue
+        element = elements[i]
+        if left > 1:
+            return None
+        if element in ('O', 'S') and degree[i] == 1:
+            j = neighbors[i][0]
+            #N-oxides are zwitterions
+            if not (elements[j] == 'N' and degree[j] == 3 and valences[j] == 3):
+                charge -= 1
+        elif element in ('F', 'Cl', 'Br', 'I') and degree[i] == 0:
+            charge -= 1
+        elif element == 'N' and degree[i] == 2:
+            charge -= 1
+        elif element == 'C' and any(elements[j] == 'N' and degree[j] == 3
+                for j in neighbors[i]):
+            #iminium, e.g. amidinium, guanidinium or protonated imidazole
+            charge += 1
+        else:
+            return None
+    return charge
+
 def is_secret_peptide(mol_data):
     '''
     Checks whether something that wasn't identified as a peptide (i.e. didn't
@@ -151,55 +421,59 @@ def is_secret_peptide(mol_data):
     '''
     #relevant elements for identifying backbone
     nameslist = ["N", "C", "O"]
-    #store tuple of locations of atoms for each name and whether they are
-    #bonded to the correct next guy in the chain here
-    atomdict = {}
-    for name in nameslist:
-        atomdict[name] = []
     #which ALREADY SEEN atom name(s) should be bonded to current atom if it's in a peptide
     last_atom = {}
     last_atom["C"] = ["C", "N", "O"]
     last_atom["N"] = ["C"]
     last_atom["O"] = ["C"]
-    for i,atom in enumerate(mol_data.mol_data['element']):
-        reduced_type = ''.join(char for char in atom if char.isalpha())
-        if reduced_type in nameslist:
-            me = (mol_data.mol_data['x'][i], mol_data.mol_data['y'][i],
-                    mol_data.mol_data['z'][i])
-            atomdict[reduced_type].append([me, -1, ''])
-            be_my_neighbor = last_atom[reduced_type]
-            for maybe_neighbor in be_my_neighbor:
-                for j,seen in enumerate(atomdict[maybe_neighbor]):
-                    if maybe_neighbor == reduced_type and j == len(atomdict[reduced_type])-1:
-                        #we're at the current atom
-                        break
-                    elif is_bonded(get_dist(me, seen[0])) and atomdict[maybe_neighbor][j][1] < 0:
-                        #update my relevant neighbor to indicate our adjacency
-                        atomdict[maybe_neighbor][j][1] = len(atomdict[reduced_type]) - 1
-                        atomdict[maybe_neighbor][j][2] = reduced_type
-    result = False
-    for atom in atomdict["N"]:
-        result = walk_to_end(atom, atomdict, "N")
-        if result:
-            break
-    return result
+    types = [''.join(char for char in atom if char.isalpha()) for atom in
+            mol_data.mol_data['element']]
+    backbone = np.array([i for i,t in enumerate(types) if t in nameslist],
+            dtype=np.int64)
+    if not len(backbone):
+        return False
+    types = [types[i] for i in backbone]
+    #each atom is followed by the first later atom it's bonded to whose type
+    #may come after it in a chain
+    pairs = CellList(get_coords(mol_data)[backbone], 2.0).pairs()
+    allowed = np.array([types[i] in last_atom[types[j]] for i,j in
+        pairs.tolist()], dtype=bool)
+    pairs = pairs[allowed] if len(pairs) else pairs
+    following = np.full(len(backbone), len(backbone), dtype=np.int64)
+    np.minimum.at(following, pairs[:,0], pairs[:,1])
+    #walk from the back so each atom's chain end is already known
+    ends_at_o = [False] * len(backbone)
+    for i in range(len(backbone)-1, -1, -1):
+        if following[i] < len(backbone):
+            ends_at_o[i] = ends_at_o[following[i]]
+        else:
+            ends_at_o[i] = types[i] == "O"
+    return any(end for end,t in zip(ends_at_o, types) if t == "N")
 
-def get_units(lib):
+@memoize_file
+def parse_lib(lib):
     '''
-    Get the names of the units defined by an AMBER library file
+    Parse an AMBER library file; returns a dict with the names of the units
+    it defines and the names of their atoms (only units for prep files)
     '''
     units = []
+    atoms = []
     ext = os.path.splitext(lib)[-1]
     with open(lib,'r') as f:
         if ext[0:4] != 'prep':
-            copy = False
+            section = None
             for line in f:
                 if line.startswith('!!index array str'):
-                    copy = True
+                    section = 'index'
                 elif line.startswith('!'):
-                    break
-                elif copy:
+                    if line.split()[0].split('.')[-1] == 'atoms':
+                        section = 'atoms'
+                    else:
+                        section = None
+                elif section == 'index':
                     units.append(line.strip().strip('"'))
+                elif section == 'atoms' and line.split():
+                    atoms.append(line.split()[0].strip('"'))
         else:
             i = 0
             for line in f:
@@ -207,7 +481,19 @@ def get_units(lib):
                     units.append(line.split()[0])
                     break
                 i += 1
-    return units
+    return {'units': units, 'atoms': atoms}
+
+def get_units(lib):
+    '''
+    Get the names of the units defined by an AMBER library file
+    '''
+    return parse_lib(lib)['units']
+
+def get_lib_atoms(lib):
+    '''
+    Get the names of the atoms in the units defined by an AMBER library file
+    '''
+    return parse_lib(lib)['atoms']
 
 def get_charge(mol2):
     '''
@@ -231,6 +517,85 @@ def get_charge(mol2):
                 charge += float(line.split()[-1])
     return int(math.ceil(charge)) if charge > 0 else int(math.floor(charge))
 
+def mol2_element(atom_type, name):
+    '''
+    Return the element for a mol2 atom from its type, which is a Sybyl type
+    like "C.ar" or a lowercase GAFF type like "ca" or "cl", falling back to
+    its name
+    '''
+    if atom_type[:1].isupper():
+        return atom_type.split('.')[0].capitalize()
+    if atom_type[:2] in ('cl', 'br'):
+        return atom_type[:2].capitalize()
+    if atom_type[:1].isalpha():
+        return atom_type[0].upper()
+    return ''.join(char for char in name if char.isalpha())[:1].upper()
+
+def get_mol2_graph(mol2):
+    '''
+    Return the atom names, elements, and bonds (as pairs of atom indices)
+    of the first molecule in a mol2 file
+    '''
+    names, elements, bonds = [], [], []
+    ids = {}
+    record = None
+    with open(mol2, 'r') as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if record == 'BOND':
+                    break
+                record = line.strip()[len('@<TRIPOS>'):]
+                continue
+            fields = line.split()
+            if not fields:
+                continue
+            if record == 'ATOM':
+                ids[fields[0]] = len(names)
+                names.append(fields[1])
+                elements.append(mol2_element(fields[5], fields[1]))
+            elif record == 'BOND':
+                bonds.append((ids[fields[1]], ids[fields[2]]))
+    return names, elements, bonds
+
+def get_prmtop_charge(prmtop):
+    '''
+    Return the total charge of the system in an AMBER prmtop, in units of e
+    '''
+    charges = []
+    with open(prmtop, 'r') as f:
+        copy = False
+        for line in f:
+            if line.startswith('%FLAG'):
+                if copy:
+                    break
+                copy = line.split()[1] == 'CHARGE'
+            elif copy and not line.startswith('%'):
+                charges += [float(value) for value in line.split()]
+    #prmtop charges are scaled so Coulomb's law needs no constant
+    return sum(charges) / 18.2223
+
+@memoize_file
+def get_ion_elements(lib):
+    '''
+    Return a dict mapping the AMBER names of the ions given masses in an
+    frcmod to their elements
+    '''
+    ions = {}
+    copy = False
+    with open(lib, 'r') as f:
+        for line in f:
+            if line.startswith('MASS'):
+                copy = True
+            elif line.startswith('NONBON'):
+                break
+            elif copy:
+                contents = line.split()
+                if contents:
+                    ambername = contents[0]
+                    element = ''.join(c for c in contents[0] if c.isalpha())
+                    ions[ambername] = element.upper()
+    return ions
+
 def get_ions(libs):
     '''
     Find which ions are defined for chosen water model; returns a dict mapping
@@ -238,21 +603,23 @@ def get_ions(libs):
     '''
     ions = {}
     for lib in libs:
-        copy = False
-        with open(lib, 'r') as f:
-            for line in f:
-                if line.startswith('MASS'):
-                    copy = True
-                elif line.startswith('NONBON'):
-                    break
-                elif copy:
-                    contents = line.split()
-                    if contents:
-                        ambername = contents[0]
-                        element = ''.join(c for c in contents[0] if c.isalpha())
-                        ions[ambername] = element.upper()
+        ions.update(get_ion_elements(lib))
     return ions
 
+@memoize_file
+def get_aliases(ff):
+    '''
+    Return [alias, name] for each assignment in a leaprc, which is how
+    leaprcs alias residue names
+    '''
+    aliases = []
+    with open(ff, 'r') as f:
+        for line in f:
+            m = re.search(r'(\S+)\s*=\s*(\S+)', line)
+            if m:
+                aliases.append([m.group(1), m.group(2)])
+    return aliases
+
 def get_available_res(ff=''):
     '''
     Return a set of the standard amino acid residues (plus water) defined by
@@ -275,11 +642,9 @@ def get_available_res(ff=''):
         "NI", "Na+", "Nd", "PB", "PD", "PR", "PT", "Pu", "RB", "Ra", "SM", "SR", 
         "Sm", "Sn", "TB", "TL", "Th", "Tl", "Tm", "U4+", "V2+", "Y", "YB2", "ZN", "Zr"]
         units = set(units)
-        with open(ff, 'r') as f:
-            for line in f: # look for aliased residues
-                m = re.search(r'(\S+)\s*=\s*(\S+)', line)
-                if m and m.group(2) in units:
-                    units.add(m.group(1))
+        for alias,name in get_aliases(ff): # look for aliased residues
+            if name in units:
+                units.add(alias)
         return units
     #amino acid residues that leap should recognize with a standard protein force
     #field, plus water
@@ -315,3 +680,149 @@ modified_residues = set(['ZA', 'ZC', 'ZD', 'ZE', 'ZF', 'ZG', 'ZHD', 'ZHE',
     'HEP', 'H1D', 'H2D', 'H1E', 'H2E', 'S1P', 'S2P', 'T1P', 'T2P', 'Y1P',
     'Y2P', 'SEP', 'THP', 'TYP'])
 
+
+#atomic masses in daltons, for estimating solute volumes
+atomic_masses = {'H': 1.008, 'Li': 6.94, 'B': 10.81, 'C': 12.011, 'N': 14.007,
+        'O': 15.999, 'F': 18.998, 'Na': 22.990, 'Mg': 24.305, 'Al': 26.982,
+        'Si': 28.085, 'P': 30.974, 'S': 32.06, 'Cl': 35.45, 'K': 39.098, 'Ca':
+        40.078, 'Mn': 54.938, 'Fe': 55.845, 'Co': 58.933, 'Ni': 58.693, 'Cu':
+        63.546, 'Zn': 65.38, 'Se': 78.971, 'Br': 79.904, 'I': 126.904, 'Hg':
+        200.592}
+#used for elements missing from the table
+default_mass = 12.011
+
+#net charges of residues as tleap builds them, for anything not given its
+#own charge; N/C-prefixed terminal variants carry their terminus's charge
+amino_acid_charges = {'ALA': 0, 'GLY': 0, 'SER': 0, 'THR': 0, 'LEU': 0, 'ILE':
+        0, 'VAL': 0, 'ASN': 0, 'GLN': 0, 'ARG': 1, 'HID': 0, 'HIE': 0, 'HIS': 0,
+        'HIP': 1, 'TRP': 0, 'PHE': 0, 'TYR': 0, 'GLU': -1, 'ASP': -1, 'LYS': 1,
+        'LYN': 0, 'PRO': 0, 'CYS': 0, 'CYX': 0, 'CYM': -1, 'MET': 0, 'ASH': 0,
+        'GLH': 0, 'HYP': 0}
+cap_charges = {'ACE': 0, 'NME': 0, 'NHE': 0}
+ion_charges = {'Na+': 1, 'NA': 1, 'K+': 1, 'K': 1, 'LI': 1, 'Li+': 1, 'RB': 1,
+        'CS': 1, 'CU1': 1, 'Cl-': -1, 'CL': -1, 'BR': -1, 'IOD': -1, 'F': -1,
+        'MG': 2, 'CA': 2, 'ZN': 2, 'MN': 2, 'FE2': 2, 'CU': 2, 'NI': 2, 'CO':
+        2, 'CD': 2, 'HG': 2, 'SR': 2, 'BA': 2, 'FE': 3, 'AL': 3, 'EU3': 3,
+        'GD3': 3, 'WAT': 0, 'HOH': 0}
+
+#TIP3P-like water number density in molecules/A^3 near 300 K, and a typical
+#protein density in g/cm^3 for the volume taken up by the solute
+water_density = 0.0334
+solute_density = 1.35
+
+def estimate_net_charge(mol, known=None):
+    '''
+    Estimate the net charge tleap will find for mol, a simplepdb, from its
+    residue names and chain breaks: amino acids at the ends of chains get
+    charged termini unless capped, and residues in known (a dict of residue
+    name -> charge, e.g. for ligands parametrized with antechamber) get the
+    charge given. Returns None if any residue's charge isn't known
+    '''
+    known = known or {}
+    index = mol.get_index()
+    resnames = mol.mol_data['resname']
+    chainids = mol.mol_data['chainid']
+    residues = [(key, resnames[atoms[0]], chainids[atoms[0]]) for key,atoms
+            in index.residues.items()]
+    charge = 0
+    for i,(key,resname,chain) in enumerate(residues):
+        if resname in known:
+            charge += known[resname]
+        elif resname in amino_acid_charges:
+            charge += amino_acid_charges[resname]
+            first = i == 0 or index.is_ter(*residues[i-1][0]) or \
+                    residues[i-1][2] != chain
+            last = i == len(residues)-1 or index.is_ter(*key) or \
+                    residues[i+1][2] != chain
+            if first and not (i > 0 and residues[i-1][1] == 'ACE' and not
+                    index.is_ter(*residues[i-1][0])):
+                charge += 1
+            if last and not (i < len(residues)-1 and residues[i+1][1] in
+                    ('NME', 'NHE') and not index.is_ter(*key)):
+                charge -= 1
+        elif len(resname) == 4 and resname[0] in 'NC' and resname[1:] in \
+                amino_acid_charges:
+            charge += amino_acid_charges[resname[1:]] + (1 if resname[0] ==
+                    'N' else -1)
+        elif resname in cap_charges:
+            charge += cap_charges[resname]
+        elif resname in ion_charges:
+            charge += ion_charges[resname]
+        else:
+            return None
+    return charge
+
+def octahedron_box(coords, buffer):
+    '''
+    Return the truncated octahedron that puts every point in coords at least
+    buffer from its faces once the points are aligned with their principal
+    axes and centered, as (D, a, volume): D is the distance between opposite
+    square faces, a the AMBER box length (the angles are 109.47 degrees), and
+    the volume in A^3
+    '''
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    centered = coords - coords.mean(axis=0)
+    #principal axes of the point cloud, as tleap orients the solute
+    _,_,axes = np.linalg.svd(centered, full_matrices=False)
+    aligned = centered.dot(axes.T)
+    aligned -= (aligned.max(axis=0) + aligned.min(axis=0)) / 2
+    #square faces at |x|,|y|,|z| = D/2, hexagonal ones at |x|+|y|+|z| = 3D/4
+    square = 2 * (np.abs(aligned).max() + buffer)
+    hexagonal = 4 * (np.abs(aligned).sum(axis=1).max() / math.sqrt(3) +
+            buffer) / math.sqrt(3)
+    D = max(square, hexagonal)
+    D = float(D)
+    return D, D * math.sqrt(3) / 2, D**3 / 2
+
+def estimate_solvation(coords, elements, buffer, net_charge=None):
+    '''
+    Estimate what solvating a solute in a truncated octahedron with the given
+    buffer will produce. Returns a dict with the box length and volume, the
+    solute's volume, the number of waters left once ions replace some, the
+    counts of Na+ and Cl- needed to neutralize net_charge (None if it isn't
+    known) and the total number of atoms, counting three per water
+    '''
+    D,length,volume = octahedron_box(coords, buffer)
+    mass = sum(atomic_masses.get(element, default_mass) for element in
+            elements)
+    #mass in Da -> volume in A^3 at the given density in g/cm^3
+    solute_volume = mass * 1.66054 / solute_density
+    waters = max(int(round((volume - solute_volume) * water_density)), 0)
+    if net_charge is None:
+        ions = None
+    else:
+        ions = {'Na+': max(-net_charge, 0), 'Cl-': max(net_charge, 0)}
+    #each ion replaces a water
+    nions = sum(ions.values()) if ions else 0
+    return {'box_length': length, 'box_volume': volume, 'solute_volume':
+            solute_volume, 'waters': waters - nions, 'ions': ions, 'natoms':
+            len(elements) + 3 * waters - 2 * nions}
+
+def estimated_ions(estimate, extra=None):
+    '''
+    Return the ion counts from an estimate_solvation estimate for tleap to
+    place at random, or None to have it neutralize the system itself. That's
+    always the case with an extra leap script, which can change the charge
+    '''
+    if extra and estimate['ions'] is not None:
+        print('Not using the estimated ion counts, since %s may change the \
+net charge; tleap will place neutralizing ions itself\n' %extra)
+        return None
+    return estimate['ions']
+
+def build_neutral(build, prmtop, ions, tolerance=0.01):
+    '''
+    Build a solvated system with build(ions), which writes prmtop, ions
+    being estimated_ions counts or None. The estimate comes from a residue
+    name table, so if the system isn't neutral with it, it's rebuilt with
+    build(None). Returns the ions the system was built with
+    '''
+    build(ions)
+    if ions is not None:
+        charge = get_prmtop_charge(prmtop)
+        if abs(charge) > tolerance:
+            print('System has a net charge of %.3f with the estimated ions; \
+rebuilding it with tleap placing the ions\n' %charge)
+            ions = None
+            build(ions)
+    return ions
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+import collections, hashlib, json, os
+
+#Resumable multi-stage runs. A pipeline is a graph of stages, each declaring
+#the files it reads and writes and any other parameters that affect what it
+#produces. Fingerprints of all of these are recorded in a JSON manifest as
+#each stage finishes, so a rerun skips the stages that are still up to date
+#and resumes from the first stale one.
+
+class Stage:
+    '''
+    One step of a pipeline.
+
+    Attributes:
+        name: Unique within the pipeline; the stage's key in the manifest.
+
+        func: Called with no arguments to run the stage.
+
+        inputs: Files the stage reads.
+
+        outputs: Files the stage writes.
+
+        params: JSON-serializable values other than files that determine the
+        outputs.
+
+        deps: Names of stages that have to run first.
+    '''
+    def __init__(self, name, func, inputs=(), outputs=(), params=None,
+            deps=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        #compare params as they will read back from the manifest
+        self.params = json.loads(json.dumps(params))
+        self.deps = list(deps)
+
+class Pipeline:
+    '''
+    Stage graph with a manifest of what each stage last ran on.
+
+    Attributes:
+        manifest: Path of the JSON manifest.
+
+        stages: OrderedDict of name -> Stage, in the order they were added.
+
+        records: For each stage that finished, the fingerprints of its
+        inputs and outputs and its params.
+
+        files: Cached fingerprints by path, with the size and mtime they were
+        computed for, so unchanged files aren't rehashed on every run.
+    '''
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.stages = collections.OrderedDict()
+        self.records = {}
+        self.files = {}
+        try:
+            with open(manifest, 'r') as f:
+                contents = json.load(f)
+            self.records = contents['stages']
+            self.files = contents['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def add(self, name, func, inputs=(), outputs=(), params=None, deps=()):
+        '''
+        Add a stage; see Stage for the arguments
+        '''
+        assert name not in self.stages, 'Duplicate stage %s\n' %name
+        self.stages[name] = Stage(name, func, inputs, outputs, params, deps)
+        return self.stages[name]
+
+    def order(self):
+        '''
+        Return the stages so that each comes after its deps, otherwise in the
+        order they were added
+        '''
+        ordered = []
+        done = set()
+        pending = list(self.stages.values())
+        while pending:
+            for stage in pending:
+                for dep in stage.deps:
+                    assert dep in self.stages, 'Stage %s depends on unknown \
+stage %s\n' %(stage.name, dep)
+                if done.issuperset(stage.deps):
+                    break
+            else:
+                raise ValueError('Cycle among stages %s' %', '.join(stage.name
+                    for stage in pending))
+            pending.remove(stage)
+            ordered.append(stage)
+            done.add(stage.name)
+        return ordered
+
+    def fingerprint(self, path):
+        '''
+        Return the sha256 of a file's contents, or None if it doesn't exist
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        cached = self.files.get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == \
+                stat.st_mtime_ns:
+            return cached['sha256']
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+        self.files[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'sha256': sha.hexdigest()}
+        return sha.hexdigest()
+
+    def fingerprints(self, paths):
+        return {path: self.fingerprint(path) for path in paths}
+
+    def is_current(self, stage):
+        '''
+        True if stage finished before with the same params and inputs, and
+        its outputs all exist and haven't been touched since
+        '''
+        record = self.records.get(stage.name)
+        if not record or record['params'] != stage.params:
+            return False
+        if record['inputs'] != self.fingerprints(stage.inputs):
+            return False
+        outputs = self.fingerprints(stage.outputs)
+        return None not in outputs.values() and record['outputs'] == outputs
+
+    def run(self, force=False):
+        '''
+        Run every stage that isn't current, or that depends on one that ran,
+        in dependency order; with force, run them all. Returns the names of
+        the stages that ran
+        '''
+        ran = []
+        for stage in self.order():
+            if not force and not set(stage.deps).intersection(ran) and \
+                    self.is_current(stage):
+                print('Stage %s is up to date, skipping' %stage.name)
+                continue
+            #forget the old record first so that a stage that gets
+            #interrupted is never mistaken for a finished one
+            self.records.pop(stage.name, None)
+            inputs = self.fingerprints(stage.inputs)
+            self.save()
+            stage.func()
+            self.records[stage.name] = {'params': stage.params, 'inputs':
+                    inputs, 'outputs': self.fingerprints(stage.outputs)}
+            self.save()
+            ran.append(stage.name)
+        return ran
+
+    def save(self):
+        '''
+        Write the manifest, replacing the old one atomically
+        '''
+        tmp = self.manifest + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'stages': self.records, 'files': self.files}, f,
+                    indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest)
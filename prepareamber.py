@@ -5,14 +5,15 @@ import simplepdb as pdb
 import pdb_util as util
 from reparm_ligand import reparm  
 import os, shutil, glob, sys, logging
-from plumbum import FG, TEE
+import collections, concurrent.futures, contextlib, functools, tempfile
+import md_engines, param_cache, pipeline, profiling, tool_runner
 from plumbum.cmd import sed, grep, cut, uniq, wc
 try:
     from plumbum.cmd import obabel
 except ImportError:
     raise ImportError('Check that obabel is on your path')
 try:
-    from plumbum.cmd import antechamber, pdb4amber, tleap, pmemd_cuda
+    from plumbum.cmd import antechamber, pdb4amber, tleap
 except ImportError as e:
     print(e)
     raise ImportError('Check that AMBER binaries are on your path')
@@ -35,9 +36,10 @@ except ImportError:
 
 class Tee(object):
     '''For runfile, duplicate stdout to file'''
-    def __init__(self, name=None):
+    def __init__(self, name=None, mode='w'):
+        self.name = name
         if name:
-            self.file = open(name, 'w')
+            self.file = open(name, mode)
         else:
             self.file = None
     def writeln(self, data):
@@ -47,6 +49,8 @@ class Tee(object):
             self.file.flush()
         
 runfile = Tee() #a global variable so I don't have to pass it around
+#likewise for running the tools, which logs their output and resource use
+runner = tool_runner.ToolRunner()
 
 def find_ff(amberhome, ffname):
     ff = ''
@@ -90,10 +94,13 @@ def get_water_nickname(water_model):
     elif water_model == 'leaprc.water.tip4pew':
         return 'T4E'
 
+@profiling.profiled
 def make_amber_parm(fname, base, ff, molname='', water_model = '', 
-        wat_dist = 0, libs=[], frcmod = '', extra=None):
+        wat_dist = 0, libs=[], frcmod = '', extra=None, ions=None):
     '''
-    Generate AMBER parameters with tleap
+    Generate AMBER parameters with tleap. If ions gives the number of each
+    ion needed to neutralize the solvated system, they replace random waters
+    instead of being placed on tleap's electrostatic grid
     '''
     inpcrd = base + '.inpcrd'
     prmtop = base + '.prmtop'
@@ -121,9 +128,15 @@ def make_amber_parm(fname, base, ff, molname='', water_model = '',
             leap_input.write(extracmds)
         if water_model:
             leap_input.write('solvateoct '+ molname + get_waterbox(water_model) + 
-                    str(wat_dist) + '\n' + 
-                    'addions '+molname+' Na+ 0\n' + 
+                    str(wat_dist) + '\n')
+            if ions is None:
+                leap_input.write('addions '+molname+' Na+ 0\n' + 
                     'addions '+molname+' Cl- 0\n')
+            else:
+                for ion,count in sorted(ions.items()):
+                    if count:
+                        leap_input.write('addionsrand %s %s %d\n' %(molname,
+                            ion, count))
         elif frcmod:
             leap_input.write('loadamberparams '+frcmod+'\n' + 
                     'saveoff '+molname+' '+base+'.lib\n')
@@ -131,9 +144,20 @@ def make_amber_parm(fname, base, ff, molname='', water_model = '',
         leap_input.write('quit\n')
     command = tleap['-f', base + '.tleap'] 
     runfile.writeln(command)
-    command & FG
+    runner.run(command)
+
+def run_md(engine, run, dorun=True):
+    '''
+    Write the command for an md_engines.MDRun to the runfile and, if dorun,
+    run it with engine
+    '''
+    command = engine.command(run)
+    runfile.writeln(command)
+    if dorun:
+        engine.execute(command)
 
-def do_amber_min_constraint(fname, base):
+@profiling.profiled
+def do_amber_min_constraint(fname, base, engine):
     '''
     Do AMBER minimization with protein constraint
     '''
@@ -165,13 +189,12 @@ def do_amber_min_constraint(fname, base):
             'RES 1 ' + str(numres) + '\n' +
             'END\n' +
             'END\n')
-    command = pmemd_cuda['-O', '-i', base+'_min1.in', '-o', base+'_min1.out', '-p',
-            base+'.prmtop', '-c', base+'.inpcrd', '-r', base+'_min1.rst',
-            '-ref', base+'.inpcrd'] 
-    runfile.writeln(command)
-    command & FG
+    run_md(engine, md_engines.MDRun(base+'_min1.in', base+'_min1.out',
+        base+'.prmtop', base+'.inpcrd', base+'_min1.rst',
+        refc=base+'.inpcrd'))
 
-def do_amber_min(base):
+@profiling.profiled
+def do_amber_min(base, engine):
     '''
     Do unconstrained AMBER minimization 
     '''
@@ -185,12 +208,11 @@ def do_amber_min(base):
             '  ntr    = 0,\n' + 
             '  cut    = 10.0\n' + 
             ' /\n')
-    command = pmemd_cuda['-O', '-i', base+'_min2.in', '-o', base+'_min2.out', '-p',
-            base+'.prmtop', '-c', base+'_min1.rst', '-r', base+'_min2.rst'] 
-    runfile.writeln(command)
-    command & FG
+    run_md(engine, md_engines.MDRun(base+'_min2.in', base+'_min2.out',
+        base+'.prmtop', base+'_min1.rst', base+'_min2.rst'))
 
-def do_amber_warmup(fname, base, temperature):
+@profiling.profiled
+def do_amber_warmup(fname, base, temperature, engine):
     '''
     Do AMBER MD to gradually increase system to target temp
     '''
@@ -230,13 +252,12 @@ def do_amber_warmup(fname, base, temperature):
             'RES 1 ' + str(numres) + '\n' + 
             'END\n' + 
             'END\n')
-    command = pmemd_cuda['-O', '-i', base+'_md1.in', '-o', base+'_md1.out', '-p',
-            base+'.prmtop', '-c', base+'_min2.rst', '-r', base+'_md1.rst',
-            '-ref', base+'_min2.rst', '-x', base+'_md1.nc'] 
-    runfile.writeln(command)
-    command & FG
+    run_md(engine, md_engines.MDRun(base+'_md1.in', base+'_md1.out',
+        base+'.prmtop', base+'_min2.rst', base+'_md1.rst',
+        refc=base+'_min2.rst', mdcrd=base+'_md1.nc'))
 
-def do_amber_constant_pressure(base, temp):
+@profiling.profiled
+def do_amber_constant_pressure(base, temp, engine):
     '''
     Do AMBER MD to equilibrate system at constant pressure
     '''
@@ -254,11 +275,9 @@ def do_amber_constant_pressure(base, temp):
              '  ntpr = 5000, ntwx = 5000, ntwr = 500000,\n' + 
              '  ioutfm = 1\n' + 
              ' /\n')
-    command = pmemd_cuda['-O', '-i', base+'_md2.in', '-o', base+'_md2.out', '-p',
-            base+'.prmtop', '-c', base+'_md1.rst', '-r', base+'_md2.rst',
-            '-x', base+'_md2.nc'] 
-    runfile.writeln(command)
-    command & FG
+    run_md(engine, md_engines.MDRun(base+'_md2.in', base+'_md2.out',
+        base+'.prmtop', base+'_md1.rst', base+'_md2.rst',
+        mdcrd=base+'_md2.nc'))
 
 def make_amber_production_input(base, args):
     '''
@@ -282,70 +301,243 @@ def make_amber_production_input(base, args):
             '  ioutfm = 1\n' + 
              '/\n')
 
-def do_amber_preproduction(fname, base, args, ff):
+def do_amber_preproduction(fname, base, args, ff, engine):
     '''
     Do minimization with constraints, minimization without constraints, initial
     MD as temperature is raised to target temp, second MD where system is
     equilibrated at constant pressure, and generate input files for production
     run MD but don't run it (becuz it's PREproduction, see?)
     '''
-    do_amber_min_constraint(fname, base)
-    do_amber_min(base)
-    do_amber_warmup(fname, base, args.temperature)
-    do_amber_constant_pressure(base, args.temperature)
+    do_amber_min_constraint(fname, base, engine)
+    do_amber_min(base, engine)
+    do_amber_warmup(fname, base, args.temperature, engine)
+    do_amber_constant_pressure(base, args.temperature, engine)
     make_amber_production_input(base, args)
 
-def do_amber_production(base, dorun):
+@profiling.profiled
+def do_amber_production(base, dorun, engine):
     '''
     Does AMBER production run MD locally.  If dorun is false, only print command
     '''
-    command = pmemd_cuda['-O', '-i', base+'_md3.in', '-o', base+'_md3.out', '-p',
-            base+'.prmtop', '-c', base+'_md2.rst', '-r', base+'_md3.rst',
-            '-x', base+'_md3.nc'] 
-    runfile.writeln(command)
-    if dorun:
-        command & FG
+    run_md(engine, md_engines.MDRun(base+'_md3.in', base+'_md3.out',
+        base+'.prmtop', base+'_md2.rst', base+'_md3.rst',
+        mdcrd=base+'_md3.nc'), dorun)
+
+def estimate_system(fname, wat_dist, ante_lig):
+    '''
+    Estimate the size of the solvated system tleap will build from the
+    complex in fname, without running it; see util.estimate_solvation. The
+    net charges of ligands parametrized with antechamber come from their
+    mol2s
+    '''
+    mol = pdb.simplepdb(fname)
+    known = {}
+    for ligname,mol2 in ante_lig:
+        known[pdb.simplepdb(ligname).mol_data['resname'][0]] = \
+                util.get_charge(mol2)
+    net_charge = util.estimate_net_charge(mol, known)
+    estimate = util.estimate_solvation(util.get_coords(mol),
+            mol.get_elements(), float(wat_dist), net_charge)
+    print('Estimated system: %d atoms, %d waters, %s ions, truncated \
+octahedron with box length %.1f A (%.0f A^3)\n' %(estimate['natoms'],
+        estimate['waters'], ', '.join('%d %s' %(count, ion) for ion,count in
+            sorted(estimate['ions'].items())) if estimate['ions'] is not None
+        else 'unknown numbers of', estimate['box_length'],
+        estimate['box_volume']))
+    return estimate
 
-def do_antechamber(fname, net_charge, ff, molname, base = ''):
+def amber_pipeline(fname, base, ff, libs, ante_lig, args):
+    '''
+    Return the Pipeline that parametrizes the complex in fname and, unless
+    only parameters were requested, runs preproduction and optionally
+    production MD for it
+    '''
+    stages = pipeline.Pipeline(base + '_stages.json')
+    prmtop = base + '.prmtop'
+    inpcrd = base + '.inpcrd'
+    do_reparm = len(ante_lig) > 0 and not args.no_openff
+    ions = None
+    if args.estimate_solvation:
+        #size things up before committing to tleap
+        estimate = estimate_system(fname, args.water_dist, ante_lig)
+        if args.max_waters and estimate['waters'] > args.max_waters:
+            print('Estimated %d waters exceeds --max_waters %d; check %s \
+for stray molecules or coordinates far from the rest. Aborting...\n' %
+                    (estimate['waters'], args.max_waters, fname))
+            sys.exit()
+        ions = util.estimated_ions(estimate, args.extra)
+
+    def parm():
+        #falls back to addions 0 if the estimate doesn't neutralize it
+        util.build_neutral(lambda ions: make_amber_parm(fname, base, ff,
+            'complex', args.water_model, args.water_dist, libs,
+            extra=args.extra, ions=ions), prmtop, ions)
+        if do_reparm:
+            # Only do reparm if there are ligs to reparm    
+            reparm(ante_lig, base)
+    #reparm rewrites the prmtop in place, so it's part of the same stage
+    inputs = [fname] + libs + [name for lig in ante_lig for name in lig if
+            do_reparm]
+    if args.extra:
+        inputs.append(args.extra)
+    stages.add('parm', parm, inputs, [prmtop, inpcrd], {'ff': ff,
+        'water_model': args.water_model, 'water_dist': args.water_dist,
+        'reparm': do_reparm, 'ions': ions})
+    if args.parm_only:
+        return stages
+
+    #only look for the MD engine now, so building parameters doesn't need it
+    engine = md_engines.get_engine(args.engine, args.md_ranks, runner)
+    prod_engine = md_engines.get_engine(args.prod_engine, args.md_ranks,
+            runner) if args.prod_engine else engine
+    #run the two minimization and two pre-production  MDs; which engine ran
+    #a stage is part of its params, so switching engines reruns it
+    md_params = {'engine': engine.name}
+    stages.add('min1', lambda: do_amber_min_constraint(fname, base, engine),
+            [fname, prmtop, inpcrd], [base + '_min1.rst'], md_params,
+            deps=['parm'])
+    stages.add('min2', lambda: do_amber_min(base, engine), [prmtop, base +
+        '_min1.rst'], [base + '_min2.rst'], md_params, deps=['min1'])
+    stages.add('md1', lambda: do_amber_warmup(fname, base, args.temperature,
+        engine), [fname, prmtop, base + '_min2.rst'], [base + '_md1.rst',
+            base + '_md1.nc'], dict(md_params, temperature=args.temperature),
+        deps=['min2'])
+    stages.add('md2', lambda: do_amber_constant_pressure(base,
+        args.temperature, engine), [prmtop, base + '_md1.rst'], [base +
+            '_md2.rst', base + '_md2.nc'], dict(md_params,
+                temperature=args.temperature), deps=['md1'])
+    stages.add('prod_input', lambda: make_amber_production_input(base, args),
+            outputs=[base + '_md3.in'], params={'prod_length':
+                args.prod_length, 'keep_velocities': args.keep_velocities,
+                'temperature': args.temperature, 'coord_dump_freq':
+                args.coord_dump_freq})
+    #run the final production MD; without run_prod_md its outputs never
+    #appear, so the stage always reruns and just prints the command
+    stages.add('prod', lambda: do_amber_production(base, args.run_prod_md,
+        prod_engine), [prmtop, base + '_md2.rst', base + '_md3.in'], [base +
+            '_md3.rst', base + '_md3.nc'], {'engine': prod_engine.name},
+        deps=['md2', 'prod_input'])
+    return stages
+
+def charge_candidates(net_charge, window=0):
+    '''
+    Return the net charges to try with antechamber in order of preference:
+    the one given, then neutral and -1, then the rest of a +/-window around
+    the one given
+    '''
+    net_charge = int(net_charge)
+    charges = [net_charge, 0, -1]
+    for offset in range(1, window+1):
+        charges += [net_charge + offset, net_charge - offset]
+    return list(collections.OrderedDict.fromkeys(charges))
+
+def run_charge_trials(fname, ext, mol2, charges):
+    '''
+    Run antechamber for all candidate net charges at once, each in its own
+    scratch directory, and keep the output for the most preferred charge that
+    works; as soon as that's known the remaining runs are killed. Returns the
+    charge used, or None if every run failed
+    '''
+    src = os.path.abspath(fname)
+    jobs = []
+    scratches = []
+    for charge in charges:
+        scratch = tempfile.mkdtemp(prefix=util.get_base(mol2) + '_nc%d_' %
+                charge, dir='.')
+        command = antechamber['-i', src, '-fi', ext, '-o', 'out.mol2', '-fo',
+                'mol2', '-c', 'bcc', '-nc', str(charge), '-s', '2']
+        runfile.writeln(command)
+        jobs.append((command, {'stage': 'antechamber_nc%d' %charge, 'cwd':
+            scratch}))
+        scratches.append(scratch)
+    try:
+        i,_ = runner.first_success(jobs, lambda i,result:
+                os.path.isfile(os.path.join(scratches[i], 'out.mol2')))
+        if i is None:
+            return None
+        shutil.copyfile(os.path.join(scratches[i], 'out.mol2'), mol2)
+        return charges[i]
+    finally:
+        for scratch in scratches:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+@contextlib.contextmanager
+def scratch_dir(prefix):
+    '''
+    Work in a fresh scratch directory under the current one, which is
+    removed afterwards. antechamber, sqm, parmchk and tleap write files with
+    fixed names (sqm.in, sqm.out, ANTECHAMBER_*.AC, ATOMTYPE.INF, leap.log)
+    to the current directory, so concurrent runs have to be kept apart.
+    Yields the directory to copy outputs back to
+    '''
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix=prefix, dir=cwd)
+    os.chdir(scratch)
+    try:
+        yield cwd
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+@profiling.profiled
+def do_antechamber(fname, net_charge, ff, molname, base = '', parallel=False,
+        charge_window=0):
     '''
     Run antechamber and get correctly named versions of the following: mol2
-    with bcc charges, frcmod, lib, prmtop, inpcrd
+    with bcc charges, frcmod, lib, prmtop, inpcrd. If antechamber fails with
+    the given net charge, neutral and -1 are tried next (plus a window of
+    charges around the given one if charge_window is set); with parallel, all
+    of them run at once. Everything runs in a private scratch directory and
+    only those outputs are copied back, so ligands can be parametrized
+    concurrently
     '''
     if not base: base = util.get_base(fname)
     ext = os.path.splitext(fname)[-1]
     ext = ext.lstrip('.')
     mol2 = base + '_amber.mol2'
-    #TODO: known issues with phosphates (see PDB: 2PQC) when getting the net
-    #charge from Gasteiger charges computed with Open Babel
-    try:
-        command = antechamber['-i', fname, '-fi', ext, '-o', mol2, '-fo', 'mol2', '-c',
-                'bcc', '-nc', str(net_charge), '-s', '2']
-        runfile.writeln(command)
-        command()
-    except Exception as e:
-        passed = False
-        charges = []
-        if net_charge != 0:
-            charges.append(0)
-        if net_charge != -1:
-            charges.append(-1)
-        for charge in charges:
-            try:
-                command = antechamber['-i', fname, '-fi', ext, '-o', mol2, '-fo', 'mol2', '-c',
-                        'bcc', '-nc', str(charge), '-s', '2']
-                runfile.writeln(command)
-                command()
-                passed = True
-                break
-            except Exception as e:
-                pass
+    frcmod = base + '.frcmod'
+    outputs = [mol2, frcmod, base + '.lib', base + '.prmtop', base + '.inpcrd']
+    fname = os.path.abspath(fname)
+    with scratch_dir(base + '_antechamber_') as outdir:
+        #TODO: known issues with phosphates (see PDB: 2PQC) when getting the net
+        #charge from Gasteiger charges computed with Open Babel
+        charges = charge_candidates(net_charge, charge_window)
+        if parallel:
+            passed = run_charge_trials(fname, ext, mol2, charges) is not None
+        else:
+            passed = False
+            for charge in charges:
+                try:
+                    command = antechamber['-i', fname, '-fi', ext, '-o', mol2, '-fo', 'mol2', '-c',
+                            'bcc', '-nc', str(charge), '-s', '2']
+                    runfile.writeln(command)
+                    runner.run(command)
+                    passed = True
+                    break
+                except Exception as e:
+                    pass
         if not passed:
             print('Antechamber failed. Check {0} structure. Aborting...\n'.format(fname))
             sys.exit()
 
-    frcmod = base + '.frcmod'
-    parmchk['-i', mol2, '-f', 'mol2', '-o', frcmod]()
-    make_amber_parm(mol2, base, ff, molname=molname, frcmod=frcmod)
+        runner.run(parmchk['-i', mol2, '-f', 'mol2', '-o', frcmod])
+        make_amber_parm(mol2, base, ff, molname=molname, frcmod=frcmod)
+        for output in outputs:
+            if os.path.isfile(output):
+                shutil.copyfile(output, os.path.join(outdir, output))
+
+@functools.lru_cache()
+def get_ambertools_version():
+    '''
+    Return the AmberTools version reported by antechamber, or failing that
+    something that changes whenever antechamber does
+    '''
+    code,stdout,stderr = antechamber.run('-h', retcode=None)
+    m = re.search(r'antechamber\s+(\d+(\.\d+)*)', stdout + stderr)
+    if m:
+        return m.group(1)
+    path = os.path.realpath(str(antechamber.executable))
+    return '%s:%d' % (path, os.path.getmtime(path))
 
 def set_matches(fname, libs, reslist, orphaned_res, mol, force=False):
     '''
@@ -357,21 +549,10 @@ def set_matches(fname, libs, reslist, orphaned_res, mol, force=False):
     matches = set(units).intersection(reslist)
     #TODO: make this work for prep and check bonds as well as atoms.
     #require that atom names and connectivity match before adding lib
-    libatoms = []
     ext = os.path.splitext(fname)[-1][0:4]
-    if ext != 'prep':
-        with open(fname,'r') as f:
-            atomcopy = False
-            for line in f:
-                if line.startswith('!'):
-                    if line.split()[0].split('.')[-1] == 'atoms':
-                        atomcopy = True
-                    else:
-                        atomcopy = False
-                elif atomcopy:
-                    aname = line.split()[0].strip('"')
-                    if not aname.startswith("H"): #ignore hydrogen
-                        libatoms.append(aname)
+    #ignore hydrogen
+    libatoms = [aname for aname in util.get_lib_atoms(fname) if not
+            aname.startswith("H")]
     molatoms = set([name.strip() for name in mol.mol_data['atomname']])
     
     if not set(libatoms).issubset(molatoms) or ext == 'prep' and not force:            
@@ -395,13 +576,238 @@ def set_matches(fname, libs, reslist, orphaned_res, mol, force=False):
                 libs.add(frcmod)
             orphaned_res -= matches
 
-if __name__ == '__main__':
+def worker_state():
+    '''
+    Return the module-level configuration worker processes need: where the
+    tools log to and their timeouts, the profile being recorded, and the
+    runfile
+    '''
+    return {'log_dir': runner.log_dir, 'timeouts': runner.timeouts, 'echo':
+            runner.echo, 'profile_path': profiling.profiler.path,
+            'profile_run': profiling.profiler.run, 'runfile': runfile.name}
+
+def init_worker(state):
+    '''
+    Configure a worker process from worker_state(). Workers started with
+    spawn or forkserver (the defaults on macOS and, from Python 3.14, Linux)
+    don't inherit the parent's globals, so it's passed explicitly
+    '''
+    global runfile
+    runner.log_dir = state['log_dir']
+    runner.timeouts = state['timeouts']
+    runner.echo = state['echo']
+    profiling.profiler.path = state['profile_path']
+    profiling.profiler.run = state['profile_run']
+    #the parent already truncated it
+    runfile = Tee(state['runfile'], 'a')
+
+def run_jobs(func, job_args, njobs=1):
+    '''
+    Call func with each tuple of arguments in job_args, in a pool of up to
+    njobs processes if njobs > 1, and return the results in input order
+    '''
+    if njobs > 1 and len(job_args) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(njobs,
+            len(job_args)), initializer=init_worker,
+            initargs=(worker_state(),)) as pool:
+            return list(pool.map(func, *zip(*job_args)))
+    return [func(*job) for job in job_args]
+
+def pdb_conversion(structure, net_charge, overwrite):
+    '''
+    Return the PDB to load structure from, the obabel command that creates it
+    (None if structure is already a PDB), and the structure's net charge if
+    known from the input
+    '''
+    assert os.path.isfile(structure),'%s does not exist\n' % structure
+    ext = os.path.splitext(structure)[-1]
+    if 'pdb' in ext:
+        return structure, None, net_charge
+    #if it's a mol2, store the net_charge from the input because
+    #conversion to a pdb and back to a mol2 with openbabel is not
+    #guaranteed to result in the same partial charges
+    if not net_charge and 'mol2' in ext:
+        net_charge = util.get_charge(structure)
+    #"base" is the base filename (no extension) from which others will be derived
+    outpdb = util.get_base(structure) + '.pdb'
+    if not overwrite:
+        outpdb = util.get_fname(outpdb, reserve=True)
+    return outpdb, obabel[structure, '-O', outpdb, '-xn'], net_charge
+
+def conversion_failed(error, outpdb):
+    '''
+    Report that obabel couldn't create outpdb and exit
+    '''
+    print('Cannot create PDB from input, error {0}. Check \
+{1}. Aborting...\n'.format(error, outpdb))
+    sys.exit()
+
+@profiling.profiled
+def load_structure(structure, net_charge, overwrite, ions, standard_res):
+    '''
+    Convert a structure to PDB with obabel if necessary and parse it. Returns
+    the PDB filename, the parsed structure, info for metals pdb4amber would
+    strip, its nonstandard residues, and its net charge if known from the
+    input
+    '''
+    structure, convert, net_charge = pdb_conversion(structure, net_charge,
+            overwrite)
+    if convert is not None:
+        try:
+            runner.run(convert)
+        except Exception as e:
+            conversion_failed(e, structure)
+    mol = pdb.simplepdb(structure)
+    if not mol.has_unique_names() and not mol.is_protein():
+        mol.rename_atoms()
+        print("Renaming atoms for",structure)
+    mol_res = set(mol.mol_data['resname'])
+    ion_resnames = set(ions.keys())
+    ions_present = set.intersection(mol_res, ion_resnames)
+    #pdb4amber seems to delete mercury (HG) along with hydrogens; for now my
+    #hacky fix is to store the relevant atom info if mercury is present and add
+    #the mercury back in after stripping...I'm preemptively doing this for
+    #hafnium too
+    metal_info = {}
+    #TODO: the pdb4amber problem this is trying to address still exists, but changes to this script's handling of ions mean this fails to solve the problem
+    if 'HG' in ions_present:
+        metal_info['HG'] = mol.get_res_info({'resname':'HG'})
+    if 'HF' in ions_present:
+        metal_info['HF'] = mol.get_res_info({'resname':'HF'})
+    nonstandard_res = list(mol_res - standard_res - ion_resnames)
+    return structure, mol, metal_info, nonstandard_res, net_charge
+
+@profiling.profiled
+def prepare_structure(struct, mol, reslist, orphaned_res, metal_info,
+        net_charge, ff, args, interactive):
+    '''
+    Run pdb4amber on a protein, or add hydrogens to a ligand and parametrize
+    it with antechamber. Returns the filename to use for the structure from
+    now on, its parsed contents, the libraries and frcmods it needs, the
+    (PDB, mol2) pair if it went through antechamber, and what pdb4amber
+    printed
+    '''
+    libs = []
+    ante_lig = None
+    pdb4amber_out = ''
+    base = util.get_base(struct)
+    is_protein = mol.is_protein()
+    if is_protein and reslist:
+        print("NOT RUNNING pdb4amber due to presence of modified residues.")
+    elif is_protein and not args.noh: 
+        fname = base + '_amber.pdb'
+        command = pdb4amber['-y', '-i', struct, '-o', fname]
+        runfile.writeln(command)
+        result = runner.run(command)
+        stdout,stderr = result.stdout,result.stderr
+        pdb4amber_out = stdout + stderr
+        struct = fname
+        if interactive:
+            input('Read the above messages and then press any key to continue; note that prepareamber will insert any missing TER records but does not add ACE/NME caps...\n')
+        #TODO: I mean, we _could_ add the ACE/NME caps...
+        mol = pdb.simplepdb(fname)
+        #if there were gaps, add appropriate TERs
+        for line in stderr.splitlines():
+            m = re.search(r'^gap .*between (\S+).(\d+)',line)
+            if m:
+                gap_res = m.group(2)
+                mol.add_ter(gap_res)
+        for deleted_ion,data in metal_info.items():
+            current_residues = set(mol.mol_data['resname'])
+            if deleted_ion not in current_residues:
+                for res in data:
+                    mol.add_residue(res)
+
+    #if we're handling a ligand and don't have library files, we will need at 
+    #least the pdb-formatted data and a mol2 from which we can derive gasteiger 
+    #charges for antechamber; make these with babel and find the net charge
+    if orphaned_res:
+        #"molname" will be the name of the unit for AMBER
+        #TODO: check whether, if there are multiple ligands to be fit in
+        #antechamber, the user has provided unit names for all of them or
+        #they have distinct residue names 
+        molname = orphaned_res[0]
+        mol.sanitize()
+        mol.set_resname(orphaned_res[0])
+        ligname = base + '_amber.pdb'
+        if not args.overwrite:
+            ligname = util.get_fname(ligname, reserve=True)
+        elif os.path.isfile(ligname):
+            os.remove(ligname)
+        mol2 = base + '_amber.mol2'
+        #create a PDB that has unique atom names, hydrogens, all HETATM
+        #records, element names, and the correct residue name
+        if not args.noh:
+            #a fresh temporary name, so concurrent runs can't collide
+            fd,tempname = tempfile.mkstemp(prefix=base + '_temp', suffix='.pdb',
+                    dir='.')
+            os.close(fd)
+            mol.writepdb(tempname)
+            runner.run(obabel[tempname, '-O', ligname, '-h','-xn'])
+            os.remove(tempname)
+            mol = pdb.simplepdb(ligname)
+            mol.sanitize()
+            mol.set_recordname('HETATM')
+            os.remove(ligname)
+            mol.writepdb(ligname)
+        else:
+            mol.writepdb(ligname)
+        #only compute if we didn't already get a value using an original
+        #mol2; the formal charge from perceived bonds saves a round trip
+        #through obabel unless it's ambiguous
+        if net_charge is None:
+            net_charge = mol.get_formal_charge()
+        if net_charge is None:
+            runner.run(obabel[ligname, '-O', mol2])
+            net_charge = util.get_charge(mol2)
+        #run antechamber
+        print('Parametrizing unit %s with antechamber.\n' % ' '.join(orphaned_res))
+        if util.is_secret_peptide(mol):
+            print('Warning: the ligand %s maybe actually be a peptide. If antechamber fails, check the residue names\n' %ligname)
+        #reuse parameters from an earlier run for the same ligand if we can
+        outputs = {'mol2': mol2, 'frcmod': base + '.frcmod', 'lib': base +
+                '.lib'}
+        if args.no_cache:
+            do_antechamber(ligname, net_charge, ff, molname, base,
+                    args.parallel_charges, args.charge_window)
+        else:
+            cache = param_cache.ParamCache(args.cache_dir, int(args.cache_size *
+                2**20))
+            key = cache.key(mol, net_charge, ff, molname,
+                    get_ambertools_version())
+            if cache.fetch(key, outputs, mol):
+                print('Using cached parameters for unit %s.\n' % molname)
+            else:
+                do_antechamber(ligname, net_charge, ff, molname, base,
+                        args.parallel_charges, args.charge_window)
+                cache.store(key, outputs, mol)
+        #add the libraries created in the last step to the libs list
+        libs.append(base + '.lib')
+        libs.append(base + '.frcmod')
+        #Antechamber does not preserve the input atomnames. It comes packaged with
+        #a program called match_atomname to cope with this. 
+        command = match_atomname['-i', ligname, '-fi', 'pdb', '-r', mol2, '-fr',
+                'mol2', '-o', ligname, '-h', 1]
+        runfile.writeln(command)
+        runner.run(command)
+        mol = pdb.simplepdb(ligname)
+        struct = ligname
+        ante_lig = (ligname, mol2)
+    return struct, mol, libs, ante_lig, pdb4amber_out
+
+def get_parser(require_structures=True):
+    '''
+    Return the command line parser for prepareamber; without
+    require_structures, for callers like batchprepare that supply the
+    structures themselves, --structures is optional
+    '''
     parser = argparse.ArgumentParser(description="Generates pre-production files for AMBER \
     MD. Can handle a receptor or ligand by themselves (checks for ligand library \
     files in the current directory and generates them if they don't exist) or \
     sets up the complex if given both a receptor and ligand.")
 
-    parser.add_argument('-s', '--structures', nargs='+', required=True, help='Structures \
+    parser.add_argument('-s', '--structures', nargs='+',
+    required=require_structures, help='Structures \
     for which you want to run a simulation. N.B. if more than one is provided \
     they will be simulated together.')
 
@@ -449,6 +855,27 @@ if __name__ == '__main__':
     parser.add_argument('-nc', '--net_charge', help='Optionally specify a net \
             charge for small molecule parametrization with antechamber.')
 
+    parser.add_argument('-pc', '--parallel_charges', action='store_true',
+            default=False, help='If antechamber might need to retry with other \
+            net charges, run all the candidates at once in separate scratch \
+            directories and keep the most preferred one that works.')
+
+    parser.add_argument('-cw', '--charge_window', type=int, default=0,
+            help='Also try net charges up to this far from the estimated one \
+            if antechamber fails with it, neutral and -1. Defaults to 0.')
+
+    parser.add_argument('-es', '--estimate_solvation', action='store_true',
+            default=False, help='Estimate the box, water and ion counts from \
+            the complex before running tleap and, if the net charge can be \
+            worked out, have tleap add that many neutralizing ions at random \
+            instead of with its much slower addions 0 placement. Not done \
+            with --extra, and tleap is rerun with addions 0 if the system \
+            is not neutral.')
+
+    parser.add_argument('--max_waters', type=int, help='With \
+    --estimate_solvation, abort before running tleap if the system would need \
+    more waters than this.')
+
     parser.add_argument('-parm', '--parm_only', action='store_true', default =
     False, help="Only generate the necessary ligand parameters, don't do the \
     preproduction MDs")
@@ -467,13 +894,63 @@ if __name__ == '__main__':
     The old script referred to this as the "timestep."')
     
     parser.add_argument('--extra', help="File with additional leap commands to apply")
+
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+            default=False, help="Always run antechamber and parmchk for \
+            ligands instead of reusing parameters cached by earlier runs.")
+
+    parser.add_argument('--cache_dir', default=param_cache.default_cache_dir,
+            help='Directory for cached ligand parameters; defaults to \
+            $PREPAREAMBER_CACHE or ~/.cache/prepareamber.')
+
+    parser.add_argument('--cache_size', type=float, default=1024,
+            help='Size in MB the ligand parameter cache may grow to before \
+            the least recently used entries are evicted; defaults to 1024.')
+
+    parser.add_argument('-e', '--engine', default='cuda', choices=['cuda',
+        'cpu', 'openmm', 'mock'], help='MD engine for the minimizations and \
+    preproduction MD: pmemd.cuda, CPU pmemd.MPI/sander, OpenMM, or a mock \
+    that runs nothing (for testing). Defaults to cuda.')
+
+    parser.add_argument('-pe', '--prod_engine', choices=['cuda', 'cpu',
+        'openmm', 'mock'], help='MD engine for production MD, if different \
+    from --engine, e.g. to prepare on CPU nodes and run production on GPUs.')
+
+    parser.add_argument('--md_ranks', type=int, default=1, help='MPI ranks \
+    for the cpu engine (or threads for OpenMM on the CPU); defaults to 1.')
+
+    parser.add_argument('--log_dir', default='logs', help='Directory for \
+    the output of each external tool, one log per tool (or per stage, for \
+    concurrent charge trials), plus tools.jsonl with the wall time, CPU time \
+    and peak memory of every run and profile.jsonl with the same for every \
+    stage. Defaults to logs.')
+
+    parser.add_argument('--timeout', nargs='+', metavar='TOOL=SECONDS',
+            help='Kill a tool that runs longer than this, e.g. \
+            antechamber=3600 pmemd.cuda=86400.')
+
+    parser.add_argument('--rerun_all', action='store_true', default=False,
+            help='Rerun every parametrization and MD stage, even ones whose \
+            inputs and outputs are unchanged since the last run.')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of \
+    structures to prepare in parallel; each runs in its own process. With more \
+    than one job the pdb4amber output is reviewed once, after all structures \
+    are done. Defaults to 1.')
     
     parser.add_argument('-noff', '--no_openff', action='store_true', default=False,
     help='Do not use open force field\'s SMIRNOFF to reparameterize antechamber \
     parameterized ligands. Default is False')
     
-    args = parser.parse_args()
+    return parser
 
+def setup_forcefields(args):
+    '''
+    Find the force fields, ions and water model requested in args. Returns
+    the list of force fields to source, the ions they define, and the residue
+    names they have parameters for; args.water_model is replaced by the
+    leaprc to source for it
+    '''
     #Check whether AMBERHOME is set and the desired force field is available
     amberhome = os.environ['AMBERHOME']
     if not amberhome:
@@ -511,78 +988,64 @@ model %s\n' %args.water_model
         args.water_model = 'leaprc.water.tip4pew'
 
     #do we have nonstandard residues?
-    mol_data = {}
-    nonstandard_res = {}
     standard_res = util.get_available_res(ff)
     ff = [ff]
     if nff:
         standard_res = standard_res.union(util.get_available_res(nff))
-        ff = ff.append(nff)
-    #pdb4amber seems to delete mercury (HG) along with hydrogens; for now my
-    #hacky fix is to store the relevant atom info if mercury is present and add
-    #the mercury back in after stripping...I'm preemptively doing this for
-    #hafnium too
-    metal_info = {}
-   
+        ff.append(nff)
+    return ff, ions, standard_res
+
+def prepare(args, ff, ions, standard_res, receptor=None):
+    '''
+    Prepare the structures in args for simulation and run the stages that
+    follow. receptor optionally gives the prepare_structure output for a
+    structure that's already been prepared (e.g. one shared by many
+    complexes); it goes first in the complex. Returns the base name of the
+    output files
+    '''
+    global runfile
+    mol_data = {}
+    #set up before any structure is loaded; run_jobs hands it to worker
+    #processes. absolute, since ligands are parametrized in scratch directories
+    runner.log_dir = os.path.abspath(args.log_dir)
+    runner.timeouts = {stage: float(seconds) for stage,seconds in
+            (timeout.split('=') for timeout in args.timeout or [])}
+    profiling.profiler.start_run(os.path.join(runner.log_dir,
+        'profile.jsonl'))
     #if any structure was not provided in PDB format, we will attempt to create
     #one from what was provided using obabel, choosing a filename that will not
     #overwrite anything in the directory (optionally)
-    for structure in args.structures:
-        net_charge = None
-        #the "structure" string in the args.structure list will be updated so
-        #that it corresponds to the PDB we should use for subsequent steps
-        assert os.path.isfile(structure),'%s does not exist\n' % structure
-        #"base" is the base filename (no extension) from which others will be derived
-        base = util.get_base(structure)
-        ext = os.path.splitext(structure)[-1]
-        if 'pdb' not in ext:
-            #if it's a mol2, store the net_charge from the input because
-            #conversion to a pdb and back to a mol2 with openbabel is not
-            #guaranteed to result in the same partial charges
-            if args.net_charge:
-                net_charge = args.net_charge
-            elif 'mol2' in ext:
-                net_charge = util.get_charge(structure)
-            outpdb = base + '.pdb'
-            if not args.overwrite:
-                outpdb = util.get_fname(outpdb)
-            try:
-                obabel[structure, '-O', outpdb, '-xn']()
-            except Exception as e:
-                print('Cannot create PDB from input, error {0} : {1}. Check \
-{2}. Aborting...\n'.format(e.errno, e.strerror, outpdb))
-                sys.exit()
-            idx = args.structures.index(structure)
-            args.structures[idx] = outpdb
-            structure = outpdb
-        mol_res = {}
-        mol_data[structure] = pdb.simplepdb(structure)
-        if not mol_data[structure].has_unique_names() and not mol_data[structure].is_protein():
-            mol_data[structure].rename_atoms()
-            print("Renaming atoms for",structure)
-        mol_res[structure] = set(mol_data[structure].mol_data['resname'])
-        ion_resnames = set(ions.keys())
-        ions_present = set.intersection(mol_res[structure], ion_resnames)
-        metal_info[structure] = {}
-	#TODO: the pdb4amber problem this is trying to address still exists, but changes to this script's handling of ions mean this fails to solve the problem
-        if 'HG' in ions_present:
-            metal_info[structure]['HG'] = mol_data[structure].get_res_info({'resname':'HG'})
-        if 'HF' in ions_present:
-            metal_info[structure]['HF'] = mol_data[structure].get_res_info({'resname':'HF'})
-        nonstandard_res[structure] = list(mol_res[structure] - standard_res -
-                ion_resnames)
+    #the structures are independent, so with --jobs they are loaded and then
+    #prepared in parallel; results always come back in input order
+    if args.jobs > 1:
+        load_args = [(structure, args.net_charge, args.overwrite, ions,
+            standard_res) for structure in args.structures]
+    else:
+        #without --jobs, still run the obabel conversions all at once; they
+        #don't depend on each other
+        conversions = [pdb_conversion(structure, args.net_charge,
+            args.overwrite) for structure in args.structures]
+        pending = [(outpdb, convert) for outpdb,convert,_ in conversions if
+                convert is not None]
+        for (outpdb,_),result in zip(pending, runner.run_all([(convert, {})
+            for _,convert in pending])):
+            if isinstance(result, Exception):
+                conversion_failed(result, outpdb)
+        load_args = [(outpdb, net_charge, args.overwrite, ions, standard_res)
+                for outpdb,_,net_charge in conversions]
+    loaded = run_jobs(load_structure, load_args, args.jobs)
 
     #if nonstandard residues, do we have the necessary library files? 
-    #check for prep, lib, and off; just add the frcmod if there is one
+    #check for prep, lib, and off; just add the frcmod if there is one. this
+    #happens serially, before anything new is parametrized, so every
+    #structure sees the same set of libraries
     libs = set([])
-    # store the ligands that were parameterized by antechamber so they can be reparameterized by SMIRNOFF
-    ante_lig = []
     if not args.libs:
         args.libs = []
-    for struct,reslist in list(nonstandard_res.items()):
+    jobs = []
+    for struct,mol,metal_info,reslist,net_charge in loaded:
         #track which units you don't have libs for
         orphaned_res = set(reslist)
-        base = util.get_base(struct)
         if orphaned_res:
         #try any user-provided locations first
             for user_lib in args.libs:
@@ -590,112 +1053,47 @@ model %s\n' %args.water_model
                     fname = user_lib + ext
                     if os.path.isfile(fname):
                         set_matches(fname, libs, reslist, orphaned_res,
-                                mol_data[struct], True)
+                                mol, True)
         #if residues are still undefined, check the current directory too
         if orphaned_res:
             local_libs = [name for name in glob.glob('*.lib') +
                     glob.glob('*.off') + glob.glob('*.prep')]
             for lib in local_libs:
-                set_matches(lib, libs, reslist, orphaned_res, mol_data[struct])
+                set_matches(lib, libs, reslist, orphaned_res, mol)
    
-        is_protein = mol_data[struct].is_protein()
         #for now, require that the ligand be provided separately from the protein -
         #that way we don't need to worry about differentiating between modified
         #residues (or other things we don't want to strip out of the protein) and
         #small molecules we can parametrize with antechamber
-        assert not (is_protein and orphaned_res), \
+        assert not (mol.is_protein() and orphaned_res), \
         "Undefined units %s in protein - check for modified residues, ions, or \
 cofactors\n" % ' '.join(orphaned_res)
-
-        if is_protein and reslist:
-            print("NOT RUNNING pdb4amber due to presence of modified residues.")
-        elif is_protein and not args.noh: 
-            fname = base + '_amber.pdb'
-            command = pdb4amber['-y', '-i', struct, '-o', fname]
-            runfile.writeln(command)
-            code,stdout,stderr = command & TEE
-            idx = args.structures.index(struct)
-            args.structures[idx] = fname
-            if not args.uninteractive:
-                input('Read the above messages and then press any key to continue; note that prepareamber will insert any missing TER records but does not add ACE/NME caps...\n')
-            #TODO: I mean, we _could_ add the ACE/NME caps...
-            mol_data[fname] = pdb.simplepdb(fname)
-            #if there were gaps, add appropriate TERs
-            for line in stderr.splitlines():
-                m = re.search(r'^gap .*between (\S+).(\d+)',line)
-                if m:
-                    gap_res = m.group(2)
-                    mol_data[fname].add_ter(gap_res)
-            for deleted_ion,data in metal_info[struct].items():
-                current_residues = set(mol_data[fname].mol_data['resname'])
-                if deleted_ion not in current_residues:
-                    for res in data:
-                        mol_data[fname].add_residue(res)
-
         assert len(orphaned_res)<2, "%s has multiple ligands; break them into \
 separate files to process with antechamber\n" % struct
+        jobs.append((struct, mol, reslist, list(orphaned_res), metal_info,
+            net_charge, ff, args, not args.uninteractive and args.jobs < 2))
 
-        #if we're handling a ligand and don't have library files, we will need at 
-        #least the pdb-formatted data and a mol2 from which we can derive gasteiger 
-        #charges for antechamber; make these with babel and find the net charge
-        orphaned_res = list(orphaned_res)
-        if orphaned_res:
-            #"molname" will be the name of the unit for AMBER
-            #TODO: check whether, if there are multiple ligands to be fit in
-            #antechamber, the user has provided unit names for all of them or
-            #they have distinct residue names 
-            molname = orphaned_res[0]
-            mol_data[struct].sanitize()
-            mol_data[struct].set_resname(orphaned_res[0])
-            tempname = base + '_temp.pdb'
-            ligname = base + '_amber.pdb'
-            if not args.overwrite:
-                tempname = util.get_fname(tempname)
-                ligname = util.get_fname(ligname)
-            if os.path.isfile(ligname):
-                os.remove(ligname)
-            mol2 = base + '_amber.mol2'
-            #create a PDB that has unique atom names, hydrogens, all HETATM
-            #records, element names, and the correct residue name
-            if not args.noh:
-                mol_data[struct].writepdb(tempname)
-                obabel[tempname, '-O', ligname, '-h','-xn']()
-                os.remove(tempname)
-                mol_data[struct] = pdb.simplepdb(ligname)
-                mol_data[struct].sanitize()
-                mol_data[struct].set_recordname('HETATM')
-                os.remove(ligname)
-                mol_data[struct].writepdb(ligname)
-            else:
-                mol_data[struct].writepdb(ligname)
-            idx = args.structures.index(struct)
-            args.structures[idx] = ligname
-            mol_data[ligname] = mol_data[struct]
-            #only compute if we didn't already get a value using an original mol2
-            if net_charge is None:
-                obabel[ligname, '-O', mol2]()
-                net_charge = util.get_charge(mol2)
-            #run antechamber
-            print('Parametrizing unit %s with antechamber.\n' % ' '.join(orphaned_res))
-            if util.is_secret_peptide(mol_data[ligname]):
-                print('Warning: the ligand %s maybe actually be a peptide. If antechamber fails, check the residue names\n' %ligname)
-            do_antechamber(ligname, net_charge, ff, molname, base)
-            #add the libraries created in the last step to the libs list
-            libs.add(base + '.lib')
-            libs.add(base + '.frcmod')
-            #Antechamber does not preserve the input atomnames. It comes packaged with
-            #a program called match_atomname to cope with this. 
-            command = match_atomname['-i', ligname, '-fi', 'pdb', '-r', mol2, '-fr',
-                    'mol2', '-o', ligname, '-h', 1]
-            runfile.writeln(command)
-            command()
-            mol_data[ligname] = pdb.simplepdb(ligname)
-            ante_lig.append((ligname, mol2))
+    # store the ligands that were parameterized by antechamber so they can be reparameterized by SMIRNOFF
+    ante_lig = []
+    libs = sorted(libs)
+    prepared = run_jobs(prepare_structure, jobs, args.jobs)
+    if receptor:
+        prepared.insert(0, receptor)
+    args.structures = []
+    for struct,mol,struct_libs,struct_ante_lig,pdb4amber_out in prepared:
+        args.structures.append(struct)
+        mol_data[struct] = mol
+        libs += [lib for lib in struct_libs if lib not in libs]
+        if struct_ante_lig:
+            ante_lig.append(struct_ante_lig)
+    if not args.uninteractive and args.jobs > 1 and any(out for *_,out in
+            prepared):
+        input('Read the pdb4amber messages above and then press any key to continue; note that prepareamber will insert any missing TER records but does not add ACE/NME caps...\n')
 
     #always add requeted frcmod files as they may apply to multiple ligands
     for lib in args.libs:
-        if os.path.isfile(lib+'.frcmod'):
-            libs.add(lib+'.frcmod')
+        if os.path.isfile(lib+'.frcmod') and lib+'.frcmod' not in libs:
+            libs.append(lib+'.frcmod')
             
     #ok, now we can be pretty sure we know what to do and that we are able to do it
     #create complex if there are multiple structures
@@ -718,13 +1116,17 @@ separate files to process with antechamber\n" % struct
         mol_data[args.structures[0]].writepdb(complex_name)    
         
     base = util.get_base(complex_name)
-    #make initial parameters files
-    make_amber_parm(complex_name, base, ff, 'complex', args.water_model, args.water_dist, libs, extra=args.extra)
-    if (len(ante_lig) > 0 and not args.no_openff):
-        # Only do reparm if there are ligs to reparm    
-        reparm(ante_lig, base)
-    #run the two minimization and two pre-production  MDs
-    if not args.parm_only: 
-        do_amber_preproduction(complex_name, base, args, ff)
-        #run the final production MD
-        do_amber_production(base, args.run_prod_md)
+    #each step is a stage in a pipeline whose manifest records what it ran
+    #on, so if a run dies partway through, rerunning it picks up from the
+    #first stage whose inputs or outputs have changed
+    stages = amber_pipeline(complex_name, base, ff, libs, ante_lig, args)
+    stages.run(args.rerun_all)
+    #where the time went, as <base>_profile.json and .csv; summarize many
+    #runs with profiling.py
+    profiling.profiler.write(base + '_profile')
+    return base
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    ff, ions, standard_res = setup_forcefields(args)
+    prepare(args, ff, ions, standard_res)
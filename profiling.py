@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+import argparse, csv, functools, json, os, resource, statistics, sys, time
+
+#Per-stage timing for prepareamber. Stage functions decorated with @profiled
+#record their wall time, their own CPU time, the CPU time and peak memory of
+#the child processes (antechamber, tleap, pmemd...) that finished during them,
+#and the files written to their working directory while they ran. That's
+#directory-wide: stages run at once in the same directory (with --jobs) each
+#see the others' files too, and their records are marked as overlapped when
+#a run is written out. Records are appended to a JSON-lines file as each
+#stage finishes, so stages run in worker processes are captured too; a run's
+#records are then written out as JSON and CSV. Run this module on directories
+#of profiles to summarize many runs.
+
+fields = ['run', 'stage', 'parent', 'pid', 'start', 'wall', 'cpu',
+        'child_cpu', 'child_maxrss', 'status', 'dir', 'files', 'bytes',
+        'overlapped']
+
+class Profiler:
+    '''
+    Collects stage records.
+
+    Attributes:
+        path: JSON-lines file records are appended to, or None to keep them
+        only in memory.
+
+        run: Identifier for the current run, stored with each record.
+
+        records: Records for stages finished in this process.
+
+        stack: Names of the stages in progress, innermost last.
+    '''
+    def __init__(self, path=None, run=None):
+        self.path = path
+        self.run = run
+        self.records = []
+        self.stack = []
+
+    def start_run(self, path, run=None):
+        '''
+        Start recording a new run to path
+        '''
+        self.path = path
+        self.run = run or '%s-%d' %(time.strftime('%Y%m%d-%H%M%S'),
+                os.getpid())
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def call(self, name, func, *args, **kwargs):
+        '''
+        Call func, recording it as stage name
+        '''
+        cwd = os.getcwd()
+        files = snapshot(cwd)
+        start = time.time()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        parent = self.stack[-1] if self.stack else ''
+        self.stack.append(name)
+        status = 'ok'
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            self.stack.pop()
+            own_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            written = {fname: size for fname,(mtime,size) in snapshot(cwd).items()
+                    if files.get(fname, (None,))[0] != mtime}
+            record = {'run': self.run, 'stage': name, 'parent': parent, 'pid':
+                    os.getpid(), 'start': start, 'wall': time.time() - start,
+                    'cpu': cpu_time(own_after) - cpu_time(own), 'child_cpu':
+                    cpu_time(children_after) - cpu_time(children),
+                    #the peak over all children so far; a lower bound for
+                    #this stage's tools unless an earlier one used more
+                    'child_maxrss': children_after.ru_maxrss / (2.**20 if
+                        sys.platform == 'darwin' else 2.**10),
+                    'status': status, 'dir': cwd, 'files': written, 'bytes':
+                    sum(written.values())}
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+    def load(self, run=None):
+        '''
+        Return the records for run (by default the current one) from path,
+        in the order the stages started
+        '''
+        run = run or self.run
+        records = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['run'] == run:
+                    records.append(record)
+        return sorted(records, key=lambda record: record['start'])
+
+    def write(self, base):
+        '''
+        Write the current run's records to base + '.json' and base + '.csv',
+        with those whose files may include other stages' marked overlapped
+        '''
+        records = mark_overlaps(self.load() if self.path else self.records)
+        with open(base + '.json', 'w') as f:
+            json.dump(records, f, indent=1)
+        write_csv(base + '.csv', records)
+
+def mark_overlaps(records):
+    '''
+    Set overlapped on each record whose stage ran in the same directory at
+    the same time as one in another process, so the files and bytes it lists
+    may include ones the other stage wrote. Returns the records
+    '''
+    for record in records:
+        record['overlapped'] = any(other['pid'] != record['pid'] and
+                other.get('dir') == record.get('dir') and other['start'] <
+                record['start'] + record['wall'] and record['start'] <
+                other['start'] + other['wall'] for other in records)
+    return records
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def snapshot(dirname='.'):
+    '''
+    Return {filename: (mtime, size)} for the files in dirname
+    '''
+    files = {}
+    for entry in os.scandir(dirname):
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+    return files
+
+def write_csv(fname, records):
+    '''
+    Write records as CSV, with the files written reduced to their names
+    '''
+    with open(fname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(dict(record, files=' '.join(sorted(
+                record['files']))))
+
+profiler = Profiler() #shared by everything that's decorated
+
+def profiled(func=None, name=None):
+    '''
+    Decorate a stage function so every call is recorded by profiler, under
+    name (by default the function's name)
+    '''
+    if func is None:
+        return functools.partial(profiled, name=name)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return profiler.call(name or func.__name__, func, *args, **kwargs)
+    return wrapper
+
+def summarize(records):
+    '''
+    Aggregate records by stage; returns a list of dicts with the number of
+    calls, the number of runs they came from, and total, mean, median and
+    max wall time, CPU time (own plus children) and bytes written
+    '''
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+    summary = []
+    for stage,group in stages.items():
+        wall = [record['wall'] for record in group]
+        summary.append({'stage': stage, 'calls': len(group), 'runs':
+            len(set(record['run'] for record in group)), 'failed':
+            sum(record['status'] != 'ok' for record in group), 'total_wall':
+            sum(wall), 'mean_wall': statistics.mean(wall), 'median_wall':
+            statistics.median(wall), 'max_wall': max(wall), 'total_cpu':
+            sum(record['cpu'] + record['child_cpu'] for record in group),
+            'total_bytes': sum(record['bytes'] for record in group)})
+    return sorted(summary, key=lambda row: -row['total_wall'])
+
+def find_profiles(dirnames):
+    '''
+    Return the records in every *_profile.json under dirnames
+    '''
+    records = []
+    for dirname in dirnames:
+        for root,_,fnames in os.walk(dirname):
+            for fname in sorted(fnames):
+                if fname.endswith('_profile.json'):
+                    with open(os.path.join(root, fname), 'r') as f:
+                        records += json.load(f)
+    return records
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stage \
+    profiles written by prepareamber runs under one or more directories, \
+    slowest stages first.')
+    parser.add_argument('dirs', nargs='+', help='Directories to search for \
+    *_profile.json files.')
+    parser.add_argument('-o', '--out', help='Also write the summary to this \
+    CSV file.')
+    args = parser.parse_args()
+
+    summary = summarize(find_profiles(args.dirs))
+    columns = ['stage', 'calls', 'runs', 'failed', 'total_wall', 'mean_wall',
+            'median_wall', 'max_wall', 'total_cpu', 'total_bytes']
+    if args.out:
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+            writer.writerows(summary)
+    width = max([len('stage')] + [len(row['stage']) for row in summary])
+    print('%-*s %6s %5s %6s %11s %10s %10s %10s %11s %12s' %((width,) +
+        tuple(columns)))
+    for row in summary:
+        print('%-*s %6d %5d %6d %11.1f %10.1f %10.1f %10.1f %11.1f %12d' %
+                (width, row['stage'], row['calls'], row['runs'], row['failed'],
+                    row['total_wall'], row['mean_wall'], row['median_wall'],
+                    row['max_wall'], row['total_cpu'], row['total_bytes']))
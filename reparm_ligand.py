@@ -12,8 +12,10 @@ try:
 except ImportError:
     raise ImportError('Check that obabel is on your path')
 import pdb_util as util
+import profiling
 
 
+@profiling.profiled
 def reparm(ligands, base): 
     print('**Running reparameterization of ligand(s) using open force fields\'s SMIRNOFF with openff 2.0.0**')
     # Load already parm'd system
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+import concurrent.futures
+import numpy as np
+
+#Pairwise RMSDs between trajectory frames, computed from a block of
+#coordinates with matrix products instead of one function call per pair. For
+#frames flattened to vectors a and b, |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, so a
+#tile of the RMSD matrix is one GEMM plus the frames' squared norms. Frames
+#are only read a tile at a time, and the matrix can be written to a memory
+#mapped file, so neither has to fit in memory.
+
+def open_memmap(fname, shape, dtype=np.float32):
+    '''
+    Create a .npy file of the given shape and return it memory mapped, for
+    arrays too big for memory; it can be reopened with np.load(fname,
+    mmap_mode='r')
+    '''
+    return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+            shape=shape)
+
+def load_coords(universe, selection, step=1, dtype=np.float32, fname=None):
+    '''
+    Read the positions of selection, an MDAnalysis AtomGroup in universe, at
+    every step-th frame into an (F, N, 3) array, memory mapped to fname if
+    given
+    '''
+    nframes = len(range(0, universe.trajectory.n_frames, step))
+    shape = (nframes, selection.n_atoms, 3)
+    if fname:
+        coords = open_memmap(fname, shape, dtype)
+    else:
+        coords = np.empty(shape, dtype=dtype)
+    for i,ts in enumerate(universe.trajectory[::step]):
+        coords[i] = selection.positions
+    return coords
+
+def tiles(nframes, tile):
+    '''
+    Return the (start, stop) bounds of consecutive tiles covering nframes
+    '''
+    return [(start, min(start + tile, nframes)) for start in range(0,
+        nframes, tile)]
+
+def inner_products(a, b):
+    '''
+    Return the 3x3 matrices a_i^T b_j for every pair of frames in a (n, N,
+    3) and b (m, N, 3), as an (n, m, 3, 3) array, computed as one GEMM
+    '''
+    n,natoms = a.shape[:2]
+    m = len(b)
+    products = a.transpose(0, 2, 1).reshape(n * 3, natoms).dot(
+            b.transpose(1, 0, 2).reshape(natoms, m * 3))
+    return products.reshape(n, 3, m, 3).transpose(0, 2, 1, 3)
+
+def qcp_rmsd(M, G1, G2, natoms, precision=1e-11, iterations=50):
+    '''
+    Return the RMSDs after optimal superposition of pairs of centered frames
+    a and b, given their inner product matrices M = a^T b, (..., 3, 3), and
+    squared norms G1 and G2 (broadcastable to M's leading shape). Uses
+    Theobald's quaternion characteristic polynomial (QCP) method: the
+    largest eigenvalue of the 4x4 key matrix is found by Newton's method on
+    its characteristic polynomial, for every pair at once
+    '''
+    M = np.asarray(M, dtype=np.float64)
+    Sxx, Sxy, Sxz = M[...,0,0], M[...,0,1], M[...,0,2]
+    Syx, Syy, Syz = M[...,1,0], M[...,1,1], M[...,1,2]
+    Szx, Szy, Szz = M[...,2,0], M[...,2,1], M[...,2,2]
+    Sxx2, Syy2, Szz2 = Sxx**2, Syy**2, Szz**2
+    Sxy2, Syz2, Sxz2 = Sxy**2, Syz**2, Sxz**2
+    Syx2, Szy2, Szx2 = Syx**2, Szy**2, Szx**2
+
+    SyzSzymSyySzz2 = 2 * (Syz * Szy - Syy * Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+    C2 = -2 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    C1 = 8 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx - Sxx * Syy
+            * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz)
+    SxzpSzx, SyzpSzy, SxypSyx = Sxz + Szx, Syz + Szy, Sxy + Syx
+    SyzmSzy, SxzmSzx, SxymSyx = Syz - Szy, Sxz - Szx, Sxy - Syx
+    SxxpSyy, SxxmSyy = Sxx + Syy, Sxx - Syy
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+    C0 = (Sxy2Sxz2Syx2Szx2**2
+        + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 -
+            SyzSzymSyySzz2)
+        + (-SxzpSzx * SyzmSzy + SxymSyx * (SxxmSyy - Szz)) * (-SxzmSzx *
+            SyzpSzy + SxymSyx * (SxxmSyy + Szz))
+        + (-SxzpSzx * SyzpSzy - SxypSyx * (SxxpSyy - Szz)) * (-SxzmSzx *
+            SyzmSzy - SxypSyx * (SxxpSyy + Szz))
+        + (SxypSyx * SyzpSzy + SxzpSzx * (SxxmSyy + Szz)) * (-SxymSyx *
+            SyzmSzy + SxzpSzx * (SxxpSyy + Szz))
+        + (SxypSyx * SyzmSzy + SxzmSzx * (SxxmSyy - Szz)) * (-SxymSyx *
+            SyzpSzy + SxzmSzx * (SxxpSyy - Szz)))
+
+    #the largest root is at most E0, and Newton's method from there converges
+    #to it monotonically
+    E0 = np.broadcast_to((np.asarray(G1) + np.asarray(G2)) / 2,
+            C0.shape).astype(np.float64)
+    eigenvalue = E0.copy()
+    for _ in range(iterations):
+        x2 = eigenvalue**2
+        b = (x2 + C2) * eigenvalue
+        a = b + C1
+        denominator = 2 * x2 * eigenvalue + b + a
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = np.where(denominator != 0, (a * eigenvalue + C0) /
+                    denominator, 0)
+        eigenvalue -= delta
+        if (np.abs(delta) <= np.abs(precision * eigenvalue)).all():
+            break
+    return np.sqrt(np.maximum(2 * (E0 - eigenvalue), 0) / natoms)
+
+class RMSDBlock:
+    '''
+    Frames flattened to vectors, ready for pairwise RMSDs.
+
+    Attributes:
+        coords: The (F, N, 3) frames.
+
+        superpose: Whether RMSDs are minimized over rotations and
+        translations; if so every frame is centered on its own centroid.
+
+        center: Otherwise, a point subtracted from every atom before taking
+        products; it changes no RMSD but keeps the squared norms small, which
+        matters for precision in float32.
+
+        norms: Squared norm of each centered frame, in float64.
+    '''
+    def __init__(self, coords, tile=512, superpose=False):
+        self.coords = coords
+        self.superpose = superpose
+        self.nframes, self.natoms = coords.shape[:2]
+        #QCP takes a small difference of large sums, which float32 products
+        #can't resolve for near-identical frames
+        self.dtype = np.float32 if coords.dtype == np.float32 and not \
+                superpose else np.float64
+        self.center = np.zeros(3)
+        if not superpose:
+            for start,stop in tiles(self.nframes, tile):
+                self.center += coords[start:stop].sum(axis=(0, 1),
+                        dtype=np.float64)
+            self.center /= max(self.nframes * self.natoms, 1)
+        self.norms = np.empty(self.nframes)
+        for start,stop in tiles(self.nframes, tile):
+            flat = self.flat(start, stop)
+            self.norms[start:stop] = np.einsum('ij,ij->i', flat, flat,
+                    dtype=np.float64)
+
+    def flat(self, start, stop):
+        '''
+        Return frames start to stop, centered and flattened to (n, 3N)
+        '''
+        frames = np.asarray(self.coords[start:stop])
+        if self.superpose:
+            center = frames.mean(axis=1, keepdims=True, dtype=np.float64)
+        else:
+            center = self.center
+        return (frames - center).astype(self.dtype, copy=False).reshape(
+                stop - start, -1)
+
+    def rmsd(self, rows, cols):
+        '''
+        Return the RMSDs between frames in the ranges rows and cols, each a
+        (start, stop) pair, as a float64 array
+        '''
+        a = self.flat(*rows)
+        b = self.flat(*cols)
+        if self.superpose:
+            return qcp_rmsd(inner_products(a.reshape(len(a), self.natoms, 3),
+                b.reshape(len(b), self.natoms, 3)), self.norms[rows[0]:rows[1],
+                    None], self.norms[None,cols[0]:cols[1]], self.natoms)
+        d2 = self.norms[rows[0]:rows[1],None] + self.norms[None,
+                cols[0]:cols[1]] - 2 * a.dot(b.T)
+        np.maximum(d2, 0, out=d2)
+        return np.sqrt(d2 / self.natoms)
+
+def rmsd_to(coords, ref, superpose=False, tile=512):
+    '''
+    Return the RMSD of every frame in coords, an (F, N, 3) array, to the
+    (N, 3) coordinates ref, minimized over rotations and translations if
+    superpose
+    '''
+    ref = np.asarray(ref, dtype=np.float64)
+    if superpose:
+        ref = ref - ref.mean(axis=0)
+    out = np.empty(len(coords))
+    for start,stop in tiles(len(coords), tile):
+        frames = np.asarray(coords[start:stop], dtype=np.float64)
+        if superpose:
+            frames = frames - frames.mean(axis=1, keepdims=True)
+            M = frames.transpose(0, 2, 1).reshape(-1, len(ref)).dot(ref)
+            out[start:stop] = qcp_rmsd(M.reshape(-1, 3, 3), np.einsum(
+                'ijk,ijk->i', frames, frames), (ref**2).sum(), len(ref))
+        else:
+            out[start:stop] = np.sqrt(((frames - ref)**2).sum(axis=2).mean(
+                axis=1))
+    return out
+
+def rmsd(a, b, superpose=False):
+    '''
+    Return the RMSD between two (N, 3) sets of coordinates, minimized over
+    rotations and translations if superpose
+    '''
+    return rmsd_to(np.asarray(a)[None], b, superpose)[0]
+
+def tiled_rmsd(coords, out=None, cutoff=None, tile=512, threads=1,
+        superpose=False):
+    '''
+    Compute the RMSDs between every pair of frames in coords, an (F, N, 3)
+    array; without superpose they're the plain RMSDs of MDAnalysis's rmsd,
+    which assume the frames are already aligned, with it they're minimized
+    over rotations and translations.
+    Only the upper triangle is computed, tile by tile; each tile is written
+    to out, an (F, F) array or memmap, and its mirror image, if out is given.
+    With threads > 1 tiles are computed concurrently, which helps when the
+    BLAS is single-threaded. Returns the number of frames within cutoff of
+    each frame (itself included) if cutoff is given, otherwise None
+    '''
+    block = RMSDBlock(coords, tile, superpose)
+    counts = np.zeros(block.nframes, dtype=np.int64) if cutoff is not None \
+            else None
+    bounds = tiles(block.nframes, tile)
+    pairs = [(rows, cols) for i,rows in enumerate(bounds) for cols in
+            bounds[i:]]
+
+    def fill(pair):
+        rows,cols = pair
+        values = block.rmsd(rows, cols)
+        if rows == cols:
+            np.fill_diagonal(values, 0)
+        if out is not None:
+            out[rows[0]:rows[1], cols[0]:cols[1]] = values
+            out[cols[0]:cols[1], rows[0]:rows[1]] = values.T
+        if cutoff is None:
+            return pair, None, None
+        within = values < cutoff
+        return pair, within.sum(axis=1), within.sum(axis=0)
+
+    def tally(results):
+        for (rows,cols),row_counts,col_counts in results:
+            if counts is not None:
+                counts[rows[0]:rows[1]] += row_counts
+                if rows != cols:
+                    counts[cols[0]:cols[1]] += col_counts
+
+    if threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            tally(pool.map(fill, pairs))
+    else:
+        tally(map(fill, pairs))
+    if isinstance(out, np.memmap):
+        out.flush()
+    return counts
+
+def rmsd_matrix(coords, tile=512, threads=1, fname=None, superpose=False):
+    '''
+    Return the symmetric (F, F) float32 matrix of RMSDs between every pair of
+    frames in coords; see tiled_rmsd. If fname is given the matrix is a
+    memmap of that .npy file rather than held in memory
+    '''
+    nframes = len(coords)
+    if fname:
+        out = open_memmap(fname, (nframes, nframes))
+    else:
+        out = np.zeros((nframes, nframes), dtype=np.float32)
+    tiled_rmsd(coords, out, None, tile, threads, superpose)
+    return out
+
+class FarthestPoints:
+    '''
+    Farthest-point sampling of frames: each frame added is the one farthest
+    from every frame already picked. Each frame's RMSD to its nearest pick is
+    kept up to date, so adding a frame costs one pass of RMSDs to it, and
+    so is which pick that is, so the picks' clusters come for free.
+
+    Attributes:
+        coords: The (F, N, 3) frames.
+
+        superpose: Whether RMSDs are minimized over rotations and
+        translations.
+
+        centers: Indices of the frames picked so far, in order.
+
+        distances: Each frame's RMSD to the nearest center.
+
+        assignments: Index in centers of each frame's nearest center (the
+        earliest, if several are equally near).
+    '''
+    def __init__(self, coords, superpose=False, tile=512):
+        self.coords = coords
+        self.superpose = superpose
+        self.tile = tile
+        self.centers = []
+        self.distances = np.full(len(coords), np.inf)
+        self.assignments = np.zeros(len(coords), dtype=np.int64)
+
+    def add(self, frame):
+        '''
+        Make frame a center
+        '''
+        distances = rmsd_to(self.coords, self.coords[frame], self.superpose,
+                self.tile)
+        closer = distances < self.distances
+        self.assignments[closer] = len(self.centers)
+        self.distances[closer] = distances[closer]
+        self.centers.append(frame)
+
+    def farthest(self):
+        '''
+        Return the frame farthest from every center (the first, if several
+        are equally far)
+        '''
+        return int(np.argmax(self.distances))
+
+    def add_farthest(self):
+        '''
+        Make the farthest frame a center and return it
+        '''
+        frame = self.farthest()
+        self.add(frame)
+        return frame
+
+    def cluster_sizes(self):
+        '''
+        Return the number of frames nearest each center
+        '''
+        return np.bincount(self.assignments, minlength=len(self.centers))
+
+    def cluster_radii(self):
+        '''
+        Return the largest RMSD of a frame to the center it's nearest
+        '''
+        radii = np.zeros(len(self.centers))
+        np.maximum.at(radii, self.assignments, self.distances)
+        return radii
+
+    def save(self, fname):
+        '''
+        Write each frame's nearest center (as a frame number and an index in
+        centers) and its RMSD to it, as a .npz of arrays or as CSV, by
+        extension
+        '''
+        centers = np.array(self.centers, dtype=np.int64)
+        if fname.endswith('.npz'):
+            np.savez(fname, centers=centers, assignments=self.assignments,
+                    distances=self.distances)
+        else:
+            with open(fname, 'w') as f:
+                f.write('frame,center,cluster,rmsd\n')
+                for frame,(cluster,distance) in enumerate(zip(
+                    self.assignments, self.distances)):
+                    f.write('%d,%d,%d,%.4f\n' %(frame, centers[cluster],
+                        cluster, distance))
+
+def farthest_point_sampling(coords, size, first=0, superpose=False,
+        tile=512):
+    '''
+    Pick size frames of coords that are far apart, starting from first.
+    Returns the FarthestPoints state
+    '''
+    sampler = FarthestPoints(coords, superpose, tile)
+    sampler.add(first)
+    for _ in range(size - 1):
+        sampler.add_farthest()
+    return sampler
@@ -1,9 +1,113 @@
 #!/usr/bin/python
 import pdb_util as util
-from copy import deepcopy
+import pdb_arrays
+from pdb_arrays import ArrayData
+from copy import copy, deepcopy
+import numpy as np
 import os, itertools
 import collections
 
+class ResidueIndex:
+    '''
+    Constant-time residue lookups for a simplepdb, built in one pass over its
+    atoms.
+
+    Attributes:
+        residues: Maps (resnum, rescode) to the indices of the residue's atoms
+        in first-seen order, as a range when they are contiguous and a list
+        otherwise.
+
+        resnums, resnames, chains: Map a residue number, residue name or chain
+        ID to the (resnum, rescode) keys of the residues having it, as an
+        insertion-ordered dict used as a set.
+
+        ters: Set of TERs, as strings.
+
+        natoms: Number of atoms indexed.
+    '''
+    key_fields = ('resnum', 'rescode', 'resname', 'chainid')
+
+    def __init__(self, mol_data, ters):
+        self.residues = {}
+        self.resnums = {}
+        self.resnames = {}
+        self.chains = {}
+        self.ters = set(str(ter) for ter in ters)
+        self.natoms = 0
+        self.add_atoms(mol_data)
+
+    def add_atoms(self, mol_data):
+        '''
+        Index the atoms of mol_data past the ones already indexed, i.e. those
+        appended since the index was built
+        '''
+        #split the new atoms into runs that agree on every key field
+        if isinstance(mol_data, ArrayData):
+            arrays = [mol_data.array(field)[self.natoms:] for field in
+                    self.key_fields]
+            changed = np.zeros(max(len(arrays[0]) - 1, 0), dtype=bool)
+            for arr in arrays:
+                changed |= arr[1:] != arr[:-1]
+            starts = np.flatnonzero(np.r_[True, changed]) if len(arrays[0]) \
+                    else np.zeros(0, dtype=int)
+            runs = list(zip(*[pdb_arrays.to_list(field, arr[starts]) for
+                field,arr in zip(self.key_fields, arrays)]))
+            starts = (starts + self.natoms).tolist()
+        else:
+            starts = []
+            runs = []
+            for i,run in enumerate(zip(*[mol_data[field][self.natoms:] for
+                field in self.key_fields])):
+                if not runs or run != runs[-1]:
+                    starts.append(i + self.natoms)
+                    runs.append(run)
+        natoms = len(mol_data['resnum'])
+        for start,stop,run in zip(starts, starts[1:] + [natoms], runs):
+            resnum,rescode,resname,chain = run
+            key = (resnum, rescode)
+            atoms = self.residues.get(key)
+            if atoms is None:
+                self.residues[key] = range(start, stop)
+            elif isinstance(atoms, range) and atoms.stop == start:
+                self.residues[key] = range(atoms.start, stop)
+            else:
+                self.residues[key] = list(atoms) + list(range(start, stop))
+            self.resnums.setdefault(resnum, {})[key] = None
+            self.resnames.setdefault(resname, {})[key] = None
+            self.chains.setdefault(chain, {})[key] = None
+        self.natoms = natoms
+
+    def residue_atoms(self, resnum, rescode=''):
+        '''
+        Return the indices of the atoms in residue resnum with insertion code
+        rescode
+        '''
+        return self.residues.get((resnum, rescode), [])
+
+    def lookup(self, field, value):
+        '''
+        Return the sorted indices of the atoms in residues with at least one
+        atom whose field equals value, or None if field isn't indexed
+        '''
+        if field == 'resnum':
+            keys = self.resnums.get(value, ())
+        elif field == 'resname':
+            keys = self.resnames.get(value, ())
+        elif field == 'chainid':
+            keys = self.chains.get(value, ())
+        else:
+            return None
+        atoms = []
+        for key in keys:
+            atoms.extend(self.residues[key])
+        return sorted(atoms)
+
+    def is_ter(self, resnum, rescode=''):
+        '''
+        Returns true if there is a TER after residue resnum
+        '''
+        return str(resnum) + rescode in self.ters
+
 class simplepdb:
     '''
     Parses and writes PDB files, and exposes limited functionality for
@@ -11,68 +115,114 @@ class simplepdb:
     manipulations required for setting up MD simulations. 
 
     Attributes:
-        mol_data: Dictionary of PDB column names and their values.
+        mol_data: Dictionary of PDB column names and their values. By default
+        the values are lists; with backend='array' mol_data is a
+        pdb_arrays.ArrayData holding NumPy columns, which still hands back
+        list-like views when indexed by column name. With lazy=True the file
+        is memory-mapped and each column is only decoded when first used.
 
         ters : Locations of breaks in the molecule, per the input PDB or
         resulting from simple operations such as merging molecules. Specified
         as a list of residues that appear immediately _before_ a break.
 
-        connect: Connect records for the molecule. Format is a dictionary where
-        the keys are the atoms that were found in the input connect record and
-        the values are the list of atoms to which they were bonded (per that
-        record). 
+        connect: Connect records for the molecule, as a
+        pdb_arrays.ConnectGraph. It reads like a dictionary where the keys are
+        the atoms that were found in the input connect record and the values
+        are the list of atoms to which they were bonded (per that record),
+        and answers neighbors() queries in both directions.
 
         natoms: Number of atoms in molecule(s).
+
+        index: ResidueIndex used for residue lookups, built on first use by
+        get_index. Methods that add, remove or reorder atoms keep it up to
+        date or reset it to None; anything else that edits the residue fields
+        of mol_data directly should reset it too.
     '''
-    def __init__(self, other):
+    def __init__(self, other, backend=None, lazy=False):
         '''
         Return a simplepdb object created by parsing an input PDB file or
         copying the contents of another object.
         Can't construct an object without such input because no utilities are 
         provided that could be used to construct a reasonable molecule.
-        '''
+        backend is 'list' or 'array' and selects how mol_data is stored; a
+        copy keeps the backend of the original unless one is given. lazy
+        memory-maps an input file instead of reading it, and implies the
+        array backend.
+        '''
+        assert backend in (None, 'list', 'array'), 'Unknown backend %s\n' % backend
+        assert not (lazy and backend == 'list'), 'Lazy loading requires the \
+        array backend\n'
+        self.index = None
         if isinstance(other, self.__class__):
             for k,v in other.__dict__.items():
-                setattr(self, k, deepcopy(v))
+                if k != 'index':
+                    setattr(self, k, deepcopy(v))
         else:
             assert os.path.isfile(other), 'simplepdb constructor requires \
             input PDB or object of the same type.\n'
             assert 'pdb' in os.path.splitext(other)[-1], 'Not a PDB file.\n'
-            self.mol_data = self.parse_pdb(other)
-            self.ters,self.connect = self.get_ters_and_connect(other)
-            self.natoms = len(self.mol_data['atomnum'])
+            self.mol_data,self.ters,self.connect = pdb_arrays.parse_pdb(other,
+                    lazy)
+            self.natoms = self.mol_data.natoms
             if self.natoms == 0:
                 print("WARNING: no atoms in molecule.\n")
+            if not backend:
+                backend = 'array' if lazy else 'list'
+        if backend == 'array':
+            self.to_arrays()
+        elif backend == 'list':
+            self.to_lists()
 
     def __eq__(self, other):
         '''
         Check equality of simplepdb objects based on the values of their fields
         '''
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self.fields() == other.fields()
         return NotImplemented
 
+    def fields(self):
+        '''
+        Return the attributes that define the molecule, i.e. everything but
+        the residue index
+        '''
+        return {k: v for k,v in self.__dict__.items() if k != 'index'}
+
+    def get_index(self):
+        '''
+        Return the ResidueIndex for the molecule, building it if necessary
+        '''
+        if self.index is None or self.index.natoms != self.natoms:
+            self.index = ResidueIndex(self.mol_data, self.ters)
+        return self.index
+
+    def is_array_backed(self):
+        '''
+        Returns true if mol_data is stored as NumPy columns
+        '''
+        return isinstance(self.mol_data, ArrayData)
+
+    def to_arrays(self):
+        '''
+        Switch mol_data to columnar NumPy storage
+        '''
+        if not self.is_array_backed():
+            self.mol_data = ArrayData.from_lists(self.mol_data)
+
+    def to_lists(self):
+        '''
+        Switch mol_data back to a dictionary of lists
+        '''
+        if self.is_array_backed():
+            self.mol_data = self.mol_data.to_lists()
+
     def parse_pdb(self, pdb):
         '''
         Return a dictionary of PDB column names and their values for ATOM and
         HETATM records in the provided PDB file
         '''
-        #TODO: deal with multiple models
-        parse = util.make_parser(util.pdb_fieldwidths)
-        f = open(pdb, 'r')
-        mol_data_list = [parse(line) for line in f if line.startswith('HETATM') or line.startswith('ATOM')]
-        f.close()
-        mol_data = {}
-        for i,field in enumerate(util.pdb_fieldnames):
-            if i in util.pdb_floatfields:
-                fieldlist = [float(line[i]) if line[i].strip() else line[i] for
-                        line in mol_data_list]
-            elif i in util.pdb_intfields:
-                fieldlist = [int(line[i]) if line[i].strip() else line[i] for
-                        line in mol_data_list]
-            else:
-                fieldlist = [line[i].strip() for line in mol_data_list]
-            mol_data[field] = fieldlist
+        #only the first MODEL of a multi-model file is read, see iter_models
+        mol_data = pdb_arrays.parse_pdb(pdb)[0].to_lists()
         if not mol_data['element']:
             self.set_element(mol_data)
         return mol_data
@@ -81,31 +231,7 @@ class simplepdb:
         '''
         Returns a list of breaks in a PDB file and a dictionary of CONECT records
         '''
-        ters = []
-        connect = collections.OrderedDict()
-        last_line = ''
-        parse = util.make_parser(util.pdb_connectfields)
-        with open (pdb,'r') as f:
-            for line in f:
-                if line.startswith('TER'):
-                    #this includes the insertion code, if applicable, so the
-                    #ters have to be strings rather than ints
-                    ters.append(last_line[22:27].strip())
-                elif line.startswith('CONECT'):
-                    contents = parse(line)
-                    atom = int(contents[1])
-                    bonds = [int(bond) for bond in contents[2:] if
-                            bond.strip()]
-                    if atom not in connect:
-                        connect[atom] = bonds
-                    else:
-                        connect[atom] = connect[atom] + bonds
-                elif line.startswith('ATOM') or line.startswith('HETATM'):
-                    last_line = line
-        ter = last_line[22:27].strip()
-        if ter and not ter in ters:
-            ters.append(ter)
-        return ters,connect
+        return pdb_arrays.parse_pdb(pdb)[1:]
 
     def get_res_info(self, field_dict):
         '''
@@ -113,27 +239,55 @@ class simplepdb:
         residues whose field value matches the passed-in value
         '''
         info = []
-        resnums = []
+        index = self.get_index()
+        if self.is_array_backed():
+            matched = [np.zeros(0, dtype=np.intp)]
+            for key,value in field_dict.items():
+                assert key in list(self.mol_data.keys()), 'Invalid residue identifier\n'
+                atoms = index.lookup(key, value)
+                if atoms is None:
+                    matched.append(np.flatnonzero(self.mol_data.matches(key, value)))
+                else:
+                    atoms = np.array(atoms, dtype=np.intp)
+                    matched.append(atoms[self.mol_data.matches(key, value, atoms)])
+            selected = self.mol_data.take(np.unique(np.concatenate(matched)))
+            _,first,inverse = np.unique(selected.array('resnum'),
+                    return_index=True, return_inverse=True)
+            #group atoms by residue, with residues in first-seen order
+            rank = np.argsort(np.argsort(first))[inverse]
+            order = np.argsort(rank, kind='stable')
+            bounds = [0] + (np.flatnonzero(np.diff(rank[order])) + 1).tolist()
+            grouped = selected.take(order).to_lists()
+            for start,stop in zip(bounds, bounds[1:] + [len(order)]):
+                if stop > start:
+                    info.append({field: values[start:stop] for field,values in
+                        grouped.items()})
+            return info
+        positions = {}
         for key,value in field_dict.items():
             assert key in list(self.mol_data.keys()), 'Invalid residue identifier\n'
-            indices = [i for i,e in enumerate(self.mol_data[key]) if e==value]
-            for index in indices:
-                resnum = self.mol_data['resnum'][index]
-                if resnum not in resnums:
-                    resnums.append(resnum)
-                    info.append({})
-                    for key in list(self.mol_data.keys()):
-                        info[-1][key] = [self.mol_data[key][index]]
-                else:
-                    res_index = resnums.index(resnum)
-                    for key in list(self.mol_data.keys()):
-                        info[res_index][key].append(self.mol_data[key][index])
+            atoms = index.lookup(key, value)
+            if atoms is None:
+                atoms = range(self.natoms)
+            column = self.mol_data[key]
+            for atom in atoms:
+                if column[atom] != value:
+                    continue
+                resnum = self.mol_data['resnum'][atom]
+                if resnum not in positions:
+                    positions[resnum] = len(info)
+                    info.append({field: [] for field in self.mol_data})
+                res = info[positions[resnum]]
+                for field in self.mol_data:
+                    res[field].append(self.mol_data[field][atom])
         return info
 
     def get_center(self):
         '''
         Returns location of center
         '''
+        if self.is_array_backed():
+            return self.mol_data.coords.mean(axis=0).tolist()
         center = [0,0,0]
         center[0] = sum(self.mol_data['x']) / self.natoms
         center[1] = sum(self.mol_data['y']) / self.natoms
@@ -145,12 +299,17 @@ class simplepdb:
         Translates molecule to new origin
         '''
         assert len(loc)==3,"Center is not three dimensional"
+        if self.is_array_backed():
+            self.mol_data.coords -= np.asarray(loc, dtype=np.float64)
+            return
         self.mol_data['x'] = [x - loc[0] for x in self.mol_data['x']]
         self.mol_data['y'] = [y - loc[1] for y in self.mol_data['y']]
         self.mol_data['z'] = [z - loc[2] for z in self.mol_data['z']]
 
     def add_ter(self, ter):
         self.ters.append(ter)
+        if self.index is not None:
+            self.index.ters.add(str(ter))
 
     def add_residue(self, res_info, ignore_resnum=True):
         '''
@@ -159,20 +318,37 @@ class simplepdb:
         number and just sticking it at the end
         '''
         assert len(set(res_info['resnum'])) == 1, 'Different residue numbers in putative residue\n'
-        if ignore_resnum:
-            res_info['resnum'] = [max(self.mol_data['resnum']) + 1] * len(res_info['resnum'])
+        if self.is_array_backed():
+            resnums = self.mol_data.array('resnum')
+            if ignore_resnum:
+                res_info['resnum'] = [int(resnums.max()) + 1] * len(res_info['resnum'])
+            else:
+                assert res_info['resnum'][0] > 0, 'Residue numbers must be positive integers\n'
+                assert res_info['resnum'][0] not in self.get_index().resnums, 'Residue number %d already exists\n' %res_info['resnum'][0]
+            self.mol_data.extend(res_info)
         else:
-            assert res_info['resnum'][0] > 0, 'Residue numbers must be positive integers\n'
-            assert res_info['resnum'][0] not in self.mol_data['resnum'], 'Residue number %d already exists\n' %res_info['resnum'][0]
-        for key,value in self.mol_data.items():
-            value += res_info[key]
+            if ignore_resnum:
+                res_info['resnum'] = [max(self.mol_data['resnum']) + 1] * len(res_info['resnum'])
+            else:
+                assert res_info['resnum'][0] > 0, 'Residue numbers must be positive integers\n'
+                assert res_info['resnum'][0] not in self.get_index().resnums, 'Residue number %d already exists\n' %res_info['resnum'][0]
+            for key,value in self.mol_data.items():
+                value += res_info[key]
         self.natoms += len(res_info['resnum'])
+        if self.index is not None:
+            self.index.add_atoms(self.mol_data)
 
     def group_by_residue(self):
         '''
         Rearrange atoms in a file so that atoms in the same residue are
-        contiguous and orders residues monotonically by resnum
+        contiguous and orders residues monotonically by resnum. Atoms keep
+        their atom numbers, so CONECT records remain valid.
         '''
+        if self.is_array_backed():
+            order = np.argsort(self.mol_data.array('resnum'), kind='stable')
+            self.mol_data = self.mol_data.take(order)
+            self.index = None
+            return
         unsorted_resmap = {}
         for old_idx in range(self.natoms):
             resnum = self.mol_data['resnum'][old_idx]
@@ -185,54 +361,41 @@ class simplepdb:
         new_mol_data = {}
         for key in self.mol_data:
             new_mol_data[key] = [self.mol_data[key][i] for i in new_indices]
-
-        self.renumber_atoms()
         self.mol_data = new_mol_data
+        self.index = None
     
     def renumber_atoms(self, start_val=1):
         '''
         Renumber atoms so they start at start_val
         '''
-        mapping = {}
-        for i in range(self.natoms):
-            old_val = self.mol_data['atomnum'][i]
-            new_val = i + start_val
-            self.mol_data['atomnum'][i] = new_val
-            mapping[old_val] = new_val
-
-        #TODO: ugly
-        new_connect = collections.OrderedDict()
-        for atom,bonds in list(self.connect.items()):
-            if atom in mapping:
-                new_connect[mapping[atom]] = bonds
-        
-        for atom,bonds in list(new_connect.items()):
-            for bond in bonds:
-                if bond in mapping:
-                    idx = bonds.index(bond)
-                    new_connect[atom][idx] = mapping[bond]
-
-        self.connect = new_connect
+        old_vals = pdb_arrays.to_array('atomnum', self.mol_data['atomnum'])
+        new_vals = np.arange(start_val, start_val + self.natoms)
+        if self.is_array_backed():
+            self.mol_data['atomnum'] = new_vals
+        else:
+            self.mol_data['atomnum'] = new_vals.tolist()
+        self.connect = self.connect.renumber(old_vals, new_vals)
     
     def renumber_residues(self, start_val=1):
         '''
         Renumber residues so they start at start_val in "first seen" order, desirable
         when there is a ligand at the end of data with an out-of-order resnum
         '''
-        reslist = []
-        for i,resnum in enumerate(self.mol_data['resnum']):
-            name = str(resnum)
-            if name not in reslist:
-                newidx = len(reslist)
-                reslist.append(name)
-            else:
-                newidx = reslist.index(name)
-            newnum = newidx + start_val
-            self.mol_data['resnum'][i] = newnum
-            insert_code = self.mol_data['rescode'][i]
-            if str(resnum) + insert_code in self.ters:
-                ter_idx = self.ters.index(str(resnum)+insert_code)
-                self.ters[ter_idx] = str(newnum) + insert_code
+        #new number for each residue number, and new name for each TER
+        renumbered = {}
+        renamed = {}
+        for resnum,code in self.get_index().residues:
+            newnum = renumbered.setdefault(resnum, len(renumbered) + start_val)
+            renamed.setdefault(str(resnum) + code, str(newnum) + code)
+        self.ters = [renamed.get(ter, ter) for ter in self.ters]
+        if self.is_array_backed():
+            _,first,inverse = np.unique(self.mol_data.array('resnum'),
+                    return_index=True, return_inverse=True)
+            self.mol_data['resnum'] = np.argsort(np.argsort(first))[inverse] + start_val
+        else:
+            self.mol_data['resnum'] = [renumbered[resnum] for resnum in
+                    self.mol_data['resnum']]
+        self.index = None
     
     def rename_atoms(self):
         '''
@@ -240,20 +403,18 @@ class simplepdb:
         '''
         if self.has_unique_names():
             return
-        for i,name in enumerate(self.mol_data['atomname']):
-            self.mol_data['atomname'][i] = ''.join([char for char in
-                    self.mol_data['element'][i]])
+        names = [''.join([char for char in element]) for element in
+                self.mol_data['element']]
         
         occurrences = {}
-        for i,atom in enumerate(self.mol_data['atomname']):
+        for i,atom in enumerate(names):
             if atom not in occurrences:
                 occurrences[atom] = [i,1]
             else:
                 occurrences[atom][1] += 1
-            self.mol_data['atomname'][i] += str(occurrences[atom][1])
-            self.mol_data['atomname'][i] = \
-            '{:>{}s}'.format(self.mol_data['atomname'][i],
+            names[i] = '{:>{}s}'.format(atom + str(occurrences[atom][1]),
                     util.pdb_fieldwidths[3])
+        self.mol_data['atomname'] = names
     
     def set_element(self, mol_data):
         '''
@@ -278,29 +439,133 @@ class simplepdb:
             self.set_element(self.mol_data)
             self.rename_atoms()
 
+    def get_elements(self):
+        '''
+        Return each atom's element symbol, capitalized like "Cl", taken from
+        the element field or, if that is blank, the first letter of the atom
+        name
+        '''
+        elements = []
+        for element,name in zip(self.mol_data['element'],
+                self.mol_data['atomname']):
+            element = element.strip() or ''.join(char for char in name if
+                    char.isalpha())[:1]
+            elements.append(element.capitalize())
+        return elements
+
+    def perceive_bonds(self, tolerance=0.45):
+        '''
+        Replace the CONECT records with bonds inferred from interatomic
+        distances and covalent radii, listing every bond in both directions
+        '''
+        pairs = util.find_bonds(util.get_coords(self), self.get_elements(),
+                tolerance)
+        atomnums = pdb_arrays.to_array('atomnum', self.mol_data['atomnum'])
+        first = np.r_[pairs[:,0], pairs[:,1]]
+        second = np.r_[pairs[:,1], pairs[:,0]]
+        order = np.lexsort((second, first))
+        self.connect = pdb_arrays.ConnectGraph.from_pairs(
+                atomnums[first[order]], atomnums[second[order]])
+
+    def get_formal_charge(self):
+        '''
+        Estimate the net formal charge of a molecule with explicit hydrogens
+        from its CONECT records, perceiving bonds first if there are none.
+        Returns None if it can't be determined, including for a molecule
+        without hydrogens; see pdb_util.estimate_formal_charge
+        '''
+        elements = self.get_elements()
+        if 'H' not in elements:
+            return None
+        if not len(self.connect):
+            self.perceive_bonds()
+        atomnums = pdb_arrays.to_array('atomnum', self.mol_data['atomnum'])
+        index = {atomnum: i for i,atomnum in enumerate(atomnums.tolist())}
+        neighbors = [[index[bonded] for bonded in
+            self.connect.neighbors(atomnum).tolist() if bonded in index] for
+            atomnum in atomnums.tolist()]
+        return util.estimate_formal_charge(elements, neighbors)
+
     def has_hydrogen(self):
         '''
         Returns true if hydrogens are present
         '''
+        if self.is_array_backed():
+            return bool((np.char.strip(self.mol_data.array('element')) == b'H').any())
         return 'H' in [elem.strip() for elem in self.mol_data['element']]
     
     def strip_hydrogen(self):
         '''
         Strip out all the hydrogens
         '''
-        h_indices = [i for i,elem in enumerate(self.mol_data['element']) if elem.strip() ==
-                'H']
-        new_mol_data = {}
-        for key in list(self.mol_data.keys()):
-            new_mol_data[key] = [self.mol_data[key][i] for i in
-                    range(len(self.mol_data[key])) if i not in h_indices]
-        self.mol_data = new_mol_data
+        if self.is_array_backed():
+            self.filter_atoms(np.char.strip(self.mol_data.array('element')) !=
+                    b'H')
+        else:
+            self.filter_atoms([elem.strip() != 'H' for elem in
+                self.mol_data['element']])
+
+    def select(self, atoms):
+        '''
+        Return a new simplepdb holding only the atoms selected by a boolean
+        mask or a predicate, see filter_atoms
+        '''
+        mol = copy(self)
+        mol.filter_atoms(atoms)
+        return mol
+
+    def filter_atoms(self, atoms):
+        '''
+        Keep only the atoms selected by atoms, which is either a boolean mask
+        with one entry per atom or a predicate called with a dict mapping
+        field names to an atom's values. CONECT records lose their bonds to
+        removed atoms, and a TER after a residue that was removed entirely
+        moves to the last remaining residue before it.
+        '''
+        if callable(atoms):
+            columns = self.mol_data.to_lists() if self.is_array_backed() else \
+                    self.mol_data
+            atoms = [bool(atoms(dict(zip(columns.keys(), values)))) for values
+                    in zip(*columns.values())]
+        mask = np.asarray(atoms, dtype=bool).reshape(-1)
+        assert len(mask) == self.natoms, 'Selection has %d entries for %d \
+        atoms\n' % (len(mask), self.natoms)
+
+        renamed = {}
+        last = None
+        for (resnum,code),res_atoms in self.get_index().residues.items():
+            name = str(resnum) + code
+            if mask[np.asarray(res_atoms)].any():
+                last = name
+            renamed[name] = last
+        ters = []
+        for ter in self.ters:
+            ter = renamed.get(str(ter), ter)
+            if ter is not None and ter not in ters:
+                ters.append(ter)
+
+        keep = np.flatnonzero(mask)
+        if self.is_array_backed():
+            self.mol_data = self.mol_data.take(keep)
+        else:
+            keep = keep.tolist()
+            self.mol_data = {key: [values[i] for i in keep] for key,values in
+                    self.mol_data.items()}
+        self.connect = self.connect.subgraph(pdb_arrays.to_array('atomnum',
+            self.mol_data['atomnum']))
+        self.ters = ters
+        self.natoms = len(keep)
+        self.index = None
     
     def is_protein(self, ff=''):
         '''
         Returns true if standard amino acid residues are present
         '''
-        aa = util.get_available_res(ff).intersection(self.mol_data['resname'])
+        if self.is_array_backed():
+            resnames = self.mol_data.unique('resname')
+        else:
+            resnames = self.mol_data['resname']
+        aa = util.get_available_res(ff).intersection(resnames)
         return len(aa) > 0
 
     def has_unique_names(self):
@@ -308,6 +573,11 @@ class simplepdb:
         Returns true if atom names are unique
         '''
         #TODO: add to tests
+        if self.is_array_backed():
+            atom_ids = np.char.add(self.mol_data.array('resnum').astype('S'),
+                    self.mol_data.array('atomname'))
+            _,counts = np.unique(atom_ids, return_counts=True)
+            return not (counts > 1).any()
         atom_ids = []
         for i in range(self.natoms):
             atom_ids.append(str(self.mol_data['resnum'][i]) +
@@ -327,9 +597,14 @@ class simplepdb:
         of "ATOM" and "HETATM"'
         if not resnum:
             self.mol_data['recordname'] = [newname] * self.natoms
+        elif self.is_array_backed():
+            names = self.mol_data.array('recordname').astype('S6')
+            names[self.mol_data.matches('resnum', resnum)] = newname.encode()
+            self.mol_data['recordname'] = names
         else:
-            self.mol_data['recordname'] = [newname for name in
-            self.mol_data['recordname'] if self.mol_data['resnum'] == resnum]
+            self.mol_data['recordname'] = [newname if num == resnum else name
+                    for name,num in zip(self.mol_data['recordname'],
+                        self.mol_data['resnum'])]
 
     def set_resname(self, newname, oldname=''):
         '''
@@ -339,9 +614,15 @@ class simplepdb:
         #TODO: add to tests
         if not oldname:
             self.mol_data['resname'] = [newname] * self.natoms
+        elif self.is_array_backed():
+            names = self.mol_data.array('resname')
+            names = names.astype('S%d' % max(names.dtype.itemsize, len(newname)))
+            names[self.mol_data.matches('resname', oldname)] = newname.encode()
+            self.mol_data['resname'] = names
         else:
-            self.mol_data['resname'] = [newname for name in
-            self.mol_data['resname'] if name == oldname]
+            self.mol_data['resname'] = [newname if name == oldname else name
+                    for name in self.mol_data['resname']]
+        self.index = None
 
     def writepdb(self, fname, mols=[]):
         '''
@@ -352,53 +633,38 @@ class simplepdb:
         if not mols:
             mols = [self]
 
-        with open(fname, 'w') as f:
-            start_atom = 1
-            start_res = 1
-            for mol in mols:
-                mol.renumber_atoms(start_atom)
-                mol.renumber_residues(start_res)
-                for i in range(mol.natoms):
-                    j = 0
-                    for fieldwidth in util.pdb_fieldwidths:
-                        if fieldwidth > 0:
-                            fieldname = util.pdb_fieldnames[j]
-                            if fieldname=='x' or fieldname=='y' or fieldname=='z':
-                                output='{:.3f}'.format(mol.mol_data[fieldname][i])
-                                f.write('{:>{}s}'.format(str(output),fieldwidth))
-                            elif fieldname=='occupancy' or fieldname=='beta' and \
-                            str(mol.mol_data[fieldname][i]).strip():
-                                output='{:.2f}'.format(mol.mol_data[fieldname][i])
-                                f.write('{:>{}s}'.format(str(output),fieldwidth))
-                            elif fieldname=='recordname':
-                                f.write('{:<{}s}'.format(str(mol.mol_data[fieldname][i]),fieldwidth))
-                            else:
-                                f.write('{:>{}s}'.format(str(mol.mol_data[fieldname][i]),fieldwidth))
-                            j += 1
-                        else:
-                            f.write('{:>{}s}'.format('',abs(fieldwidth)))
-                    f.write('\n')
-                    insert_code = mol.mol_data['rescode'][i]
-                    if (i == mol.natoms-1):
-                        f.write('TER\n')
-                    elif (str(mol.mol_data['resnum'][i])+insert_code in mol.ters and
-                    str(mol.mol_data['resnum'][i])+insert_code !=
-                    str(mol.mol_data['resnum'][i+1])+mol.mol_data['rescode'][i+1]):
-                        f.write('TER\n')
-                start_atom = mol.mol_data['atomnum'][-1]+1
-                start_res = mol.mol_data['resnum'][-1]+1
-
-            for mol in mols:
-                for atom,bonds in list(mol.connect.items()):
-                    bonds_seen = 0
-                    for bond in bonds:
-                        if not bonds_seen % 4:
-                            if bonds_seen: f.write('\n')
-                            f.write('CONECT')
-                            f.write('{:>{}s}'.format(str(atom),util.pdb_connectfields[1]))
-                        f.write('{:>{}s}'.format(str(bond),5)) 
-                        bonds_seen = bonds_seen + 1
-                    f.write('\n')
-
-            f.write('END\n')
+        chunks = []
+        start_atom = 1
+        start_res = 1
+        for mol in mols:
+            mol.renumber_atoms(start_atom)
+            mol.renumber_residues(start_res)
+            chunks.append(pdb_arrays.format_atoms(mol.mol_data, mol.ters))
+            start_atom = mol.mol_data['atomnum'][-1]+1
+            start_res = mol.mol_data['resnum'][-1]+1
 
+        for mol in mols:
+            chunks.append(pdb_arrays.format_connect(mol.connect))
+        chunks.append(b'END\n')
+
+        with open(fname, 'wb') as f:
+            f.write(b''.join(chunks))
+
+def iter_models(pdb):
+    '''
+    Generate a simplepdb for each MODEL of a multi-model (NMR ensemble or
+    trajectory) PDB file, reading the file one model at a time. The models
+    are array-backed and share the topology columns, TERs and CONECTs parsed
+    from the first model, each with its own coordinates, so memory use stays
+    flat however many models there are. Copy a model with simplepdb() before
+    changing anything other than its coordinates.
+    '''
+    assert os.path.isfile(pdb), 'iter_models requires an input PDB.\n'
+    for mol_data,ters,connect in pdb_arrays.iter_models(pdb):
+        mol = simplepdb.__new__(simplepdb)
+        mol.mol_data = mol_data
+        mol.ters = ters
+        mol.connect = connect
+        mol.natoms = mol_data.natoms
+        mol.index = None
+        yield mol
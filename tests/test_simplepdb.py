@@ -2,7 +2,23 @@
 import unittest
 import env
 import simplepdb as pdb
+import pdb_arrays
+import pdb_util as util
 import os
+import shutil
+import json
+import tempfile
+import time
+import csv
+import contextlib
+import param_cache
+import manifest
+import pipeline
+import md_engines
+import tool_runner
+import profiling
+import rmsd_engine
+import numpy as np
 from plumbum.cmd import awk, head, tail
 
 class IOTests(unittest.TestCase):
@@ -111,6 +127,13 @@ class IOTests(unittest.TestCase):
         out = [int(elem) if elem.strip() else elem for elem in out]
         self.assertEqual(self.pdb.mol_data['charge'], out[:-1])
 
+    def test_ters_and_connect(self):
+        structure = pdb.simplepdb('3EML.pdb')
+        self.assertEqual(structure.natoms, 3757)
+        self.assertEqual(structure.ters, ['310', '576'])
+        self.assertEqual(len(structure.connect), 168)
+        self.assertEqual(structure.connect[507], [1114])
+
     def test_write(self):
         fname = 'tmp.pdb'
         self.pdb.writepdb(fname)
@@ -146,6 +169,25 @@ class ActionTests(unittest.TestCase):
         self.assertEqual(badnumber.mol_data['resnum'],
         self.complex.mol_data['resnum'])
 
+    def test_select(self):
+        complex = pdb.simplepdb('3EML.pdb')
+        ligand = complex.select(lambda atom: atom['resname'] == 'ZMA')
+        self.assertEqual(ligand.natoms, 25)
+        self.assertEqual(set(ligand.mol_data['resname']), {'ZMA'})
+        self.assertEqual(complex.natoms, 3757)
+        atomnums = set(ligand.mol_data['atomnum'])
+        self.assertTrue(ligand.connect)
+        for atom,bonds in ligand.connect.items():
+            self.assertIn(atom, atomnums)
+            self.assertTrue(atomnums.issuperset(bonds))
+
+    def test_filter_atoms(self):
+        complex = pdb.simplepdb('3EML.pdb')
+        #dropping the residue before the first TER moves it back one residue
+        complex.filter_atoms([resnum != 310 for resnum in
+            complex.mol_data['resnum']])
+        self.assertEqual(complex.ters, ['309', '576'])
+
     def test_rename_atoms(self):
         ligand_h_copy = pdb.simplepdb(self.ligand_h)
         ligand_noh_copy = pdb.simplepdb(self.ligand_noh)
@@ -175,6 +217,931 @@ class ActionTests(unittest.TestCase):
         ligand_copy = pdb.simplepdb(self.ligand_h)
         ligand_copy.strip_hydrogen()
         self.assertFalse(ligand_copy.has_hydrogen())
+        self.assertEqual(ligand_copy.natoms, self.ligand_noh.natoms)
+        self.assertEqual(ligand_copy.natoms,
+                len(ligand_copy.mol_data['atomnum']))
+
+class ArrayBackendTests(unittest.TestCase):
+    '''
+    Tests that the NumPy-backed mol_data matches the list-based one.
+    '''
+    def setUp(self):
+        self.complex = pdb.simplepdb('LIGreceptor.pdb')
+        self.complex_array = pdb.simplepdb('LIGreceptor.pdb', backend='array')
+        self.ligand_h = pdb.simplepdb('LIG_h.pdb')
+        self.ligand_h_array = pdb.simplepdb('LIG_h.pdb', backend='array')
+
+    def test_mol_data(self):
+        self.assertTrue(self.complex_array.is_array_backed())
+        self.assertEqual(self.complex_array.mol_data, self.complex.mol_data)
+        self.assertEqual(self.complex_array.mol_data.coords.shape,
+                (self.complex.natoms, 3))
+
+    def test_to_lists(self):
+        copy = pdb.simplepdb(self.complex_array, backend='list')
+        self.assertFalse(copy.is_array_backed())
+        self.assertEqual(copy, self.complex)
+
+    def test_get_res_info(self):
+        self.assertEqual(self.complex_array.get_res_info({'resname': 'LIG'}),
+                self.complex.get_res_info({'resname': 'LIG'}))
+
+    def test_center(self):
+        center = self.complex.get_center()
+        self.complex_array.set_origin(center)
+        for val in self.complex_array.get_center():
+            self.assertAlmostEqual(val, 0)
+
+    def test_group_by_residue(self):
+        self.complex.group_by_residue()
+        self.complex_array.group_by_residue()
+        self.assertEqual(self.complex_array.mol_data, self.complex.mol_data)
+
+    def test_renumber_residues(self):
+        self.complex.renumber_residues()
+        self.complex_array.renumber_residues()
+        self.assertEqual(self.complex_array.mol_data['resnum'],
+                self.complex.mol_data['resnum'])
+        self.assertEqual(self.complex_array.ters, self.complex.ters)
+
+    def test_strip_hydrogen(self):
+        self.ligand_h.strip_hydrogen()
+        self.ligand_h_array.strip_hydrogen()
+        self.assertFalse(self.ligand_h_array.has_hydrogen())
+        self.assertEqual(self.ligand_h_array.mol_data, self.ligand_h.mol_data)
+
+    def test_write(self):
+        fname = 'tmp.pdb'
+        chignolin = pdb.simplepdb('chignolin.pdb', backend='array')
+        chignolin.writepdb(fname)
+        new_pdb = pdb.simplepdb(fname, backend='array')
+        os.remove(fname)
+        self.assertEqual(chignolin, new_pdb)
+
+    def test_write_matches_list(self):
+        receptor = pdb.simplepdb('receptor.pdb')
+        receptor_array = pdb.simplepdb('receptor.pdb', backend='array')
+        receptor.writepdb('tmp_list.pdb')
+        receptor_array.writepdb('tmp_array.pdb')
+        with open('tmp_list.pdb') as f1, open('tmp_array.pdb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        os.remove('tmp_list.pdb')
+        os.remove('tmp_array.pdb')
+
+class LazyLoadingTests(unittest.TestCase):
+    '''
+    Tests memory-mapped loading that decodes columns on demand.
+    '''
+    def setUp(self):
+        self.complex = pdb.simplepdb('3EML.pdb')
+        self.lazy = pdb.simplepdb('3EML.pdb', lazy=True)
+
+    def test_index_only(self):
+        self.assertEqual(self.lazy.natoms, self.complex.natoms)
+        self.assertEqual(self.lazy.ters, self.complex.ters)
+        self.assertEqual(self.lazy.connect, self.complex.connect)
+        for field in self.lazy.mol_data:
+            self.assertFalse(self.lazy.mol_data.is_decoded(field))
+
+    def test_decode_on_access(self):
+        self.assertTrue(self.lazy.is_protein())
+        self.assertTrue(self.lazy.mol_data.is_decoded('resname'))
+        self.assertFalse(self.lazy.mol_data.is_decoded('x'))
+        self.assertFalse(self.lazy.mol_data.is_decoded('beta'))
+
+    def test_get_res_info(self):
+        self.assertEqual(self.lazy.get_res_info({'resname': 'ZMA'}),
+                self.complex.get_res_info({'resname': 'ZMA'}))
+        self.assertFalse(self.lazy.mol_data.is_decoded('x'))
+
+    def test_mol_data(self):
+        self.assertEqual(self.lazy.mol_data, self.complex.mol_data)
+
+class MultiModelTests(unittest.TestCase):
+    '''
+    Tests reading MODEL/ENDMDL ensembles.
+    '''
+    def setUp(self):
+        with open('chignolin.pdb', 'r') as f:
+            atoms = [line for line in f if line.startswith(('ATOM', 'TER'))]
+        with open('tmp_models.pdb', 'w') as f:
+            for i in range(3):
+                f.write('MODEL     %4d\n' % (i+1))
+                for line in atoms:
+                    if line.startswith('ATOM'):
+                        line = line[:30] + '%8.3f' % (float(line[30:38]) + i) \
+                                + line[38:]
+                    f.write(line)
+                f.write('ENDMDL\n')
+            f.write('END\n')
+        self.pdb = pdb.simplepdb('chignolin.pdb')
+
+    def tearDown(self):
+        os.remove('tmp_models.pdb')
+
+    def test_first_model(self):
+        first = pdb.simplepdb('tmp_models.pdb')
+        self.assertEqual(first.natoms, self.pdb.natoms)
+        self.assertEqual(first.ters, self.pdb.ters)
+        self.assertEqual(first.mol_data['x'], self.pdb.mol_data['x'])
+
+    def test_iter_models(self):
+        models = list(pdb.iter_models('tmp_models.pdb'))
+        self.assertEqual(len(models), 3)
+        for i,model in enumerate(models):
+            self.assertEqual(model.natoms, self.pdb.natoms)
+            self.assertEqual(model.ters, self.pdb.ters)
+            self.assertEqual(model.mol_data['atomname'],
+                    self.pdb.mol_data['atomname'])
+            self.assertEqual([round(x-i, 3) for x in model.mol_data['x']],
+                    self.pdb.mol_data['x'])
+        #topology columns are shared rather than copied
+        self.assertIs(models[1].mol_data.array('atomname'),
+                models[0].mol_data.array('atomname'))
+
+    def test_single_model(self):
+        models = list(pdb.iter_models('chignolin.pdb'))
+        self.assertEqual(len(models), 1)
+        self.assertEqual(models[0].mol_data, pdb.simplepdb('chignolin.pdb',
+            backend='array').mol_data)
+
+class IndexTests(unittest.TestCase):
+    '''
+    Tests the residue index behind residue lookups.
+    '''
+    def setUp(self):
+        self.complex = pdb.simplepdb('LIGreceptor.pdb')
+        self.ligand = pdb.simplepdb('LIG_h.pdb')
+
+    def test_lookup(self):
+        index = self.complex.get_index()
+        resnum = self.complex.mol_data['resnum'][0]
+        atoms = [i for i,num in enumerate(self.complex.mol_data['resnum']) if
+                num == resnum]
+        self.assertEqual(list(index.residue_atoms(resnum)), atoms)
+        self.assertEqual(index.lookup('resnum', resnum), atoms)
+        self.assertEqual(index.lookup('resname', 'LIG'), [i for i,name in
+            enumerate(self.complex.mol_data['resname']) if name == 'LIG'])
+        self.assertIsNone(index.lookup('atomname', ' CA '))
+
+    def test_add_residue(self):
+        index = self.complex.get_index()
+        self.complex.add_residue(self.ligand.get_res_info({'resname':
+            'LIG'})[0])
+        self.assertIs(self.complex.get_index(), index)
+        self.assertEqual(len(self.complex.get_res_info({'resname': 'LIG'})),
+                2)
+        self.assertEqual(index.residues,
+                pdb.ResidueIndex(self.complex.mol_data,
+                    self.complex.ters).residues)
+
+    def test_invalidate(self):
+        self.complex.get_index()
+        self.complex.group_by_residue()
+        self.assertIsNone(self.complex.index)
+        self.ligand.get_index()
+        self.ligand.strip_hydrogen()
+        self.assertIsNone(self.ligand.index)
+
+    def test_equality(self):
+        copy = pdb.simplepdb(self.complex)
+        self.complex.get_index()
+        self.assertEqual(copy, self.complex)
+
+class ConnectTests(unittest.TestCase):
+    '''
+    Tests the CSR representation of CONECT records.
+    '''
+    def setUp(self):
+        self.complex = pdb.simplepdb('3EML.pdb')
+
+    def test_neighbors(self):
+        connect = self.complex.connect
+        self.assertEqual(connect.neighbors(507).tolist(), [1114])
+        self.assertIn(507, connect.neighbors(1114).tolist())
+        self.assertEqual(len(connect.neighbors(1)), 0)
+
+    def test_renumber_atoms(self):
+        graph = pdb_arrays.ConnectGraph.from_dict({1: [2, 2, 3], 3: [1]})
+        graph = graph.renumber([1, 2, 3], [10, 20, 30])
+        self.assertEqual(dict(graph), {10: [20, 20, 30], 30: [10]})
+
+    def test_write(self):
+        fname = 'tmp_connect.pdb'
+        self.complex.writepdb(fname)
+        written = pdb.simplepdb(fname)
+        os.remove(fname)
+        self.assertEqual(len(written.connect), len(self.complex.connect))
+        self.assertEqual(written.connect, self.complex.connect)
+
+class NeighborTests(unittest.TestCase):
+    '''
+    Tests the cell list neighbor search and code built on it.
+    '''
+    def setUp(self):
+        self.complex = pdb.simplepdb('3EML.pdb')
+
+    def test_pairs(self):
+        coords = util.get_coords(self.complex)[:300]
+        pairs = util.CellList(coords, 2.0).pairs()
+        expected = set()
+        for i in range(len(coords)):
+            for j in range(i+1, len(coords)):
+                if util.get_dist(coords[i], coords[j]) < 2.0:
+                    expected.add((i, j))
+        self.assertEqual(set(map(tuple, pairs.tolist())), expected)
+
+    def test_query(self):
+        coords = util.get_coords(self.complex)
+        found = util.CellList(coords, 4.0).query(coords[100], 3.0)
+        self.assertEqual(found.tolist(), [i for i in range(len(coords)) if
+            util.get_dist(coords[i], coords[100]) < 3.0])
+
+    def test_is_secret_peptide(self):
+        self.assertTrue(util.is_secret_peptide(self.complex))
+        self.assertFalse(util.is_secret_peptide(pdb.simplepdb('LIG_h.pdb')))
+
+class BondTests(unittest.TestCase):
+    '''
+    Tests distance-based bond perception and formal charge estimation.
+    '''
+    def test_perceive_bonds(self):
+        ligand = pdb.simplepdb('ZMA.pdb')
+        connect = {atom: sorted(bonds) for atom,bonds in
+                ligand.connect.items()}
+        ligand.perceive_bonds()
+        self.assertEqual(dict(ligand.connect), connect)
+
+    def test_formal_charge(self):
+        self.assertEqual(pdb.simplepdb('LIG_h.pdb').get_formal_charge(), 0)
+        #without hydrogens the valences are ambiguous
+        self.assertIsNone(pdb.simplepdb('LIG_noh.pdb').get_formal_charge())
+
+    def test_charged_groups(self):
+        #acetate and nitromethane, heavy atoms first
+        elements = ['C', 'C', 'O', 'O', 'H', 'H', 'H']
+        neighbors = [[1, 4, 5, 6], [0, 2, 3], [1], [1], [0], [0], [0]]
+        self.assertEqual(util.estimate_formal_charge(elements, neighbors), -1)
+        elements[1] = 'N'
+        self.assertEqual(util.estimate_formal_charge(elements, neighbors), 0)
+
+class CacheTests(unittest.TestCase):
+    '''
+    Tests the ligand parameter cache.
+    '''
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = param_cache.ParamCache(self.cache_dir, 2**20)
+        self.ligand = pdb.simplepdb('LIG_h.pdb')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def hydrogenate(self, carbons, bonds):
+        #add hydrogens to fill each carbon's valence of 4
+        elements = ['C'] * carbons
+        bonds = list(bonds)
+        for i in range(carbons):
+            for _ in range(4 - sum(i in bond for bond in bonds[:])):
+                bonds.append((i, len(elements)))
+                elements.append('H')
+        return elements, bonds
+
+    def test_isomorphic(self):
+        #decalin and bicyclopentyl, which 1-WL refinement can't tell apart
+        decalin = self.hydrogenate(10, [(0, 1), (1, 2), (2, 3), (3, 4), (4,
+            5), (5, 0), (5, 6), (6, 7), (7, 8), (8, 9), (9, 0)])
+        bicyclopentyl = self.hydrogenate(10, [(0, 1), (1, 2), (2, 3), (3, 4),
+            (4, 0), (0, 5), (5, 6), (6, 7), (7, 8), (8, 9), (9, 5)])
+        self.assertEqual(sorted(decalin[0]), sorted(bicyclopentyl[0]))
+        self.assertFalse(param_cache.isomorphic(decalin, bicyclopentyl))
+        #the same molecule with its atoms shuffled
+        order = list(np.random.default_rng(0).permutation(len(decalin[0])))
+        shuffled = ([decalin[0][i] for i in order], [(order.index(i),
+            order.index(j)) for i,j in decalin[1]])
+        self.assertTrue(param_cache.isomorphic(decalin, shuffled))
+
+    def write_mol2(self, fname, names, elements, bonds):
+        with open(fname, 'w') as f:
+            f.write('@<TRIPOS>MOLECULE\nLIG\n%d %d 1 0 0\nSMALL\nbcc\n\n' %
+                    (len(names), len(bonds)))
+            f.write('@<TRIPOS>ATOM\n')
+            for i,(name,element) in enumerate(zip(names, elements)):
+                f.write('%d %s 0.0 0.0 0.0 %s 1 LIG 0.0\n' %(i+1, name,
+                    element.lower()))
+            f.write('@<TRIPOS>BOND\n')
+            for i,(a,b) in enumerate(bonds):
+                f.write('%d %d %d 1\n' %(i+1, a+1, b+1))
+
+    def test_same_molecule(self):
+        names,elements,bonds = param_cache.bond_graph(self.ligand)
+        mol2 = os.path.join(self.cache_dir, 'LIG.mol2')
+        #atoms in reverse order, under the same names
+        n = len(names)
+        self.write_mol2(mol2, names[::-1], elements[::-1], [(n-1-i, n-1-j) for
+            i,j in bonds])
+        self.assertEqual(util.get_mol2_graph(mol2)[1], elements[::-1])
+        self.assertTrue(param_cache.same_molecule(self.ligand, mol2))
+        #a bond moved
+        self.write_mol2(mol2, names, elements, bonds[1:] + [(bonds[0][0],
+            (bonds[0][1] + 1) % n)])
+        self.assertFalse(param_cache.same_molecule(self.ligand, mol2))
+        #two carbons with different neighbors swapping names
+        def neighbors(i):
+            return sorted(elements[b if a == i else a] for a,b in bonds if i in
+                    (a, b))
+        carbons = [i for i,element in enumerate(elements) if element == 'C']
+        first = carbons[0]
+        second = [i for i in carbons if neighbors(i) != neighbors(first)][0]
+        swapped = list(names)
+        swapped[first],swapped[second] = swapped[second],swapped[first]
+        self.write_mol2(mol2, swapped, elements, bonds)
+        self.assertFalse(param_cache.same_molecule(self.ligand, mol2))
+
+    def test_topology_hash(self):
+        #moved and with the atoms in reverse order
+        moved = pdb.simplepdb(self.ligand, backend='array')
+        moved.set_origin([1.0, -2.0, 3.0])
+        moved.mol_data = moved.mol_data.take(slice(None, None, -1))
+        self.assertEqual(param_cache.topology_hash(moved),
+                param_cache.topology_hash(self.ligand))
+        self.assertNotEqual(param_cache.topology_hash(self.ligand),
+                param_cache.topology_hash(pdb.simplepdb('LIG_noh.pdb')))
+
+    def test_collisions(self):
+        #two molecules whose keys collide get separate entries
+        mol2s = {}
+        for name in ('LIG_h', 'LIG_noh'):
+            mol2s[name] = os.path.join(self.cache_dir, name + '.mol2')
+            self.write_mol2(mol2s[name], *param_cache.bond_graph(name +
+                '.pdb'))
+        ligand = pdb.simplepdb('LIG_noh.pdb')
+        fetched = os.path.join(self.cache_dir, 'fetched.mol2')
+        self.cache.store('key', {'mol2': mol2s['LIG_h']}, self.ligand)
+        self.assertFalse(self.cache.fetch('key', {'mol2': fetched}, ligand))
+        self.cache.store('key', {'mol2': mol2s['LIG_noh']}, ligand)
+        #storing a molecule again doesn't add another entry
+        self.cache.store('key', {'mol2': mol2s['LIG_h']}, self.ligand)
+        self.assertEqual(sorted(os.path.basename(path) for _,_,path in
+            self.cache.entries()), ['key', 'key-1'])
+        for name,mol in (('LIG_h', self.ligand), ('LIG_noh', ligand)):
+            self.assertTrue(self.cache.fetch('key', {'mol2': fetched}, mol))
+            with open(fetched) as f, open(mol2s[name]) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_store_fetch(self):
+        key = self.cache.key(self.ligand, 0, ['leaprc.protein.ff15ipq'], 'LIG',
+                '22.0')
+        self.assertNotEqual(key, self.cache.key(self.ligand, 1,
+            ['leaprc.protein.ff15ipq'], 'LIG', '22.0'))
+        fetched = os.path.join(self.cache_dir, 'fetched.pdb')
+        self.assertFalse(self.cache.fetch(key, {'pdb': fetched}))
+        self.cache.store(key, {'pdb': 'LIG_h.pdb'})
+        self.assertTrue(self.cache.fetch(key, {'pdb': fetched}))
+        with open(fetched) as f, open('LIG_h.pdb') as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_evict(self):
+        self.cache.max_size = os.path.getsize('3EML.pdb') * 1.5
+        self.cache.store('first', {'pdb': '3EML.pdb'})
+        self.cache.store('second', {'pdb': '3EML.pdb'})
+        self.assertEqual([os.path.basename(path) for _,_,path in
+            self.cache.entries()], ['second'])
+
+class PipelineTests(unittest.TestCase):
+    '''
+    Tests resuming a staged run from its manifest.
+    '''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.ran = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def copy_stage(self, src, dst):
+        def run():
+            self.ran.append(dst)
+            shutil.copyfile(self.path(src), self.path(dst))
+        return run
+
+    def make_pipeline(self, param=1):
+        stages = pipeline.Pipeline(self.path('stages.json'))
+        stages.add('b', self.copy_stage('a', 'b'), [self.path('a')],
+                [self.path('b')], {'param': param})
+        stages.add('c', self.copy_stage('b', 'c'), [self.path('b')],
+                [self.path('c')], deps=['b'])
+        return stages
+
+    def test_resume(self):
+        with open(self.path('a'), 'w') as f:
+            f.write('a\n')
+        self.assertEqual(self.make_pipeline().run(), ['b', 'c'])
+        self.assertEqual(self.make_pipeline().run(), [])
+        #a lost output reruns its stage and everything after it
+        os.remove(self.path('b'))
+        self.assertEqual(self.make_pipeline().run(), ['b', 'c'])
+        os.remove(self.path('c'))
+        self.assertEqual(self.make_pipeline().run(), ['c'])
+        self.assertEqual(self.make_pipeline(2).run(), ['b', 'c'])
+        self.assertEqual(self.make_pipeline(2).run(force=True), ['b', 'c'])
+        self.assertEqual(self.ran, ['b', 'c', 'b', 'c', 'c', 'b', 'c', 'b',
+            'c'])
+
+    def test_interrupted(self):
+        with open(self.path('a'), 'w') as f:
+            f.write('a\n')
+        stages = self.make_pipeline()
+        def fail():
+            raise RuntimeError('preempted')
+        stages.stages['c'].func = fail
+        self.assertRaises(RuntimeError, stages.run)
+        self.assertEqual(self.make_pipeline().run(), ['c'])
+
+    def test_order(self):
+        stages = pipeline.Pipeline(self.path('stages.json'))
+        stages.add('late', None, deps=['early'])
+        stages.add('early', None)
+        self.assertEqual([stage.name for stage in stages.order()], ['early',
+            'late'])
+        stages.add('cycle', None, deps=['cycle'])
+        self.assertRaises(ValueError, stages.order)
+
+class MetadataTests(unittest.TestCase):
+    '''
+    Tests memoized parsing of force field files.
+    '''
+    lib = '!!index array str\n "LIG"\n!entry.LIG.unit.atoms table  str name\n "C1" "c3" 0\n "H1" "hc" 0\n!entry.LIG.unit.atomspertinfo table\n "C1" "c3" 0\n'
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.workdir, 'LIG.lib')
+        with open(self.fname, 'w') as f:
+            f.write(self.lib)
+        util.parse_lib.cache_clear()
+
+    def tearDown(self):
+        util.metadata_index = ''
+        util._index = None
+        util.parse_lib.cache_clear()
+        shutil.rmtree(self.workdir)
+
+    def test_parse_lib(self):
+        self.assertEqual(util.get_units(self.fname), ['LIG'])
+        self.assertEqual(util.get_lib_atoms(self.fname), ['C1', 'H1'])
+        self.assertEqual(util.parse_lib.cache_info().misses, 1)
+        #callers can't change what's cached
+        util.get_units(self.fname).append('XXX')
+        self.assertEqual(util.get_units(self.fname), ['LIG'])
+
+    def test_modified(self):
+        util.get_units(self.fname)
+        with open(self.fname, 'w') as f:
+            f.write(self.lib.replace('LIG', 'LIGAND'))
+        self.assertEqual(util.get_units(self.fname), ['LIGAND'])
+
+    def test_index(self):
+        util.metadata_index = os.path.join(self.workdir, 'index.json')
+        util._index = None
+        util.get_units(self.fname)
+        with open(util.metadata_index, 'r') as f:
+            index = json.load(f)
+        key = 'parse_lib:' + os.path.realpath(self.fname)
+        self.assertEqual(index[key]['value']['units'], ['LIG'])
+        #a fresh process takes it from the index instead of parsing the lib
+        index[key]['value']['units'] = ['IDX']
+        with open(util.metadata_index, 'w') as f:
+            json.dump(index, f)
+        util._index = None
+        util.parse_lib.cache_clear()
+        self.assertEqual(util.get_units(self.fname), ['IDX'])
+
+class EngineTests(unittest.TestCase):
+    '''
+    Tests the MD engine backends that don't need an MD code.
+    '''
+    mdin = 'test: initial minimization\n &cntrl\n  imin   = 1,\n  maxcyc = 1000,\n  ntr    = 1,\n  cut    = 10.0\n /\nHold the protein fixed\n500.0\nFIND\n* * S *\nSEARCH\nRES 1 10\nEND\nEND\n'
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.workdir, 'test_min1.in')
+        with open(self.fname, 'w') as f:
+            f.write(self.mdin)
+        self.run = md_engines.MDRun(self.fname, self.path('min1.out'),
+                self.path('test.prmtop'), 'chignolin.pdb', self.path('min1.rst'),
+                mdcrd=self.path('min1.nc'))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def test_read_mdin(self):
+        cntrl,restraint = md_engines.read_mdin(self.fname)
+        self.assertEqual(cntrl, {'imin': 1, 'maxcyc': 1000, 'ntr': 1, 'cut':
+            10.0})
+        self.assertEqual(restraint, {'weight': 500.0, 'residues': [(1, 10)]})
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, md_engines.Engine)
+        self.assertTrue(isinstance(md_engines.get_engine('mock'),
+            md_engines.Engine))
+
+    def test_amber_command(self):
+        engine = md_engines.AmberEngine('cpu', md_engines.local['echo'])
+        args = str(engine.command(self.run)).split()[1:]
+        self.assertEqual(args, ['-O', '-i', self.fname, '-o',
+            self.path('min1.out'), '-p', self.path('test.prmtop'), '-c',
+            'chignolin.pdb', '-r', self.path('min1.rst'), '-x',
+            self.path('min1.nc')])
+
+    def test_mock(self):
+        engine = md_engines.get_engine('mock')
+        engine.execute(engine.command(self.run))
+        with open('chignolin.pdb') as f, open(self.path('min1.rst')) as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertTrue(os.path.isfile(self.path('min1.out')))
+        self.assertTrue(os.path.isfile(self.path('min1.nc')))
+
+class RunnerTests(unittest.TestCase):
+    '''
+    Tests running external tools with logs, timeouts and resource records.
+    '''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.runner = tool_runner.ToolRunner(self.workdir, echo=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_run(self):
+        result = self.runner.run(['sh', '-c', 'echo out; echo err >&2'])
+        self.assertEqual((result.status, result.stdout, result.stderr), ('ok',
+            'out\n', 'err\n'))
+        with open(os.path.join(self.workdir, 'sh.log')) as f:
+            self.assertEqual(f.read().splitlines()[1:], ['out', 'err'])
+        with open(os.path.join(self.workdir, 'tools.jsonl')) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record['returncode'], 0)
+        self.assertTrue(record['maxrss'] > 0)
+        self.assertRaises(tool_runner.ToolError, self.runner.run, ['false'])
+
+    def test_timeout(self):
+        self.runner.timeouts = {'sleep': 0.2}
+        with self.assertRaises(tool_runner.ToolError) as context:
+            self.runner.run(['sleep', '10'])
+        self.assertEqual(context.exception.result.status, 'timeout')
+        self.assertTrue(context.exception.result.wall < 5)
+
+    def test_run_all(self):
+        start = time.time()
+        results = self.runner.run_all([(['sleep', '0.5'], {}), (['false'], {}),
+            (['sleep', '0.5'], {'stage': 'other'})])
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([result.stage for result in results[::2]], ['sleep',
+            'other'])
+        self.assertTrue(isinstance(results[1], tool_runner.ToolError))
+        self.assertEqual(results[1].result.status, 'failed')
+
+    def test_first_success(self):
+        jobs = [(['sh', '-c', 'sleep 0.2; exit 1'], {}), (['true'], {'stage':
+            'second'}), (['sleep', '10'], {'stage': 'third'})]
+        i,result = self.runner.first_success(jobs)
+        self.assertEqual((i, result.stage), (1, 'second'))
+        self.assertEqual([result.status for result in self.runner.results if
+            result.stage == 'third'], ['cancelled'])
+
+class ProfilingTests(unittest.TestCase):
+    '''
+    Tests per-stage profiling.
+    '''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+        self.profiler = profiling.profiler
+        profiling.profiler = profiling.Profiler()
+        profiling.profiler.start_run(os.path.join('logs', 'profile.jsonl'))
+
+    def tearDown(self):
+        profiling.profiler = self.profiler
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_profiled(self):
+        @profiling.profiled
+        def inner():
+            with open('inner.out', 'w') as f:
+                f.write('x' * 10)
+            self.assertEqual(profiling.profiler.stack, ['outer', 'inner'])
+        @profiling.profiled(name='outer')
+        def outer_stage():
+            inner()
+        outer_stage()
+        profiling.profiler.write('test_profile')
+        with open('test_profile.json') as f:
+            records = json.load(f)
+        self.assertEqual([(record['stage'], record['parent']) for record in
+            records], [('outer', ''), ('inner', 'outer')])
+        self.assertEqual(records[1]['files'], {'inner.out': 10})
+        self.assertEqual(records[0]['bytes'], 10)
+        self.assertFalse(any(record['overlapped'] for record in records))
+        summary = profiling.summarize(profiling.find_profiles(['.']))
+        self.assertEqual(sorted((row['stage'], row['calls'], row['runs']) for
+            row in summary), [('inner', 1, 1), ('outer', 1, 1)])
+
+    def test_overlaps(self):
+        def record(pid, start, wall, dirname='.'):
+            return {'pid': pid, 'start': start, 'wall': wall, 'dir': dirname}
+        records = profiling.mark_overlaps([record(1, 0, 10), record(1, 2, 3),
+            record(2, 5, 10), record(3, 20, 1), record(4, 0, 30, 'scratch')])
+        self.assertEqual([record['overlapped'] for record in records], [True,
+            False, True, False, False])
+
+    def test_failure(self):
+        @profiling.profiled
+        def fails():
+            raise ValueError()
+        self.assertRaises(ValueError, fails)
+        self.assertEqual(profiling.profiler.records[0]['status'], 'ValueError')
+
+class ManifestTests(unittest.TestCase):
+    '''
+    Tests reading batch manifests and writing the batch summary.
+    '''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, fname, contents):
+        path = os.path.join(self.workdir, fname)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_csv(self):
+        fname = self.write('batch.csv', 'ligand,name,receptor,net_charge\n'
+                'ligs/a.mol2,,,\nligs/b.mol2,bee,other.pdb,-1\n')
+        complexes = manifest.read_manifest(fname, 'rec.pdb')
+        self.assertEqual(complexes, [{'ligand': os.path.join(self.workdir,
+            'ligs/a.mol2'), 'receptor': os.path.abspath('rec.pdb'), 'name':
+            'a'}, {'ligand': os.path.join(self.workdir, 'ligs/b.mol2'),
+                'name': 'bee', 'receptor': os.path.join(self.workdir,
+                    'other.pdb'), 'net_charge': '-1'}])
+        #only the ligand column is required
+        fname = self.write('ligands.csv', 'ligand\nc.pdb\n')
+        self.assertEqual([entry['name'] for entry in
+            manifest.read_manifest(fname, 'rec.pdb')], ['c'])
+        self.assertRaises(AssertionError, manifest.read_manifest, fname)
+
+    def test_yaml(self):
+        try:
+            import yaml
+        except ImportError:
+            self.skipTest('PyYAML is not installed')
+        fname = self.write('batch.yaml', 'receptor: rec.pdb\ncomplexes:\n'
+                '  - ligand: a.mol2\n    net_charge: 1\n'
+                '  - {ligand: b.mol2, name: bee, receptor: other.pdb}\n')
+        complexes = manifest.read_manifest(fname, 'ignored.pdb')
+        self.assertEqual([(entry['name'], os.path.basename(entry['receptor']),
+            entry.get('net_charge')) for entry in complexes], [('a', 'rec.pdb',
+                '1'), ('bee', 'other.pdb', None)])
+        #a bare list uses the default receptor
+        fname = self.write('list.yaml', '- ligand: a.mol2\n')
+        self.assertEqual(manifest.read_manifest(fname, 'rec.pdb')[0]
+                ['receptor'], os.path.abspath('rec.pdb'))
+
+    def test_bad_manifest(self):
+        fname = self.write('noligand.csv', 'name,receptor\na,rec.pdb\n')
+        with self.assertRaises(AssertionError) as context:
+            manifest.read_manifest(fname)
+        self.assertIn('entry 1 has no ligand', str(context.exception))
+        fname = self.write('duplicate.csv', 'ligand,name\na.pdb,x\n'
+                'b.pdb,x\n')
+        with self.assertRaises(AssertionError) as context:
+            manifest.read_manifest(fname, 'rec.pdb')
+        self.assertIn('Duplicate complex name x', str(context.exception))
+        #names taken from the ligand filenames can collide too
+        fname = self.write('samebase.csv', 'ligand\none/a.pdb\ntwo/a.pdb\n')
+        self.assertRaises(AssertionError, manifest.read_manifest, fname,
+                'rec.pdb')
+
+    def test_summary(self):
+        fname = os.path.join(self.workdir, 'summary.csv')
+        rows = [{'name': 'a', 'status': 'done', 'seconds': '1.5', 'error':
+            ''}, {'name': 'bee', 'status': 'failed', 'seconds': '0.2', 'error':
+                'tleap failed\nsee logs'}]
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            manifest.write_summary(fname, rows)
+        with open(fname, newline='') as f:
+            self.assertEqual(list(csv.reader(f)), [['name', 'status',
+                'seconds', 'error'], ['a', 'done', '1.5', ''], ['bee',
+                    'failed', '0.2', 'tleap failed\nsee logs']])
+
+class SolvationTests(unittest.TestCase):
+    '''
+    Tests estimating the solvated system before running tleap.
+    '''
+    def test_net_charge(self):
+        #GYDPETGTWG: one Asp, one Glu, and charged termini that cancel
+        mol = pdb.simplepdb('chignolin.pdb')
+        self.assertEqual(util.estimate_net_charge(mol), -2)
+        ligand = pdb.simplepdb('LIGreceptor.pdb')
+        self.assertEqual(util.estimate_net_charge(ligand), None)
+        self.assertEqual(util.estimate_net_charge(ligand, {'LIG': 1}),
+                util.estimate_net_charge(ligand, {'LIG': 0}) + 1)
+
+    def test_octahedron_box(self):
+        #a point only has to clear the hexagonal faces
+        D,length,volume = util.octahedron_box([[1.0, 2.0, 3.0]], 10.0)
+        self.assertAlmostEqual(D, 40 / 3**0.5)
+        self.assertAlmostEqual(length, D * 3**0.5 / 2)
+        self.assertAlmostEqual(volume, D**3 / 2)
+        #a long rod only has to clear the square ones
+        rod = [[x, 0.0, 0.0] for x in range(-50, 51)]
+        self.assertAlmostEqual(util.octahedron_box(rod, 10.0)[0], 120.0)
+
+    def test_estimate_solvation(self):
+        mol = pdb.simplepdb('chignolin.pdb')
+        estimate = util.estimate_solvation(util.get_coords(mol),
+                mol.get_elements(), 12.0, -2)
+        self.assertEqual(estimate['ions'], {'Na+': 2, 'Cl-': 0})
+        self.assertEqual(estimate['natoms'], mol.natoms + 3 *
+                estimate['waters'] + 2)
+        self.assertTrue(estimate['solute_volume'] < estimate['box_volume'])
+
+    def write_prmtop(self, prmtop, charges):
+        with open(prmtop, 'w') as f:
+            f.write('%FLAG ATOM_NAME\n%FORMAT(20a4)\n' + 'X   ' *
+                    len(charges) + '\n%FLAG CHARGE\n%FORMAT(5E16.8)\n')
+            for i in range(0, len(charges), 5):
+                f.write(''.join('%16.8E' %(charge * 18.2223) for charge in
+                    charges[i:i+5]) + '\n')
+            f.write('%FLAG ATOMIC_NUMBER\n%FORMAT(10I8)\n')
+
+    def test_prmtop_charge(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            prmtop = os.path.join(tmpdir, 'test.prmtop')
+            self.write_prmtop(prmtop, [1.0, -1.0, -0.5, -0.25, 0.125, -0.375])
+            self.assertAlmostEqual(util.get_prmtop_charge(prmtop), -1.0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_neutral(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            prmtop = os.path.join(tmpdir, 'test.prmtop')
+            builds = []
+            def build(ions, charge):
+                #a stand-in for tleap, which neutralizes things itself
+                builds.append(ions)
+                self.write_prmtop(prmtop, [charge if ions else 0.0, 0.5,
+                    -0.5])
+            estimated = {'Na+': 2, 'Cl-': 0}
+            #a right estimate is used as is
+            self.assertEqual(util.build_neutral(lambda ions: build(ions, 0.0),
+                prmtop, estimated), estimated)
+            self.assertEqual(builds, [estimated])
+            #a wrong one falls back to tleap's addions 0
+            builds[:] = []
+            self.assertEqual(util.build_neutral(lambda ions: build(ions, 1.0),
+                prmtop, estimated), None)
+            self.assertEqual(builds, [estimated, None])
+            self.assertAlmostEqual(util.get_prmtop_charge(prmtop), 0.0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_estimated_ions(self):
+        estimate = {'ions': {'Na+': 2, 'Cl-': 0}}
+        self.assertEqual(util.estimated_ions(estimate), estimate['ions'])
+        #extra leap commands can change the charge
+        self.assertEqual(util.estimated_ions(estimate, 'extra.leap'), None)
+        self.assertEqual(util.estimated_ions({'ions': None}), None)
+
+class RMSDTests(unittest.TestCase):
+    '''
+    Tests pairwise RMSDs between trajectory frames.
+    '''
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        mol = pdb.simplepdb('chignolin.pdb')
+        #a fake trajectory of chignolin jiggling around
+        self.coords = (np.array(util.get_coords(mol))[None] +
+                rng.normal(scale=1.0, size=(37, mol.natoms, 3))).astype(
+                        np.float32)
+
+    def naive(self, coords):
+        coords = coords.astype(np.float64)
+        return np.array([[np.sqrt(((a - b)**2).sum(axis=1).mean()) for b in
+            coords] for a in coords])
+
+    def test_matrix(self):
+        expected = self.naive(self.coords)
+        for tile in (5, 37, 512):
+            rmat = rmsd_engine.rmsd_matrix(self.coords, tile)
+            np.testing.assert_allclose(rmat, expected, atol=1e-3)
+            np.testing.assert_array_equal(rmat, rmat.T)
+        np.testing.assert_allclose(rmsd_engine.rmsd_matrix(self.coords, 8, 4),
+                expected, atol=1e-3)
+        self.assertTrue((np.diag(rmat) == 0).all())
+
+    def test_out_of_core(self):
+        expected = self.naive(self.coords)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'coords.npy')
+            coords = rmsd_engine.open_memmap(fname, self.coords.shape)
+            coords[:] = self.coords
+            rmat = rmsd_engine.open_memmap(os.path.join(tmpdir, 'rmsd.npy'),
+                    expected.shape)
+            for threads in (1, 3):
+                counts = rmsd_engine.tiled_rmsd(coords, rmat, 2.0, 6, threads)
+                np.testing.assert_array_equal(counts, (expected < 2.0).sum(
+                    axis=1))
+            del rmat
+            rmat = np.load(os.path.join(tmpdir, 'rmsd.npy'), mmap_mode='r')
+            np.testing.assert_allclose(rmat, expected, atol=1e-3)
+            #counts don't need the matrix stored at all
+            np.testing.assert_array_equal(rmsd_engine.tiled_rmsd(coords,
+                cutoff=2.0, tile=10), counts)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def kabsch(self, a, b):
+        a = a - a.mean(axis=0)
+        b = b - b.mean(axis=0)
+        u,singular,vt = np.linalg.svd(a.T.dot(b))
+        #no reflections
+        singular[-1] *= np.sign(np.linalg.det(u.dot(vt)))
+        return np.sqrt(max((a**2).sum() + (b**2).sum() - 2 * singular.sum(),
+            0) / len(a))
+
+    def test_superpose(self):
+        coords = self.coords.astype(np.float64)
+        #a rotated and translated copy of frame 3
+        rotation,_ = np.linalg.qr(np.random.default_rng(1).normal(size=(3,
+            3)))
+        rotation *= np.sign(np.linalg.det(rotation))
+        coords[5] = coords[3].dot(rotation.T) + 10.0
+        expected = np.array([[self.kabsch(a, b) for b in coords] for a in
+            coords])
+        for block in (coords, coords.astype(np.float32)):
+            rmat = rmsd_engine.rmsd_matrix(block, 8, superpose=True)
+            np.testing.assert_allclose(rmat, expected, atol=1e-3)
+            self.assertAlmostEqual(rmat[3,5], 0.0, places=3)
+        np.testing.assert_allclose(rmsd_engine.rmsd_to(coords, coords[2],
+            True), expected[2], atol=1e-6)
+        self.assertAlmostEqual(rmsd_engine.rmsd(coords[3], coords[5], True),
+                0.0, places=5)
+        self.assertTrue(rmsd_engine.rmsd(coords[3], coords[5]) > 1.0)
+        #superposition can only lower an RMSD
+        self.assertTrue((rmat <= self.naive(coords) + 1e-3).all())
+
+    def test_farthest_points(self):
+        expected = self.naive(self.coords)
+        #the original algorithm: rescan every frame against every pick
+        picks = [0]
+        for _ in range(5):
+            nearest = expected[:,picks].min(axis=1)
+            picks.append(int(np.argmax(nearest)))
+        sampler = rmsd_engine.farthest_point_sampling(self.coords, 6, tile=7)
+        self.assertEqual(sampler.centers, picks)
+        np.testing.assert_allclose(sampler.distances, expected[:,
+            picks].min(axis=1), atol=1e-5)
+        self.assertTrue((sampler.distances[picks] == 0).all())
+        #the original cluster assignment: the first nearest pick
+        nearest = expected[:,picks].argmin(axis=1)
+        np.testing.assert_array_equal(sampler.assignments, nearest)
+        np.testing.assert_array_equal(sampler.cluster_sizes(), np.bincount(
+            nearest, minlength=6))
+        np.testing.assert_allclose(sampler.cluster_radii(), [expected[nearest
+            == i, pick].max() for i,pick in enumerate(picks)], atol=1e-5)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'clusters.npz')
+            sampler.save(fname)
+            saved = np.load(fname)
+            np.testing.assert_array_equal(saved['centers'], picks)
+            np.testing.assert_array_equal(saved['assignments'], nearest)
+            fname = os.path.join(tmpdir, 'clusters.csv')
+            sampler.save(fname)
+            rows = np.loadtxt(fname, delimiter=',', skiprows=1)
+            np.testing.assert_array_equal(rows[:,1], np.array(picks)[nearest])
+            np.testing.assert_allclose(rows[:,3], sampler.distances, atol=1e-4)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_tiles(self):
+        self.assertEqual(rmsd_engine.tiles(10, 4), [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(rmsd_engine.tiles(0, 4), [])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+import asyncio, json, os, shlex, subprocess, sys, time
+
+#Runs external tools (obabel, antechamber, tleap, pmemd...) under asyncio, so
+#independent invocations can run at once. Each tool's stdout and stderr are
+#streamed line by line to the log file for its stage as they're produced
+#(and echoed, like plumbum's TEE), stages can have timeouts, and the wall
+#time, CPU time and peak memory of every run are appended to tools.jsonl in
+#the log directory.
+
+class ToolResult:
+    '''
+    What happened when a tool ran.
+
+    Attributes:
+        stage: Name the run was logged under.
+
+        argv: The command line.
+
+        returncode: Exit code; negative if killed by a signal.
+
+        status: "ok", "failed", "timeout" or "cancelled".
+
+        start: When it started, in seconds since the epoch.
+
+        wall, user, system: Elapsed, user CPU and system CPU time in seconds.
+
+        maxrss: Peak resident memory in MB.
+
+        stdout, stderr: Everything the tool printed.
+
+        log: The log file it was streamed to.
+    '''
+    def __init__(self, stage, argv, cwd, log):
+        self.stage = stage
+        self.argv = argv
+        self.cwd = cwd
+        self.log = log
+        self.start = None
+        self.returncode = None
+        self.status = None
+        self.wall = self.user = self.system = self.maxrss = 0.0
+        self.stdout = ''
+        self.stderr = ''
+
+    def record(self):
+        '''
+        Return the result as a JSON-serializable dict, without the output
+        '''
+        return {'stage': self.stage, 'argv': self.argv, 'cwd': self.cwd,
+                'returncode': self.returncode, 'status': self.status, 'wall':
+                self.wall, 'user': self.user, 'system': self.system, 'maxrss':
+                self.maxrss, 'log': self.log, 'start': self.start}
+
+class ToolError(RuntimeError):
+    '''
+    Raised when a tool fails or times out; has the ToolResult as result
+    '''
+    def __init__(self, result):
+        self.result = result
+        RuntimeError.__init__(self, '%s %s with exit code %s; see %s' %
+                (result.stage, result.status, result.returncode, result.log))
+
+def get_argv(command):
+    '''
+    Return the argument list for a plumbum command or a sequence of args
+    '''
+    if hasattr(command, 'formulate'):
+        command = command.formulate()
+    return [str(arg) for arg in command]
+
+class ToolRunner:
+    '''
+    Runs external tools with per-stage logs, timeouts and resource records.
+
+    Attributes:
+        log_dir: Directory for <stage>.log files and tools.jsonl.
+
+        timeouts: Dict of stage -> timeout in seconds; stages not in it can
+        run indefinitely.
+
+        echo: Whether to also print the tools' output as it's produced.
+
+        results: ToolResults for every run in this process.
+    '''
+    def __init__(self, log_dir='logs', timeouts=None, echo=True):
+        self.log_dir = log_dir
+        self.timeouts = timeouts or {}
+        self.echo = echo
+        self.results = []
+
+    async def stream(self, pipe, log, lines, echo):
+        '''
+        Copy lines from pipe to the log (and echo) until it closes
+        '''
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2**24)
+        transport,_ = await loop.connect_read_pipe(lambda:
+                asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                text = line.decode(errors='replace')
+                lines.append(text)
+                log.write(text)
+                log.flush()
+                if self.echo:
+                    echo.write(text)
+        finally:
+            transport.close()
+
+    async def run_async(self, command, stage=None, cwd=None, timeout=None,
+            check=True):
+        '''
+        Run command, a plumbum command or argument list, logging it under
+        stage (by default the executable's name) and killing it after timeout
+        seconds (by default the stage's timeout). Returns a ToolResult; with
+        check, raises ToolError unless the tool succeeded
+        '''
+        argv = get_argv(command)
+        if not stage:
+            stage = os.path.basename(argv[0])
+        if timeout is None:
+            timeout = self.timeouts.get(stage)
+        os.makedirs(self.log_dir, exist_ok=True)
+        result = ToolResult(stage, argv, os.path.abspath(cwd or '.'),
+                os.path.abspath(os.path.join(self.log_dir, stage + '.log')))
+        loop = asyncio.get_running_loop()
+        stdout, stderr = [], []
+        with open(result.log, 'a') as log:
+            log.write('$ %s\n' %' '.join(shlex.quote(arg) for arg in argv))
+            log.flush()
+            result.start = time.time()
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, cwd=cwd)
+            readers = asyncio.gather(self.stream(proc.stdout, log, stdout,
+                sys.stdout), self.stream(proc.stderr, log, stderr, sys.stderr))
+            #reap the child ourselves so its resource usage comes with it
+            waiter = loop.run_in_executor(None, os.wait4, proc.pid, 0)
+            cancelled = False
+            try:
+                _,status,usage = await asyncio.wait_for(asyncio.shield(waiter),
+                        timeout)
+                result.status = 'ok'
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                cancelled = isinstance(e, asyncio.CancelledError)
+                result.status = 'cancelled' if cancelled else 'timeout'
+                proc.kill()
+                _,status,usage = await waiter
+            await readers
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        result.returncode = proc.returncode
+        if result.status == 'ok' and proc.returncode != 0:
+            result.status = 'failed'
+        result.wall = time.time() - result.start
+        result.user = usage.ru_utime
+        result.system = usage.ru_stime
+        #ru_maxrss is in kB on Linux, bytes on macOS
+        result.maxrss = usage.ru_maxrss / (2.**20 if sys.platform ==
+                'darwin' else 2.**10)
+        result.stdout = ''.join(stdout)
+        result.stderr = ''.join(stderr)
+        self.results.append(result)
+        with open(os.path.join(self.log_dir, 'tools.jsonl'), 'a') as f:
+            f.write(json.dumps(result.record()) + '\n')
+        if cancelled:
+            raise asyncio.CancelledError()
+        if check and result.status != 'ok':
+            raise ToolError(result)
+        return result
+
+    def run(self, command, stage=None, **kwargs):
+        '''
+        Run one tool and wait for it; see run_async
+        '''
+        return asyncio.run(self.run_async(command, stage, **kwargs))
+
+    async def gather(self, jobs):
+        '''
+        Run (command, kwargs) jobs at once and wait for all of them; failures
+        are returned in place of their ToolResults rather than raised
+        '''
+        return await asyncio.gather(*[self.run_async(command, **kwargs) for
+            command,kwargs in jobs], return_exceptions=True)
+
+    def run_all(self, jobs):
+        '''
+        Run (command, kwargs) jobs all at once. Returns a ToolResult or
+        ToolError for each, in order
+        '''
+        return asyncio.run(self.gather(jobs))
+
+    async def first_success_async(self, jobs, accept=None):
+        tasks = [asyncio.ensure_future(self.run_async(command, **kwargs)) for
+                command,kwargs in jobs]
+        try:
+            for i,task in enumerate(tasks):
+                try:
+                    result = await task
+                except ToolError:
+                    continue
+                if accept is None or accept(i, result):
+                    return i, result
+            return None, None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def first_success(self, jobs, accept=None):
+        '''
+        Run (command, kwargs) jobs all at once, in order of preference, and
+        return (index, ToolResult) for the most preferred one that succeeds
+        (and that accept(index, result) approves, if given), or (None, None).
+        The rest are killed as soon as the answer is known
+        '''
+        return asyncio.run(self.first_success_async(jobs, accept))